@@ -19,7 +19,7 @@ import urlparse
 
 from django.conf import settings
 
-from localtv import models
+from localtv import models, util
 
 class FixAJAXMiddleware:
     """
@@ -66,19 +66,13 @@ def context_processor(request):
         if sitelocation.user_is_admin(request.user):
             display_submit_button = True
 
-    try:
-        cache_invalidator = str(models.Video.objects.order_by(
-                '-when_modified').values_list('when_modified', flat=True)[0])
-    except IndexError:
-        cache_invalidator = None
-
     return  {
         'sitelocation': sitelocation,
         'request': request,
         'user_is_admin': request.user_is_admin,
         'categories':  models.Category.objects.filter(site=sitelocation.site,
                                                       parent=None),
-        'cache_invalidator': cache_invalidator,
+        'cache_invalidator': util.get_site_generation(sitelocation.site_id),
 
         'display_submit_button': display_submit_button,
 
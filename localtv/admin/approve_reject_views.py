@@ -16,23 +16,32 @@
 # along with Miro Community.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import os
+import sys
 
 from django.conf import settings
-from django.core.mail import EmailMessage
-from django.core.paginator import Paginator, EmptyPage
+from django.core.cache import cache
+from django.core.paginator import EmptyPage
 from django.core.urlresolvers import reverse
 from django.shortcuts import render_to_response, get_object_or_404
-from django.template import RequestContext, Context, loader
+from django.template import RequestContext
 from django.views.decorators.csrf import csrf_protect
 
+import celery
+from importlib import import_module
+
 from localtv.decorators import require_site_admin, \
     referrer_redirect
-from localtv import models
+from localtv import models, tasks
 from localtv.admin import feeds
+from localtv.pagination import CachedCountPaginator
 from django.http import HttpResponse, HttpResponseBadRequest, \
     HttpResponseRedirect
 
-from notification import models as notification
+# queues bigger than this are cleared by the moderate_videos command in the
+# background, rather than during the request
+BACKGROUND_MODERATION_THRESHOLD = getattr(
+    settings, 'LOCALTV_BACKGROUND_MODERATION_THRESHOLD', 1000)
 
 ## --------------------
 ## Video approve/reject
@@ -44,7 +53,7 @@ def get_video_paginator(sitelocation):
         site=sitelocation.site).order_by(
         'when_submitted', 'when_published')
 
-    return Paginator(videos, 10)
+    return CachedCountPaginator(videos, 10)
 
 @require_site_admin
 @csrf_protect
@@ -101,20 +110,7 @@ def approve_video(request):
         current_video.last_featured = datetime.datetime.now()
 
     current_video.save()
-
-    if current_video.user and current_video.user.email:
-        video_approved = notification.NoticeType.objects.get(
-            label="video_approved")
-        if notification.should_send(current_video.user, video_approved, "1"):
-            subject = '[%s] "%s" was approved!' % (
-                current_video.site.name,
-                current_video)
-            t = loader.get_template(
-                'localtv/submit_video/approval_notification_email.txt')
-            c = Context({'current_video': current_video})
-            message = t.render(c)
-            EmailMessage(subject, message, settings.DEFAULT_FROM_EMAIL,
-                         [current_video.user.email]).send(fail_silently=True)
+    models.send_approval_notifications([current_video])
 
     return HttpResponse('SUCCESS')
 
@@ -171,9 +167,8 @@ def reject_all(request):
         return HttpResponseBadRequest(
             'Page number request exceeded available pages')
 
-    for video in page.object_list:
-        video.status = models.VIDEO_STATUS_REJECTED
-        video.save()
+    models.Video.objects.moderate([video.pk for video in page.object_list],
+                                  models.VIDEO_STATUS_REJECTED)
 
     return HttpResponse('SUCCESS')
 
@@ -190,10 +185,11 @@ def approve_all(request):
         return HttpResponseBadRequest(
             'Page number request exceeded available pages')
 
-    for video in page.object_list:
-        video.status = models.VIDEO_STATUS_ACTIVE
-        video.when_approved = datetime.datetime.now()
-        video.save()
+    video_ids = [video.pk for video in page.object_list]
+    models.Video.objects.moderate(video_ids, models.VIDEO_STATUS_ACTIVE)
+    models.send_approval_notifications(
+        models.Video.objects.filter(pk__in=video_ids).select_related(
+            'user', 'site'))
 
     return HttpResponse('SUCCESS')
 
@@ -203,11 +199,38 @@ def clear_all(request):
     videos = models.Video.objects.filter(
         site=request.sitelocation.site,
         status=models.VIDEO_STATUS_UNAPPROVED)
+    if 'task_id' in request.GET:
+        task = celery.result.AsyncResult(request.GET['task_id'])
+        if task.ready():
+            return HttpResponseRedirect(
+                reverse('localtv_admin_approve_reject'))
+        done, total = cache.get(
+            models.MODERATION_PROGRESS_KEY % request.sitelocation.site.pk,
+            (0, 0))
+        return render_to_response('localtv/admin/moderation_wait.html',
+                                  {'task_id': request.GET['task_id'],
+                                   'done': done,
+                                   'total': total},
+                                  context_instance=RequestContext(request))
     if request.POST.get('confirm') == 'yes':
-        for video in videos:
-            video.status = models.VIDEO_STATUS_REJECTED
-            video.save()
-        return HttpResponseRedirect(reverse('localtv_admin_approve_reject'))
+        video_ids = list(videos.values_list('pk', flat=True))
+        if len(video_ids) <= BACKGROUND_MODERATION_THRESHOLD:
+            models.Video.objects.moderate(video_ids,
+                                          models.VIDEO_STATUS_REJECTED)
+            return HttpResponseRedirect(
+                reverse('localtv_admin_approve_reject'))
+
+        mod = import_module(settings.SETTINGS_MODULE)
+        manage_py = os.path.join(
+            os.path.dirname(mod.__file__),
+            'manage.py')
+        result = tasks.check_call.delay((
+                getattr(settings, 'PYTHON_EXECUTABLE', sys.executable),
+                manage_py,
+                'moderate_videos',
+                '--reject'))
+        return HttpResponseRedirect('%s?task_id=%s' % (
+                request.path, result.task_id))
     else:
         return render_to_response('localtv/admin/clear_confirm.html',
                                   {'videos': videos},
@@ -18,7 +18,7 @@
 from datetime import datetime
 
 from django.contrib.auth.models import User
-from django.core.paginator import Paginator, EmptyPage
+from django.core.paginator import EmptyPage
 from django.db.models import Q
 from django.forms.formsets import DELETION_FIELD_NAME
 from django.http import HttpResponseRedirect, HttpResponseBadRequest
@@ -29,6 +29,7 @@ from django.views.decorators.csrf import csrf_protect
 from localtv.decorators import require_site_admin
 from localtv import models
 from localtv.admin import forms
+from localtv.pagination import CachedCountPaginator
 from localtv.util import SortHeaders, MockQueryset
 
 try:
@@ -113,7 +114,7 @@ def bulk_edit(request):
             sort.replace('name', 'name_lower'))
     else:
         videos = videos.order_by(sort)
-    video_paginator = Paginator(videos, 30)
+    video_paginator = CachedCountPaginator(videos, 30)
     try:
         page = video_paginator.page(int(request.GET.get('page', 1)))
     except ValueError:
@@ -52,7 +52,7 @@ class UnapprovedVideosFeed(views.BaseVideosFeed):
             site=self.sitelocation.site,
             status=models.VIDEO_STATUS_UNAPPROVED).order_by(
             'when_submitted', 'when_published')
-        return videos[:views.LOCALTV_FEED_LENGTH]
+        return models.prefetch_videos(videos[:views.LOCALTV_FEED_LENGTH])
 
 
 class UnapprovedUserVideosFeed(UnapprovedVideosFeed):
@@ -67,7 +67,7 @@ class UnapprovedUserVideosFeed(UnapprovedVideosFeed):
             feed=None, search=None)
         videos = videos.order_by(
             'when_submitted', 'when_published')
-        return videos[:views.LOCALTV_FEED_LENGTH]
+        return models.prefetch_videos(videos[:views.LOCALTV_FEED_LENGTH])
 
 
 unapproved = verify_secret(views.feed_view(UnapprovedVideosFeed))
@@ -17,6 +17,7 @@
 
 import datetime
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
 from django.core.paginator import Paginator, EmptyPage
@@ -28,11 +29,15 @@ from vidscraper import metasearch
 from localtv.decorators import require_site_admin, \
     referrer_redirect
 from localtv import models, util
-from localtv.admin.util import MetasearchVideo, metasearch_from_querystring, \
+from localtv.admin.util import MetasearchVideo, metasearch as search_sites, \
     strip_existing_metasearchvideos
 
 Profile = util.get_profile_model()
 
+# seconds to wait for the video sites before showing the results we have;
+# the page reloads to pick up the rest
+LIVESEARCH_WAIT = getattr(settings, 'LOCALTV_LIVESEARCH_WAIT', 3)
+
 ## ----------
 ## Utils
 ## ----------
@@ -115,18 +120,22 @@ def livesearch(request):
     query_string, order_by, query_subkey = get_query_components(request)
 
     results = []
+    pending = []
     if query_string:
         results = cache.get(query_subkey)
-        if results is None:
-            raw_results = metasearch_from_querystring(
-                query_string, order_by)
+        pending = cache.get(query_subkey + '-pending') or []
+        if results is None or pending:
+            raw_results, pending = search_sites(query_string, order_by,
+                                                wait=LIVESEARCH_WAIT)
             sorted_raw_results = metasearch.intersperse_results(raw_results)
             results = [
                 MetasearchVideo.create_from_vidscraper_dict(raw_result)
                 for raw_result in sorted_raw_results]
             results = strip_existing_metasearchvideos(
-                results, request.sitelocation.site)
-            cache.add(query_subkey, results)
+                [result for result in results if result is not None],
+                request.sitelocation.site)
+            cache.set(query_subkey, results)
+            cache.set(query_subkey + '-pending', pending)
 
     is_saved_search = bool(
         models.SavedSearch.objects.filter(
@@ -153,6 +162,7 @@ def livesearch(request):
          'video_list': page.object_list,
          'query_string': query_string,
          'order_by': order_by,
+         'pending_sites': pending,
          'is_saved_search': is_saved_search,
          'saved_searches': models.SavedSearch.objects.filter(
                 site=request.sitelocation.site)},
@@ -10,6 +10,7 @@ from django.db.models import Q
 from django.test.client import Client
 from django.utils.encoding import force_unicode
 
+from localtv.admin import util as admin_util
 from localtv.admin.util import MetasearchVideo
 from localtv.tests import BaseTestCase
 from localtv import models, util
@@ -1380,6 +1381,43 @@ class SearchAdministrationTestCase(AdministrationBaseTestCase):
         self.assertEquals(response.context[2]['order_by'], 'latest')
         self.assertEquals(response.context[2]['is_saved_search'], False)
 
+    def test_metasearch_deadlines(self):
+        """
+        admin_util.metasearch() should search the video sites at the same
+        time, return what it has once `wait` seconds have passed along with
+        the sites which are still searching, and leave out the sites which
+        run past their own deadline.
+        """
+        import time
+        def suite(id, delay):
+            def func(include_terms, exclude_terms, order_by):
+                time.sleep(delay)
+                return [{'id': id}]
+            return {'id': id, 'func': func, 'order_bys': ('latest',)}
+
+        old_suites = vidscraper.metasearch.AUTOSEARCH_SUITES
+        old_timeouts = admin_util.METASEARCH_TIMEOUTS
+        vidscraper.metasearch.AUTOSEARCH_SUITES = [
+            suite('fast', 0), suite('slow', 0.5), suite('stuck', 0.5)]
+        admin_util.METASEARCH_TIMEOUTS = {'stuck': 0.2}
+        try:
+            start = time.time()
+            results, pending = admin_util.metasearch('query', 'latest',
+                                                     wait=0.3)
+            self.assertTrue(time.time() - start < 0.5)
+            self.assertEquals(results, {'fast': [{'id': 'fast'}]})
+            self.assertEquals(pending, ['slow'])
+
+            time.sleep(0.5)
+            results, pending = admin_util.metasearch('query', 'latest',
+                                                     wait=0.3)
+            self.assertEquals(results, {'fast': [{'id': 'fast'}],
+                                        'slow': [{'id': 'slow'}]})
+            self.assertEquals(pending, [])
+        finally:
+            vidscraper.metasearch.AUTOSEARCH_SUITES = old_suites
+            admin_util.METASEARCH_TIMEOUTS = old_timeouts
+
     def test_GET_query_pagination(self):
         """
         A GET request to the livesearch view with GET['query'] and GET['page']
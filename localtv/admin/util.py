@@ -1,5 +1,10 @@
 
 import datetime
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
 
 import vidscraper
 
@@ -123,14 +128,111 @@ class MetasearchVideo(object):
         return self.publish_date
 
 
-def metasearch_from_querystring(querystring, order_by='relevant'):
+# seconds each video site gets to answer a search; LOCALTV_METASEARCH_TIMEOUTS
+# can set a different deadline for some of them, by suite id
+METASEARCH_TIMEOUT = getattr(settings, 'LOCALTV_METASEARCH_TIMEOUT', 15)
+METASEARCH_TIMEOUTS = getattr(settings, 'LOCALTV_METASEARCH_TIMEOUTS', {})
+# how long the answers from each video site are kept
+METASEARCH_CACHE_TIMEOUT = 5 * 60
+
+def _metasearch_cache_key(suite, include_terms, exclude_terms, order_by):
+    return 'localtv.metasearch:%s:%s:%s' % (
+        suite['id'], order_by,
+        hash((tuple(sorted(include_terms)), tuple(sorted(exclude_terms)))))
+
+def _search_suite(suite, include_terms, exclude_terms, order_by, timeout,
+                  collected):
+    """
+    Searches one video site.  If the results come back before its deadline,
+    they're put in `collected` and in the cache.  Runs in its own thread; a
+    site which fails has no results.
+    """
+    start = time.time()
+    cache_key = _metasearch_cache_key(suite, include_terms, exclude_terms,
+                                      order_by)
+    try:
+        results = suite['func'](include_terms=include_terms,
+                                exclude_terms=exclude_terms,
+                                order_by=order_by) or []
+    except Exception:
+        results = []
+    if time.time() - start <= timeout:
+        collected[suite['id']] = results
+        cache.set(cache_key, results, METASEARCH_CACHE_TIMEOUT)
+    cache.delete(cache_key + ':running')
+
+def metasearch(querystring, order_by='relevant', wait=None):
+    """
+    Searches all the video sites which support the ordering at the same time,
+    each in its own thread and with its own deadline.  Returns the results
+    which have come back after `wait` seconds (by default, once every site
+    has answered or run out of time), as a dictionary mapping suite ids to
+    results for vidscraper.metasearch.intersperse_results(), and the list of
+    the suite ids which are still being searched.
+
+    The searches keep going after we return, and their results are cached,
+    so calling this again for the same query picks them up.
+    """
     terms = set(querystring.split())
     exclude_terms = set([
         component for component in terms if component.startswith('-')])
     include_terms = terms.difference(exclude_terms)
     stripped_exclude_terms = [term.lstrip('-') for term in exclude_terms]
-    return vidscraper.metasearch.auto_search(
-        include_terms, stripped_exclude_terms, order_by)
+
+    suites = [suite for suite in vidscraper.metasearch.AUTOSEARCH_SUITES
+              if order_by in suite['order_bys']]
+    cache_keys = dict((suite['id'], _metasearch_cache_key(
+                suite, include_terms, stripped_exclude_terms, order_by))
+                      for suite in suites)
+    collected = {}
+    threads = {}
+    start = time.time()
+    deadline = start
+    for suite in suites:
+        timeout = METASEARCH_TIMEOUTS.get(suite['id'], METASEARCH_TIMEOUT)
+        cache_key = cache_keys[suite['id']]
+        if cache.get(cache_key) is None and \
+                cache.add(cache_key + ':running', True, int(timeout) + 1):
+            thread = threading.Thread(
+                target=_search_suite,
+                args=(suite, include_terms, stripped_exclude_terms,
+                      order_by, timeout, collected))
+            thread.setDaemon(True)
+            thread.start()
+            threads[suite['id']] = (thread, start + timeout)
+        deadline = max(deadline, start + timeout)
+    if wait is not None:
+        deadline = min(deadline, start + wait)
+
+    while True:
+        now = time.time()
+        suite_results = {}
+        pending = []
+        for suite in suites:
+            suite_id = suite['id']
+            results = collected.get(suite_id)
+            if results is None:
+                results = cache.get(cache_keys[suite_id])
+            if results is not None:
+                suite_results[suite_id] = results
+            elif suite_id in threads:
+                thread, suite_deadline = threads[suite_id]
+                if thread.isAlive() and now < suite_deadline:
+                    pending.append(suite_id)
+            elif cache.get(cache_keys[suite_id] + ':running'):
+                # started by another request
+                pending.append(suite_id)
+            # otherwise, it failed or ran out of time
+        if not pending or now >= deadline:
+            return suite_results, pending
+        time.sleep(0.1)
+
+def metasearch_from_querystring(querystring, order_by='relevant'):
+    """
+    Searches the video sites, and returns the results from all the ones which
+    answered in time.
+    """
+    return metasearch(querystring, order_by)[0]
 
 
 def strip_existing_metasearchvideos(metasearchvideos, site):
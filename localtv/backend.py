@@ -34,9 +34,6 @@ class SiteAdminBackend(ModelBackend):
         if user_obj.is_superuser:
             return True
 
-        from django.contrib.sites.models import Site
-        site = Site.objects.get_current()
-        sitelocation = SiteLocation.objects.get(site=site)
-        return sitelocation.user_is_admin(user_obj)
+        return SiteLocation.objects.get_current().user_is_admin(user_obj)
 
     has_module_perms = has_perm
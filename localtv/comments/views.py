@@ -2,11 +2,13 @@ from django import template
 from django.contrib.auth.decorators import permission_required
 from django.contrib.comments import get_model as get_comment_model
 from django.contrib.comments.views import comments
-from django.core.paginator import Paginator, InvalidPage
+from django.core.paginator import InvalidPage
 from django.http import Http404
 from django.shortcuts import render_to_response
 from django.views.decorators.csrf import csrf_protect
 
+from localtv.pagination import CachedCountPaginator
+
 def post_comment(request, next=None):
     POST = request.POST.copy()
     POST['user'] = request.user
@@ -47,7 +49,7 @@ def moderation_queue(request):
     Copied from Django 1.1, since it was removed in Django 1.2.
     """
     qs = get_comment_model().objects.filter(is_public=False, is_removed=False)
-    paginator = Paginator(qs, 100)
+    paginator = CachedCountPaginator(qs, 100)
 
     try:
         page = int(request.GET.get("page", 1))
@@ -71,5 +73,6 @@ def moderation_queue(request):
         'previous': page - 1,
         'pages': paginator.num_pages,
         'hits' : paginator.count,
+        'approximate': paginator.approximate,
         'page_range' : paginator.page_range
     }, context_instance=template.RequestContext(request))
@@ -15,10 +15,18 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Miro Community.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import time
+import urllib
+
+from django.conf import settings
 from django.contrib.auth.views import redirect_to_login
-from django.http import HttpResponseRedirect
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseRedirect, \
+    HttpResponseNotModified
+from django.utils.http import http_date
 
-from localtv import models
+from localtv import models, util
 
 def _make_safe(decorator, original):
     """
@@ -59,3 +67,54 @@ def referrer_redirect(view_func):
             return response
 
     return _make_safe(new_view_func, view_func)
+
+def cache_anonymous_page(timeout):
+    """
+    Caches the response of a public view for anonymous GET requests, for
+    `timeout` seconds or until the site's content changes.  The cache is keyed
+    on the path and the (sorted) query string.
+
+    Responses get ETag and Last-Modified headers, and a request with a
+    matching If-None-Match header gets a 304 without the view being run.
+    Logged-in users, other methods, and pages which use a CSRF token or set a
+    cookie are never cached.  The cache is off unless LOCALTV_PAGE_CACHE is
+    set to True.
+    """
+    def decorate(view_func):
+        def new_view_func(request, *args, **kwargs):
+            if not getattr(settings, 'LOCALTV_PAGE_CACHE', False) or \
+                    request.method not in ('GET', 'HEAD') or \
+                    request.sitelocation is None or \
+                    request.user.is_authenticated():
+                return view_func(request, *args, **kwargs)
+
+            query = urllib.urlencode(sorted(
+                    (key, value.encode('utf8'))
+                    for key, values in request.GET.lists()
+                    for value in values))
+            cache_key = util.site_cache_key(request.sitelocation.site_id,
+                                            'page', request.is_ajax(),
+                                            request.path, query)
+            cached = cache.get(cache_key)
+            if cached is None:
+                response = view_func(request, *args, **kwargs)
+                if response.status_code != 200 or response.cookies or \
+                        request.META.get('CSRF_COOKIE_USED'):
+                    return response
+                cached = (response.content, response['Content-Type'],
+                          '"%s"' % hashlib.md5(response.content).hexdigest(),
+                          http_date(time.time()))
+                cache.set(cache_key, cached, timeout)
+            content, content_type, etag, last_modified = cached
+
+            if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+                response = HttpResponseNotModified()
+            else:
+                response = HttpResponse(content, content_type=content_type)
+            response['ETag'] = etag
+            response['Last-Modified'] = last_modified
+            return response
+
+        return _make_safe(new_view_func, view_func)
+
+    return decorate
@@ -27,4 +27,5 @@ urlpatterns = patterns(
     (r'^(json/)?tag/(.+)$', 'tag', {}, 'localtv_feeds_tag'),
     (r'^(json/)?search/(.+)$', 'search', {}, 'localtv_feeds_search'),
     (r'^(json/)?playlist/(\d+)$', 'playlist', {}, 'localtv_feeds_playlist'),
+    (r'^json/changes/$', 'changes', {}, 'localtv_feeds_changes'),
     )
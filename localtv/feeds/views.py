@@ -16,26 +16,33 @@
 # along with Miro Community.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import hashlib
+import time
 import urllib
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.syndication.feeds import Feed, FeedDoesNotExist, add_domain
 from django.core import cache
 from django.core.files.storage import default_storage
 from django.core.urlresolvers import reverse
-from django.db.models import Q
-from django.http import HttpResponse, Http404
+from django.http import (HttpResponse, HttpResponseBadRequest,
+                         HttpResponseNotModified, Http404)
+from django.template import loader, RequestContext
 from django.utils import feedgenerator
 from django.utils.cache import patch_vary_headers
 from django.utils.encoding import iri_to_uri
+from django.utils.http import http_date
 from django.utils.translation import ugettext as _
 from django.utils.tzinfo import FixedOffset
 
 from tagging.models import Tag
 import simplejson
 
-from localtv import models
+from localtv import models, util
+from localtv.pagination import KeysetPaginator, InvalidCursor
 from localtv.playlists.models import Playlist
+from localtv.search import load_videos
 from localtv.search.forms import VideoSearchForm
 from localtv.templatetags.filters import simpletimesince
 
@@ -43,6 +50,19 @@ FLASH_ENCLOSURE_STATIC_LENGTH = 1
 
 LOCALTV_FEED_LENGTH = 30
 
+# how long (in seconds) rendered feed entries are kept; authors and tags can
+# be renamed without invalidating them
+FEED_ENTRY_CACHE_TIMEOUT = getattr(settings,
+                                   'LOCALTV_FEED_ENTRY_CACHE_TIMEOUT',
+                                   60 * 60)
+
+# the only query parameters which change what a feed contains; everything
+# else (tracking parameters, the JSONP callback) shares a cache entry
+FEED_CACHE_PARAMETERS = ('sort',)
+
+CHANGES_LENGTH = 100
+CHANGES_MAX_LENGTH = 500
+
 def feed_view(klass):
     def wrapper(request, *args):
         sitelocation = models.SiteLocation.objects.get_current()
@@ -53,11 +73,13 @@ def feed_view(klass):
         else:
             json = False
         args = args[1:]
-        cache_key = ('feed_cache:%s:%s:%i:%s:%s' % (
-            sitelocation.site.domain, klass.__name__, json, args,
-            repr(request.GET.items()))).replace(' ', '')
-        mime_type_and_output = cache.cache.get(cache_key)
-        if mime_type_and_output is None:
+        parameters = [(key, request.GET[key])
+                      for key in FEED_CACHE_PARAMETERS if key in request.GET]
+        cache_key = util.site_cache_key(
+            sitelocation.site_id, 'feed_cache', klass.__name__, int(json),
+            args, parameters)
+        cached = cache.cache.get(cache_key)
+        if cached is None:
             try:
                 feed = klass(None, request, json=json).get_feed(*args)
             except FeedDoesNotExist:
@@ -65,21 +87,31 @@ def feed_view(klass):
             else:
                 mime_type = feed.mime_type
                 output = feed.writeString('utf-8')
-                cache.cache.set(cache_key, (mime_type, output))
+                cached = (mime_type, output,
+                          hashlib.md5(output).hexdigest(),
+                          http_date(time.time()))
+                cache.cache.set(cache_key, cached)
+        mime_type, output, etag, last_modified = cached
+
+        callback = json and request.GET.get('jsoncallback')
+        if callback:
+            etag = '%s-%s' % (etag,
+                              hashlib.md5(callback.encode('utf8')).hexdigest())
+        etag = '"%s"' % etag
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = HttpResponseNotModified()
         else:
-            mime_type, output = mime_type_and_output
-
-        if json and request.GET.get('jsoncallback'):
-            output = '%s(%s);' % (
-                request.GET['jsoncallback'],
-                output)
-            mime_type = 'text/javascript'
-        if mime_type.startswith('application/') and \
-                'MSIE' in request.META.get('HTTP_USER_AGENT', ''):
-            # MSIE doesn't support application/atom+xml, so we fake it
-            mime_type = 'text/html'
-        response = HttpResponse(output,
-                            mimetype=mime_type)
+            if callback:
+                output = '%s(%s);' % (callback, output)
+                mime_type = 'text/javascript'
+            if mime_type.startswith('application/') and \
+                    'MSIE' in request.META.get('HTTP_USER_AGENT', ''):
+                # MSIE doesn't support application/atom+xml, so we fake it
+                mime_type = 'text/html'
+            response = HttpResponse(output,
+                                    mimetype=mime_type)
+        response['ETag'] = etag
+        response['Last-Modified'] = last_modified
         patch_vary_headers(response, ['User-Agent'])
         return response
     return wrapper
@@ -158,81 +190,141 @@ class JSONGenerator(feedgenerator.SyndicationFeed):
 
 
 class BaseVideosFeed(Feed):
-    title_template = "localtv/feed/title.html"
-    description_template = "localtv/feed/description.html"
     feed_type = ThumbnailFeedGenerator
+    entry_title_template = "localtv/feed/title.html"
+    entry_description_template = "localtv/feed/description.html"
 
     def __init__(self, *args, **kwargs):
         if 'json' in kwargs:
             if kwargs.pop('json'):
                 self.feed_type = JSONGenerator
         Feed.__init__(self, *args, **kwargs)
+        # entries are rendered by entry() instead
+        self.title_template = self.description_template = None
         self.sitelocation = models.SiteLocation.objects.get_current()
-
-    def item_pubdate(self, video):
-        if video.status != models.VIDEO_STATUS_ACTIVE:
-            return None
-        return video.when().replace(tzinfo=FixedOffset(0))
-
-    def item_guid(self, video):
-        if video.guid:
-            return video.guid
-        return add_domain(video.site.domain, video.get_absolute_url())
-
-    def item_link(self, video):
-        return video.get_absolute_url()
-
-    def item_extra_kwargs(self, item):
-        kwargs = {
-            'when': '%s %s ago' % (
-                item.when_prefix(),
-                simpletimesince(item.when()))
+        self._entries = {}
+
+    def entry(self, video):
+        """
+        Returns a dictionary of the parts of the video's feed entry which only
+        change when the video does: the rendered title and description, the
+        link, the enclosure and the thumbnails.  They're cached (keyed on
+        when_modified and the version of the video's authors, categories and
+        tags) and shared between all the feeds, Atom and JSON alike.  The
+        relative time is added when the feed is put together.
+        """
+        if video.pk in self._entries:
+            return self._entries[video.pk]
+        cache_key = 'localtv.feed_entry:%i:%s:%i:%s:%s' % (
+            video.pk, video.when_modified.isoformat(),
+            self.sitelocation.use_original_date,
+            util.get_cache_version('video_relations:%s' % video.pk),
+            util.get_cache_version('video_relations:site:%s' %
+                                   video.site_id))
+        entry = cache.cache.get(cache_key)
+        if entry is None:
+            entry = self._render_entry(video)
+            cache.cache.set(cache_key, entry, FEED_ENTRY_CACHE_TIMEOUT)
+        self._entries[video.pk] = entry
+        return entry
+
+    def _render_entry(self, video):
+        context = {'obj': video, 'site': self.sitelocation.site}
+        entry = {
+            'title': loader.render_to_string(
+                self.entry_title_template, context,
+                context_instance=RequestContext(self.request)),
+            'description': loader.render_to_string(
+                self.entry_description_template, context,
+                context_instance=RequestContext(self.request)),
+            'link': video.get_absolute_url(),
+            'guid': video.guid or add_domain(video.site.domain,
+                                             video.get_absolute_url()),
+            'pubdate': None,
+            'extra': {}
             }
-        if item.website_url:
-            kwargs['website_url'] = iri_to_uri(item.website_url)
-        if item.has_thumbnail:
-            if item.thumbnail_url:
-                kwargs['thumbnail'] = iri_to_uri(item.thumbnail_url)
+        if video.status == models.VIDEO_STATUS_ACTIVE:
+            entry['pubdate'] = video.when()
+
+        if video.file_url:
+            entry['enclosure_url'] = video.file_url
+        elif video.flash_enclosure_url:
+            entry['enclosure_url'] = video.flash_enclosure_url
+        else:
+            entry['enclosure_url'] = None
+        if video.file_url_length:
+            entry['enclosure_length'] = video.file_url_length
+        else:
+            entry['enclosure_length'] = FLASH_ENCLOSURE_STATIC_LENGTH
+        if video.file_url_mimetype:
+            entry['enclosure_mime_type'] = video.file_url_mimetype
+        elif video.flash_enclosure_url:
+            entry['enclosure_mime_type'] = 'application/x-shockwave-flash'
+        else:
+            entry['enclosure_mime_type'] = ""
+
+        extra = entry['extra']
+        if video.website_url:
+            extra['website_url'] = iri_to_uri(video.website_url)
+        if video.has_thumbnail:
+            if video.thumbnail_url:
+                extra['thumbnail'] = iri_to_uri(video.thumbnail_url)
             else:
                 default_url = default_storage.url(
-                    item.get_resized_thumb_storage_path(375, 295))
+                    video.get_resized_thumb_storage_path(375, 295))
                 if not (default_url.startswith('http://') or
                         default_url.startswith('https://')):
                     default_url = 'http://%s%s' % (
                     self.sitelocation.site.domain, default_url)
-                kwargs['thumbnail'] = default_url
-            kwargs['thumbnails_resized'] = resized = {}
+                extra['thumbnail'] = default_url
+            extra['thumbnails_resized'] = resized = {}
             for size in models.THUMB_SIZES:
                 url = default_storage.url(
-                    item.get_resized_thumb_storage_path(*size))
+                    video.get_resized_thumb_storage_path(*size))
                 if not (url.startswith('http://') or
                         url.startswith('http://')):
                     url = 'http://%s%s' % (
                         self.sitelocation.site.domain, url)
                 resized[size] = url
-        if item.embed_code:
-            kwargs['embed_code'] = item.embed_code
+        if video.embed_code:
+            extra['embed_code'] = video.embed_code
+        return entry
+
+    def item_title(self, video):
+        return self.entry(video)['title']
+
+    def item_description(self, video):
+        return self.entry(video)['description']
+
+    def item_pubdate(self, video):
+        pubdate = self.entry(video)['pubdate']
+        if pubdate is None:
+            return None
+        return pubdate.replace(tzinfo=FixedOffset(0))
+
+    def item_guid(self, video):
+        return self.entry(video)['guid']
+
+    def item_link(self, video):
+        return self.entry(video)['link']
+
+    def item_extra_kwargs(self, item):
+        kwargs = {
+            'when': '%s %s ago' % (
+                item.when_prefix(),
+                simpletimesince(item.when()))
+            }
+        kwargs.update(self.entry(item)['extra'])
         return kwargs
 
     def item_enclosure_url(self, video):
-        if video.file_url:
-            return video.file_url
-        elif video.flash_enclosure_url:
-            return video.flash_enclosure_url
+        return self.entry(video)['enclosure_url']
 
     def item_enclosure_length(self, video):
-        if video.file_url_length:
-            return video.file_url_length
-        else:
-            return FLASH_ENCLOSURE_STATIC_LENGTH
+        return self.entry(video)['enclosure_length']
 
     def item_enclosure_mime_type(self, video):
-        if video.file_url_mimetype:
-            return video.file_url_mimetype
-        elif video.flash_enclosure_url:
-            return 'application/x-shockwave-flash'
-        else:
-            return ""
+        return self.entry(video)['enclosure_mime_type']
 
 
 class NewVideosFeed(BaseVideosFeed):
@@ -247,7 +339,7 @@ class NewVideosFeed(BaseVideosFeed):
         videos = models.Video.objects.new(
             site=self.sitelocation.site,
             status=models.VIDEO_STATUS_ACTIVE)
-        return videos[:LOCALTV_FEED_LENGTH]
+        return models.prefetch_videos(videos[:LOCALTV_FEED_LENGTH])
 
 
 class FeaturedVideosFeed(BaseVideosFeed):
@@ -265,7 +357,7 @@ class FeaturedVideosFeed(BaseVideosFeed):
             status=models.VIDEO_STATUS_ACTIVE)
         videos = videos.order_by(
             '-last_featured', '-when_approved','-when_submitted')
-        return videos[:LOCALTV_FEED_LENGTH]
+        return models.prefetch_videos(videos[:LOCALTV_FEED_LENGTH])
 
 
 class PopularVideosFeed(BaseVideosFeed):
@@ -276,7 +368,7 @@ class PopularVideosFeed(BaseVideosFeed):
         videos = models.Video.objects.popular_since(
             datetime.timedelta(days=7), self.sitelocation,
             status=models.VIDEO_STATUS_ACTIVE)
-        return videos[:LOCALTV_FEED_LENGTH]
+        return models.prefetch_videos(videos[:LOCALTV_FEED_LENGTH])
 
     def title(self):
         return "%s: %s" % (
@@ -292,7 +384,8 @@ class CategoryVideosFeed(BaseVideosFeed):
         return category.get_absolute_url()
 
     def items(self, category):
-        return category.approved_set.all()[:LOCALTV_FEED_LENGTH]
+        return models.prefetch_videos(
+            category.approved_set.all()[:LOCALTV_FEED_LENGTH])
 
     def title(self, category):
         return "%s: %s" % (
@@ -306,11 +399,9 @@ class AuthorVideosFeed(BaseVideosFeed):
         return reverse('localtv_author', args=[author.pk])
 
     def items(self, author):
-        videos = models.Video.objects.filter(
-            Q(authors=author) | Q(user=author),
-            site=self.sitelocation.site,
-            status=models.VIDEO_STATUS_ACTIVE).distinct()
-        return videos[:LOCALTV_FEED_LENGTH]
+        videos = models.Video.objects.by_author(author,
+                                                self.sitelocation.site)
+        return models.prefetch_videos(videos[:LOCALTV_FEED_LENGTH])
 
     def title(self, author):
         return "%s: %s" % (
@@ -325,10 +416,9 @@ class TagVideosFeed(BaseVideosFeed):
         return reverse('localtv_list_tag', args=[tag.name])
 
     def items(self, tag):
-        videos = models.Video.tagged.with_all(tag).filter(
-            site=self.sitelocation.site,
-            status=models.VIDEO_STATUS_ACTIVE)
-        return videos[:LOCALTV_FEED_LENGTH]
+        videos = models.Video.objects.with_tag(
+            tag, self.sitelocation.site).order_by('-tag_index__best_date')
+        return models.prefetch_videos(videos[:LOCALTV_FEED_LENGTH])
 
     def title(self, tag):
         return "%s: %s" % (
@@ -348,13 +438,14 @@ class SearchVideosFeed(BaseVideosFeed):
             raise FeedDoesNotExist(search)
         results = form.search()
         if self.request.GET.get('sort', None) == 'latest':
-            return models.Video.objects.new(
+            return models.prefetch_videos(models.Video.objects.new(
                 site=self.sitelocation.site,
                 status=models.VIDEO_STATUS_ACTIVE,
                 pk__in=[result.pk for result in results[:LOCALTV_FEED_LENGTH]
-                        if result])
-        return [result.object for result in results[:LOCALTV_FEED_LENGTH]
-                if result.object]
+                        if result]))
+        return load_videos(results[:LOCALTV_FEED_LENGTH],
+                           site=self.sitelocation.site,
+                           status=models.VIDEO_STATUS_ACTIVE)
 
     def title(self, search):
         return u"%s: %s" % (
@@ -371,7 +462,7 @@ class PlaylistVideosFeed(BaseVideosFeed):
         videos = playlist.video_set.all()
         if self.request.GET.get('sort', None) != 'order':
             videos = videos.order_by('-playlistitem___order')
-        return videos[:LOCALTV_FEED_LENGTH]
+        return models.prefetch_videos(videos[:LOCALTV_FEED_LENGTH])
 
     def title(self, playlist):
         return "%s: %s" % (
@@ -385,3 +476,119 @@ author = feed_view(AuthorVideosFeed)
 tag = feed_view(TagVideosFeed)
 search = feed_view(SearchVideosFeed)
 playlist = feed_view(PlaylistVideosFeed)
+
+
+def _isoformat(value):
+    if value is not None:
+        return value.isoformat()
+
+CHANGES_FIELDS = {
+    'id': lambda video: video.pk,
+    'name': lambda video: video.name,
+    'description': lambda video: video.description,
+    'url': lambda video: add_domain(video.site.domain,
+                                    video.get_absolute_url()),
+    'guid': lambda video: video.guid,
+    'website_url': lambda video: video.website_url,
+    'file_url': lambda video: video.file_url,
+    'file_url_mimetype': lambda video: video.file_url_mimetype,
+    'embed_code': lambda video: video.embed_code,
+    'thumbnail_url': lambda video: video.thumbnail_url,
+    'when_submitted': lambda video: _isoformat(video.when_submitted),
+    'when_published': lambda video: _isoformat(video.when_published),
+    'when_modified': lambda video: _isoformat(video.when_modified),
+    'categories': lambda video: [category.slug for category in
+                                 video.categories.all()],
+    'authors': lambda video: [author.username for author in
+                              video.authors.all()],
+    'tags': lambda video: [tag.name for tag in video.tags],
+    }
+
+CHANGES_DEFAULT_FIELDS = ('id', 'name', 'url', 'when_modified')
+
+CHANGES_RELATED_FIELDS = ('url', 'categories', 'authors', 'tags')
+
+def changes(request):
+    """
+    Returns the videos which have been added, changed or removed since the
+    `after` cursor, as compact JSON:
+
+        {"fields": ["id", "name", ...],
+         "changed": [[1, "Video Name", ...], ...],
+         "removed": [2, 3, ...],
+         "cursor": "...",
+         "more": false}
+
+    Each changed video is a list of the requested `fields` (a comma-separated
+    list; by default id, name, url and when_modified).  Removed videos are
+    ones which were deleted, or which are no longer approved.  Clients should
+    store the cursor and pass it back as `after`; while `more` is true, there
+    are more changes waiting.  Up to `limit` videos and removals are returned
+    at a time.
+
+    Deletions are only remembered for LOCALTV_TOMBSTONE_RETENTION_DAYS (see
+    the prune_tombstones command).  A client whose cursor is older than that
+    may have missed some, and has to do a full resync, starting again
+    without a cursor.
+    """
+    sitelocation = models.SiteLocation.objects.get_current()
+
+    if 'fields' in request.GET:
+        fields = [field for field in request.GET['fields'].split(',')
+                  if field]
+    else:
+        fields = CHANGES_DEFAULT_FIELDS
+    for field in fields:
+        if field not in CHANGES_FIELDS:
+            return HttpResponseBadRequest('Unknown field: %s' % field)
+
+    try:
+        limit = min(int(request.GET.get('limit', CHANGES_LENGTH)),
+                    CHANGES_MAX_LENGTH)
+    except ValueError:
+        limit = CHANGES_LENGTH
+    limit = max(limit, 1)
+
+    # the cursor has a part for the videos and a part for the tombstones
+    video_cursor, tombstone_cursor = '', ''
+    if request.GET.get('after'):
+        video_cursor, _sep, tombstone_cursor = request.GET[
+            'after'].partition('.')
+
+    video_paginator = KeysetPaginator(
+        models.Video.objects.filter(site=sitelocation.site),
+        limit, ['when_modified', 'pk'])
+    tombstone_paginator = KeysetPaginator(
+        models.VideoTombstone.objects.filter(site=sitelocation.site),
+        limit, ['when_deleted', 'pk'])
+    try:
+        video_page = video_paginator.page(after=video_cursor or None)
+        tombstone_page = tombstone_paginator.page(
+            after=tombstone_cursor or None)
+    except InvalidCursor:
+        return HttpResponseBadRequest('Invalid cursor')
+
+    changed = [video for video in video_page.object_list
+               if video.status == models.VIDEO_STATUS_ACTIVE]
+    if [field for field in fields if field in CHANGES_RELATED_FIELDS]:
+        changed = models.prefetch_videos(changed)
+    removed = [video.pk for video in video_page.object_list
+               if video.status != models.VIDEO_STATUS_ACTIVE]
+    removed.extend(tombstone.video_id
+                   for tombstone in tombstone_page.object_list)
+
+    if video_page.object_list:
+        video_cursor = video_paginator.cursor_for(video_page.object_list[-1])
+    if tombstone_page.object_list:
+        tombstone_cursor = tombstone_paginator.cursor_for(
+            tombstone_page.object_list[-1])
+
+    output = simplejson.dumps({
+            'fields': fields,
+            'changed': [[CHANGES_FIELDS[field](video) for field in fields]
+                        for video in changed],
+            'removed': removed,
+            'cursor': '%s.%s' % (video_cursor, tombstone_cursor),
+            'more': video_page.has_next() or tombstone_page.has_next(),
+            }, separators=(',', ':'))
+    return HttpResponse(output, mimetype='application/json')
@@ -18,14 +18,20 @@
 import datetime
 
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.core.paginator import InvalidPage
+from django.http import Http404, HttpResponse
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
-from django.views.generic.list_detail import object_list
 
+import simplejson
 from tagging.models import Tag
 
 from localtv import models
+from localtv.decorators import cache_anonymous_page
+from localtv.pagination import (KeysetPaginator, InvalidCursor,
+                                CachedCountPaginator)
+from localtv.search import (load_videos, browse_counts, resolve_facets,
+                            suggest)
 from localtv.search.forms import VideoSearchForm
 
 def get_args(func):
@@ -46,22 +52,156 @@ def get_args(func):
         return func(request, *args, **kwargs)
     return wrapper
 
+def _cursor_url(request, name, cursor):
+    GET = request.GET.copy()
+    for key in 'page', 'after', 'before':
+        GET.pop(key, None)
+    GET[name] = cursor
+    return '%s?%s' % (request.path, GET.urlencode())
+
+def video_list(request, queryset, paginate_by, template_name,
+               extra_context=None, keys=None,
+               prepare=models.prefetch_videos):
+    """
+    Like object_list(), but if the request has an 'after' or 'before' cursor,
+    the videos are paginated by the values of their sort keys instead of by
+    page number.  That keeps deep pages as cheap as the first one.  Numbered
+    pages get their total from a CachedCountPaginator, and link to the
+    following and preceding pages with cursors (next_page_url and
+    previous_page_url); page numbers are only used by templates which ask for
+    them.
+
+    `keys` are the sort keys for cursor pagination, and the order of the
+    numbered pages; by default, the ordering of the queryset followed by
+    '-pk'.  If the ordering can't be used for
+    cursors (it's not on the database, or it has NULLs), pass keys=False and
+    only page numbers will be supported.
+
+    `prepare` turns the objects on a numbered page into the list of videos to
+    show; it's how pages of search results are loaded.
+    """
+    if keys is None:
+        keys = list(queryset.query.order_by or
+                    queryset.model._meta.ordering) + ['-pk']
+    if keys and ('after' in request.GET or 'before' in request.GET):
+        context = _cursor_page_context(request, queryset, paginate_by, keys)
+    else:
+        if keys:
+            # the same order as the cursor pages, so that videos with equal
+            # dates don't move between pages
+            queryset = queryset.order_by(*keys)
+        context = _numbered_page_context(request, queryset, paginate_by,
+                                         prepare=prepare)
+        if keys:
+            # link onwards with cursors, so that following the links never
+            # walks deep OFFSET pages
+            _add_cursor_links(request, context,
+                              KeysetPaginator(queryset, paginate_by, keys))
+    if extra_context:
+        for key, value in extra_context.items():
+            if callable(value):
+                context[key] = value()
+            else:
+                context[key] = value
+    return render_to_response(template_name, context,
+                              context_instance=RequestContext(request))
+
+def _numbered_page_context(request, queryset, paginate_by,
+                           template_object_name='video',
+                           prepare=models.prefetch_videos):
+    """
+    The same context object_list() would build, but the total is counted with
+    a CachedCountPaginator.  `prepare` is called with the objects on the page
+    (by default, to prefetch the videos' relations) and returns the list to
+    use.
+    """
+    paginator = CachedCountPaginator(queryset, paginate_by)
+    page = request.GET.get('page', 1)
+    try:
+        page_number = int(page)
+    except ValueError:
+        if page == 'last':
+            page_number = paginator.num_pages
+        else:
+            raise Http404
+    try:
+        page_obj = paginator.page(page_number)
+    except InvalidPage:
+        raise Http404
+    page_obj.object_list = prepare(page_obj.object_list)
+    return {
+        '%s_list' % template_object_name: page_obj.object_list,
+        'paginator': paginator,
+        'page_obj': page_obj,
+        'is_paginated': page_obj.has_other_pages(),
+        'results_per_page': paginator.per_page,
+        'has_next': page_obj.has_next(),
+        'has_previous': page_obj.has_previous(),
+        'page': page_obj.number,
+        'next': page_obj.next_page_number(),
+        'previous': page_obj.previous_page_number(),
+        'first_on_page': page_obj.start_index(),
+        'last_on_page': page_obj.end_index(),
+        'pages': paginator.num_pages,
+        'hits': paginator.count,
+        'page_range': paginator.page_range,
+        }
+
+def _add_cursor_links(request, context, paginator):
+    """
+    Adds the URLs of the cursor pages before and after the numbered page in
+    the context.
+    """
+    page = context['page_obj']
+    if page.has_next() and page.object_list:
+        context['next_page_url'] = _cursor_url(
+            request, 'after', paginator.cursor_for(page.object_list[-1]))
+    if page.has_previous() and page.object_list:
+        context['previous_page_url'] = _cursor_url(
+            request, 'before', paginator.cursor_for(page.object_list[0]))
+
+def _cursor_page_context(request, queryset, paginate_by, keys):
+    paginator = KeysetPaginator(queryset, paginate_by, keys)
+    try:
+        page = paginator.page(after=request.GET.get('after'),
+                              before=request.GET.get('before'))
+    except InvalidCursor:
+        raise Http404
+    page.object_list = models.prefetch_videos(page.object_list)
+    context = {
+        'video_list': page.object_list,
+        'page_obj': page,
+        'is_paginated': page.has_other_pages(),
+        'cursor_pagination': True,
+        'results_per_page': paginate_by,
+        'has_next': page.has_next(),
+        'has_previous': page.has_previous(),
+        }
+    if page.has_next():
+        context['next_page_url'] = _cursor_url(request, 'after',
+                                               page.next_cursor())
+    if page.has_previous():
+        context['previous_page_url'] = _cursor_url(request, 'before',
+                                                   page.previous_cursor())
+    return context
+
+@cache_anonymous_page(60 * 60)
 def index(request):
     return render_to_response(
         'localtv/browse.html', {},
         context_instance=RequestContext(request))
 
+@cache_anonymous_page(15 * 60)
 @get_args
 def new_videos(request, count=15, sort=None):
     videos = models.Video.objects.new(
         site=request.sitelocation.site,
         status=models.VIDEO_STATUS_ACTIVE)
-    return object_list(
-        request=request, queryset=videos,
-        paginate_by=count,
-        template_name='localtv/video_listing_new.html',
-        allow_empty=True, template_object_name='video')
+    return video_list(request, videos, count,
+                      'localtv/video_listing_new.html')
 
+# watches don't change the content generation, so expire sooner
+@cache_anonymous_page(5 * 60)
 @get_args
 def popular_videos(request, count=15, sort=None):
     period = datetime.timedelta(days=7)
@@ -70,12 +210,11 @@ def popular_videos(request, count=15, sort=None):
         watch__timestamp__gte=datetime.datetime.now() - period,
         status=models.VIDEO_STATUS_ACTIVE,
         )
-    return object_list(
-        request=request, queryset=videos,
-        paginate_by=count,
-        template_name='localtv/video_listing_popular.html',
-        allow_empty=True, template_object_name='video')
+    return video_list(request, videos, count,
+                      'localtv/video_listing_popular.html',
+                      keys=False)
 
+@cache_anonymous_page(15 * 60)
 @get_args
 def featured_videos(request, count=15, sort=None):
     kwargs = {
@@ -84,32 +223,30 @@ def featured_videos(request, count=15, sort=None):
         'status': models.VIDEO_STATUS_ACTIVE}
     if sort == 'latest':
         videos = models.Video.objects.new(**kwargs)
+        keys = None
     else:
         videos = models.Video.objects.filter(**kwargs)
         videos = videos.order_by(
             '-last_featured', '-when_approved', '-when_published',
             '-when_submitted')
-    return object_list(
-        request=request, queryset=videos,
-        paginate_by=count,
-        template_name='localtv/video_listing_featured.html',
-        allow_empty=True, template_object_name='video')
+        # the other dates can be NULL
+        keys = ['-last_featured', '-pk']
+    return video_list(request, videos, count,
+                      'localtv/video_listing_featured.html',
+                      keys=keys)
 
+@cache_anonymous_page(15 * 60)
 @get_args
 def tag_videos(request, tag_name, count=15, sort=None):
     tag = get_object_or_404(Tag, name=tag_name)
-    videos = models.Video.tagged.with_all(tag).filter(
-        site=request.sitelocation.site,
-        status=models.VIDEO_STATUS_ACTIVE)
-    videos = videos.order_by(
-        '-when_approved', '-when_published', '-when_submitted')
-    return object_list(
-        request=request, queryset=videos,
-        paginate_by=count,
-        template_name='localtv/video_listing_tag.html',
-        allow_empty=True, template_object_name='video',
-        extra_context={'tag': tag})
+    videos = models.Video.objects.with_tag(tag, request.sitelocation.site)
+    videos = videos.order_by('-tag_index__best_date', '-pk')
+    return video_list(request, videos, count,
+                      'localtv/video_listing_tag.html',
+                      extra_context={'tag': tag},
+                      keys=['-tag_index__best_date', '-pk'])
 
+@cache_anonymous_page(15 * 60)
 @get_args
 def feed_videos(request, feed_id, count=15, sort=None):
     feed = get_object_or_404(models.Feed, pk=feed_id,
@@ -117,18 +254,15 @@ def feed_videos(request, feed_id, count=15, sort=None):
     videos = models.Video.objects.new(site=request.sitelocation.site,
                                       feed=feed,
                                       status=models.VIDEO_STATUS_ACTIVE)
-    return object_list(
-        request=request, queryset=videos,
-        paginate_by=count,
-        template_name='localtv/video_listing_feed.html',
-        allow_empty=True, template_object_name='video',
-        extra_context={'feed': feed})
+    return video_list(request, videos, count,
+                      'localtv/video_listing_feed.html',
+                      extra_context={'feed': feed})
 
 
 @get_args
 def video_search(request, count=10, sort=None):
     query = ''
-    pks = []
+    results = None
 
     if 'query' in request.GET and 'q' not in request.GET:
         # old-style templates
@@ -142,29 +276,47 @@ def video_search(request, count=10, sort=None):
         if form.is_valid():
             query = form.cleaned_data['q']
             results = form.search()
-            pks = [result.pk for result in results if result is not None]
 
-    if not pks:
-        queryset = models.Video.objects.none()
-    elif sort == 'latest':
+    if results is None:
+        return video_list(request, models.Video.objects.none(), count,
+                          'localtv/video_listing_search.html',
+                          extra_context={'query': query},
+                          keys=False)
+
+    extra_context = {'query': query,
+                     'facets': lambda: resolve_facets(results.facets, query)}
+    if sort == 'latest':
+        pks = [result.pk for result in results if result is not None]
         queryset = models.Video.objects.new(
             site=request.sitelocation.site,
             status=models.VIDEO_STATUS_ACTIVE,
             pk__in=pks)
+        return video_list(request, queryset, count,
+                          'localtv/video_listing_search.html',
+                          extra_context=extra_context)
     else:
-        queryset = models.Video.objects.filter(
-                site=request.sitelocation.site,
-                status=models.VIDEO_STATUS_ACTIVE,
-                pk__in=pks).order_by()
-        order = ['-localtv_video.id = %i' % int(pk) for pk in pks]
-        queryset = queryset.extra(order_by=order)
-    return object_list(
-        request=request, queryset=queryset,
-        paginate_by=count,
-        template_name='localtv/video_listing_search.html',
-        allow_empty=True, template_object_name='video',
-        extra_context={'query': query})
+        # paginate the results themselves, and only load the videos on the
+        # page; relevance can't be used as a cursor
+        def prepare(page):
+            return load_videos(page,
+                               site=request.sitelocation.site,
+                               status=models.VIDEO_STATUS_ACTIVE)
+        return video_list(request, results, count,
+                          'localtv/video_listing_search.html',
+                          extra_context=extra_context,
+                          keys=False, prepare=prepare)
 
+def search_suggestions(request, count=10):
+    """
+    Returns JSON suggestions for the search box, for the prefix in the 'q'
+    GET argument.
+    """
+    suggestions = suggest(request.GET.get('q', ''),
+                          request.sitelocation.site, count)
+    return HttpResponse(simplejson.dumps(suggestions, separators=(',', ':')),
+                        mimetype='application/json')
+
+@cache_anonymous_page(15 * 60)
 @get_args
 def category(request, slug=None, count=15, sort=None):
     if slug is None:
@@ -172,42 +324,58 @@ def category(request, slug=None, count=15, sort=None):
             site=request.sitelocation.site,
             parent=None)
 
-        return object_list(
-            request=request, queryset=categories,
-            paginate_by=count,
-            template_name='localtv/categories.html',
-            allow_empty=True, template_object_name='category')
+        def count_all():
+            return dict((category.pk, category.approved_set.count())
+                        for category in categories)
+
+        def video_counts(page):
+            # counted by the search backend, if it can count facets
+            page = list(page)
+            counts = browse_counts('category_tree', request.sitelocation.site,
+                                   fallback=count_all)
+            for category in page:
+                category.video_count = counts.get(category.pk, 0)
+            return page
+        context = _numbered_page_context(
+            request, categories, count,
+            template_object_name='category', prepare=video_counts)
+        return render_to_response(
+            'localtv/categories.html',
+            context,
+            context_instance=RequestContext(request))
     else:
         category = get_object_or_404(models.Category, slug=slug,
                                      site=request.sitelocation.site)
-        return object_list(
-            request=request, queryset=category.approved_set.all(),
-            paginate_by=count,
-            template_name='localtv/category.html',
-            allow_empty=True, template_object_name='video',
-            extra_context={'category': category})
+        return video_list(request, category.approved_set.all(), count,
+                          'localtv/category.html',
+                          extra_context={'category': category})
 
+@cache_anonymous_page(15 * 60)
 @get_args
 def author(request, id=None, count=15, sort=None):
     if id is None:
+        def video_counts(authors):
+            return models.VideoAuthorIndex.objects.video_counts(
+                list(authors), request.sitelocation.site)
+        context = _numbered_page_context(
+            request, User.objects.order_by('pk'), count,
+            template_object_name='author', prepare=video_counts)
+        # themes iterate over 'authors'
+        context['authors'] = context['author_list']
         return render_to_response(
             'localtv/author_list.html',
-            {'authors': User.objects.all()},
+            context,
             context_instance=RequestContext(request))
     else:
         author = get_object_or_404(User,
                                    pk=id)
+        videos = models.Video.objects.by_author(author,
+                                                request.sitelocation.site)
         if sort:
-            videos = models.Video.objects.new()
-        else:
-            videos = models.Video.objects.all()
-        videos = videos.filter(
-            Q(authors=author) | Q(user=author),
-            site=request.sitelocation.site,
-            status=models.VIDEO_STATUS_ACTIVE).distinct()
-        return object_list(request=request, queryset=videos,
-                           paginate_by=count,
-                           template_name='localtv/author.html',
-                           allow_empty=True,
-                           template_object_name='video',
-                           extra_context={'author': author})
+            if request.sitelocation.use_original_date:
+                videos = videos.order_by('-best_date')
+            else:
+                videos = videos.order_by('-best_posted_date')
+        return video_list(request, videos, count,
+                          'localtv/author.html',
+                          extra_context={'author': author})
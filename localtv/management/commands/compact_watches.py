@@ -0,0 +1,99 @@
+import datetime
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+from django.db.models import F
+
+from localtv import models
+
+# used when the database can't tell us how big a Watch row is
+DEFAULT_BYTES_PER_ROW = 64
+
+class Command(NoArgsCommand):
+
+    help = ('Folds Watch records older than LOCALTV_WATCH_RETENTION_DAYS '
+            'into daily WatchRollups, and deletes them.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', type='int', dest='days',
+                    help='Compact watches older than this many days '
+                    '(default: LOCALTV_WATCH_RETENTION_DAYS, or 30).'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=1000,
+                    help='Number of watches to compact per transaction.'),
+        make_option('--sleep', type='float', dest='sleep', default=0,
+                    help='Seconds to sleep between chunks, to give other '
+                    'queries a chance at the table.'))
+
+    def handle_noargs(self, days=None, chunk_size=1000, sleep=0,
+                      verbosity=1, **options):
+        verbosity = int(verbosity)
+        if days is None:
+            cutoff = models.Watch.retention_cutoff()
+        else:
+            cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+
+        bytes_per_row = self.bytes_per_row()
+        compacted = 0
+        while True:
+            rows = list(models.Watch.objects.filter(
+                    timestamp__lt=cutoff).order_by('pk').values_list(
+                    'pk', 'video', 'timestamp')[:chunk_size])
+            if not rows:
+                break
+            self.compact(rows)
+            compacted += len(rows)
+            if verbosity > 1:
+                print 'compacted %i watches' % compacted
+            if sleep:
+                time.sleep(sleep)
+
+        if verbosity:
+            print 'Compacted %i watches older than %s; about %i KB reclaimed' % (
+                compacted, cutoff.replace(microsecond=0),
+                compacted * bytes_per_row / 1024)
+
+    @transaction.commit_on_success
+    def compact(self, rows):
+        """
+        Adds the given (pk, video_id, timestamp) Watch rows to the daily
+        rollups and deletes them, in a single transaction.
+        """
+        counts = {}
+        for pk, video_id, timestamp in rows:
+            key = (video_id, timestamp.date())
+            counts[key] = counts.get(key, 0) + 1
+
+        for (video_id, date), count in counts.items():
+            if not models.WatchRollup.objects.filter(
+                video=video_id, date=date).update(count=F('count') + count):
+                models.WatchRollup.objects.create(video_id=video_id,
+                                                  date=date,
+                                                  count=count)
+
+        models.Watch.objects.filter(
+            pk__in=[pk for pk, video_id, timestamp in rows]).delete()
+
+    def bytes_per_row(self):
+        """
+        Returns the average on-disk size of a Watch row (including indexes),
+        if the database can tell us.
+        """
+        engine = connection.settings_dict['ENGINE']
+        table = models.Watch._meta.db_table
+        cursor = connection.cursor()
+        if 'postgresql' in engine:
+            cursor.execute('SELECT pg_total_relation_size(%s), reltuples '
+                           'FROM pg_class WHERE relname = %s', [table, table])
+            size, rows = cursor.fetchone()
+        elif 'mysql' in engine:
+            cursor.execute('SHOW TABLE STATUS LIKE %s', [table])
+            status = cursor.fetchone()
+            size, rows = status[6] + status[8], status[4]
+        else:
+            return DEFAULT_BYTES_PER_ROW
+        if not rows:
+            return DEFAULT_BYTES_PER_ROW
+        return int(size / rows)
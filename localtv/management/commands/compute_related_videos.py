@@ -0,0 +1,126 @@
+import heapq
+import math
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from localtv import models
+
+# how much sharing each kind of feature counts towards two videos being
+# related; rarer features count for more
+FEATURE_WEIGHTS = {
+    'tag': 1.0,
+    'category': 0.5,
+    'author': 1.5,
+    }
+
+class Command(NoArgsCommand):
+
+    help = ('Computes the most related videos for each active video, by the '
+            'tags, categories and authors they share, and stores them for '
+            'the video pages.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--length', type='int', dest='length',
+                    default=models.RELATED_VIDEOS_LENGTH,
+                    help='Number of related videos to keep for each video '
+                    '(default: LOCALTV_RELATED_VIDEOS_LENGTH, or 10).'),
+        make_option('--max-feature-videos', type='int',
+                    dest='max_feature_videos', default=1000,
+                    help='Ignore tags, categories and authors with more '
+                    'videos than this; they say little about how related '
+                    'two videos are, and cost the most to compare.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=500,
+                    help='Number of lists to store per transaction.'))
+
+    def handle_noargs(self, length=models.RELATED_VIDEOS_LENGTH,
+                      max_feature_videos=1000, chunk_size=500, verbosity=1,
+                      **options):
+        verbosity = int(verbosity)
+        start = time.time()
+        site_id = settings.SITE_ID
+        dates = dict(models.Video.objects.filter(
+                site=site_id,
+                status=models.VIDEO_STATUS_ACTIVE).values_list('pk',
+                                                               'best_date'))
+        features = self.features(site_id)
+        postings = {}
+        for video_id, video_features in features.items():
+            for feature in video_features:
+                postings.setdefault(feature, []).append(video_id)
+
+        # each feature is worth its weight, less the more videos share it
+        weights = {}
+        for feature, video_ids in postings.items():
+            if 1 < len(video_ids) <= max_feature_videos:
+                weights[feature] = (FEATURE_WEIGHTS[feature[0]] /
+                                    math.log(len(video_ids) + 1))
+
+        video_ids = sorted(dates)
+        for index in xrange(0, len(video_ids), chunk_size):
+            chunk = video_ids[index:index + chunk_size]
+            self.store([(video_id,
+                         self.related(video_id, features, postings, weights,
+                                      dates, length))
+                        for video_id in chunk])
+            if verbosity > 1:
+                print 'computed %i/%i videos' % (index + len(chunk),
+                                                 len(video_ids))
+
+        if verbosity:
+            print 'Computed related videos for %i videos in %.1f seconds' % (
+                len(video_ids), time.time() - start)
+
+    def features(self, site_id):
+        """
+        Returns a dictionary mapping the pk of each active video on the site
+        to the set of its (kind, pk) features: its tags, categories and
+        authors.
+        """
+        features = {}
+        def add(kind, rows):
+            for video_id, pk in rows:
+                features.setdefault(video_id, set()).add((kind, pk))
+        add('tag', models.VideoTagIndex.objects.filter(
+                site=site_id,
+                status=models.VIDEO_STATUS_ACTIVE).values_list('video',
+                                                               'tag'))
+        add('category', models.Video.categories.through.objects.filter(
+                video__site=site_id,
+                video__status=models.VIDEO_STATUS_ACTIVE).values_list(
+                'video', 'category'))
+        add('author', models.VideoAuthorIndex.objects.filter(
+                site=site_id,
+                status=models.VIDEO_STATUS_ACTIVE).values_list('video',
+                                                               'author'))
+        return features
+
+    def related(self, video_id, features, postings, weights, dates, length):
+        """
+        Returns the pks of the `length` videos which share the most (weighted)
+        features with the given one, newest first among equals.  Only the
+        videos which share at least one feature are scored.
+        """
+        scores = {}
+        for feature in features.get(video_id, ()):
+            weight = weights.get(feature)
+            if weight is None:
+                continue
+            for other_id in postings[feature]:
+                if other_id != video_id:
+                    scores[other_id] = scores.get(other_id, 0) + weight
+        return [other_id for score, date, other_id in heapq.nlargest(
+                length, ((score, dates.get(other_id), other_id)
+                         for other_id, score in scores.iteritems()))]
+
+    @transaction.commit_on_success
+    def store(self, lists):
+        """
+        Stores the (video_id, related_ids) lists in a single transaction.
+        """
+        for video_id, related_ids in lists:
+            models.RelatedVideos.objects.store(video_id, related_ids)
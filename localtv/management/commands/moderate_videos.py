@@ -0,0 +1,54 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import CommandError, NoArgsCommand
+
+from localtv import models
+
+class Command(NoArgsCommand):
+
+    help = ('Approves or rejects all the videos in the review queue, in '
+            'chunks.  Progress is kept in the cache for the admin to show.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--approve', action='store_const', dest='status',
+                    const=models.VIDEO_STATUS_ACTIVE,
+                    help='Approve the videos.'),
+        make_option('--reject', action='store_const', dest='status',
+                    const=models.VIDEO_STATUS_REJECTED,
+                    help='Reject the videos.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=models.MODERATION_CHUNK_SIZE,
+                    help='Number of videos to update per transaction.'))
+
+    def handle_noargs(self, status=None,
+                      chunk_size=models.MODERATION_CHUNK_SIZE, verbosity=1,
+                      **options):
+        if status is None:
+            raise CommandError('pass --approve or --reject')
+        verbosity = int(verbosity)
+        progress_key = models.MODERATION_PROGRESS_KEY % settings.SITE_ID
+
+        video_ids = list(models.Video.objects.filter(
+                site=settings.SITE_ID,
+                status=models.VIDEO_STATUS_UNAPPROVED).values_list(
+                'pk', flat=True))
+
+        def progress(done, total):
+            cache.set(progress_key, (done, total), 60 * 60)
+            if verbosity > 1:
+                print 'moderated %i/%i videos' % (done, total)
+        progress(0, len(video_ids))
+        models.Video.objects.moderate(video_ids, status,
+                                      chunk_size=chunk_size,
+                                      progress=progress)
+        if status == models.VIDEO_STATUS_ACTIVE:
+            for index in xrange(0, len(video_ids), chunk_size):
+                models.send_approval_notifications(
+                    models.Video.objects.filter(
+                        pk__in=video_ids[index:index + chunk_size]
+                        ).select_related('user', 'site'))
+
+        if verbosity:
+            print 'Moderated %i videos' % len(video_ids)
@@ -0,0 +1,50 @@
+import datetime
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from localtv import models
+
+class Command(NoArgsCommand):
+
+    help = ('Deletes the VideoTombstones older than '
+            'LOCALTV_TOMBSTONE_RETENTION_DAYS.  Clients of the changes feed '
+            'with an older cursor have to do a full resync.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', type='int', dest='days',
+                    help='Delete tombstones older than this many days '
+                    '(default: LOCALTV_TOMBSTONE_RETENTION_DAYS, or 90).'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=1000,
+                    help='Number of tombstones to delete at a time.'),
+        make_option('--sleep', type='float', dest='sleep', default=0,
+                    help='Seconds to sleep between chunks, to give other '
+                    'queries a chance at the table.'))
+
+    def handle_noargs(self, days=None, chunk_size=1000, sleep=0,
+                      verbosity=1, **options):
+        verbosity = int(verbosity)
+        if days is None:
+            cutoff = models.VideoTombstone.retention_cutoff()
+        else:
+            cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+
+        pruned = 0
+        while True:
+            pks = list(models.VideoTombstone.objects.filter(
+                    when_deleted__lt=cutoff).order_by('pk').values_list(
+                    'pk', flat=True)[:chunk_size])
+            if not pks:
+                break
+            models.VideoTombstone.objects.filter(pk__in=pks).delete()
+            pruned += len(pks)
+            if verbosity > 1:
+                print 'pruned %i tombstones' % pruned
+            if sleep:
+                time.sleep(sleep)
+
+        if verbosity:
+            print 'Pruned %i tombstones older than %s' % (
+                pruned, cutoff.replace(microsecond=0))
@@ -0,0 +1,180 @@
+import multiprocessing
+import os
+import os.path
+import shutil
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connection
+
+from haystack import site
+
+from localtv import models
+
+def prepare(video):
+    """
+    Prepares the search document for a video; run in the worker processes.
+    """
+    return site.get_index(models.Video).full_prepare(video)
+
+
+class PreparedIndex(object):
+    """
+    Stands in for the VideoIndex in the backend's update() (which calls
+    full_prepare() for each object), handing out the documents which were
+    already prepared by the workers.
+    """
+    def __init__(self, index, videos, documents):
+        self.index = index
+        self.documents = dict((video.pk, document)
+                              for video, document in zip(videos, documents))
+
+    def full_prepare(self, video):
+        return self.documents[video.pk]
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+
+def new_index_backend(path, site):
+    """
+    Returns a Whoosh search backend which creates a new index at the given
+    path, rather than opening the one at HAYSTACK_WHOOSH_PATH.
+    """
+    from haystack.backends.whoosh_backend import SearchBackend
+    from whoosh.filedb.filestore import FileStorage
+    from whoosh.qparser import QueryParser
+
+    class Backend(SearchBackend):
+        def setup(self):
+            os.makedirs(path)
+            self.storage = FileStorage(path)
+            self.content_field_name, self.schema = self.build_schema(
+                self.site.all_searchfields())
+            self.parser = QueryParser(self.content_field_name,
+                                      schema=self.schema)
+            self.index = self.storage.create_index(self.schema)
+            self.setup_complete = True
+    return Backend(site=site)
+
+
+class Command(NoArgsCommand):
+
+    help = ('Rebuilds the search index for the videos, in chunks, preparing '
+            'the documents in a pool of worker processes.  With the Whoosh '
+            'backend, the index is built in a new directory and swapped in '
+            'when it is complete.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=500,
+                    help='Number of videos to load and index at a time.'),
+        make_option('--workers', type='int', dest='workers',
+                    help='Number of processes preparing documents '
+                    '(default: the number of CPUs).'))
+
+    def handle_noargs(self, chunk_size=500, workers=None, verbosity=1,
+                      **options):
+        verbosity = int(verbosity)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        index = site.get_index(models.Video)
+        queryset = index.get_queryset().order_by('pk')
+        total = queryset.count()
+        # built once, rather than for every chunk
+        category_trees = index.category_trees(
+            set(models.Category.objects.values_list('site', flat=True)))
+        backend, swap = self.fresh_backend(index)
+        swapping = backend is not index.backend
+        if swapping:
+            # changes made while we're building the new index would be
+            # written to the old one, and lost in the swap; leave them queued
+            # for update_search_queue to apply to the new one
+            models.SearchIndexQueue.pause()
+
+        pool = None
+        if workers > 1:
+            # the workers have to open their own database connections
+            connection.close()
+            pool = multiprocessing.Pool(workers)
+
+        start = time.time()
+        done = 0
+        last_pk = 0
+        try:
+            while True:
+                videos = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+                if not videos:
+                    break
+                last_pk = videos[-1].pk
+                if swapping:
+                    models.SearchIndexQueue.pause()
+                videos = index.preload(videos, category_trees)
+                if pool is not None:
+                    documents = pool.map(prepare, videos)
+                else:
+                    documents = map(prepare, videos)
+                backend.update(PreparedIndex(index, videos, documents),
+                               videos)
+
+                done += len(videos)
+                if verbosity > 1:
+                    rate = done / max(time.time() - start, 0.001)
+                    print ('%i/%i videos (%.1f docs/sec, about %i seconds '
+                           'left)' % (done, total, rate,
+                                      max(total - done, 0) / rate))
+            swap(done)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if swapping:
+                models.SearchIndexQueue.resume()
+
+        if verbosity:
+            seconds = time.time() - start
+            print 'Indexed %i videos in %.1f seconds (%.1f docs/sec)' % (
+                done, seconds, done / max(seconds, 0.001))
+
+    def fresh_backend(self, index):
+        """
+        Returns a search backend writing to an empty index, and a function
+        which swaps that index in for the current one once it holds the given
+        number of documents.  Only the file-based Whoosh index can be
+        swapped; other backends are updated in place.
+        """
+        if getattr(settings, 'HAYSTACK_SEARCH_ENGINE', None) != 'whoosh' or \
+                not getattr(index.backend, 'use_file_storage', False):
+            return index.backend, lambda count: None
+
+        path = os.path.abspath(settings.HAYSTACK_WHOOSH_PATH)
+        new_path = '%s.%i' % (path, time.time())
+        backend = new_index_backend(new_path, site)
+        backend.setup()
+
+        def swap(count):
+            built = backend.index.refresh()
+            documents = built.doc_count_all()
+            if not os.path.isdir(new_path) or \
+                    built.storage.folder != new_path or documents != count:
+                shutil.rmtree(new_path, ignore_errors=True)
+                raise CommandError(
+                    'the new index at %s has %i documents instead of %i; '
+                    'leaving the current index in place' % (
+                        new_path, documents, count))
+            if os.path.islink(path):
+                old_path = os.path.realpath(path)
+                # renaming over the old symlink replaces it atomically
+                os.symlink(new_path, new_path + '.link')
+                os.rename(new_path + '.link', path)
+            else:
+                # the first rebuild; after this, the index is a symlink
+                old_path = path + '.old'
+                if os.path.exists(path):
+                    os.rename(path, old_path)
+                os.symlink(new_path, path)
+            shutil.rmtree(old_path, ignore_errors=True)
+        return backend, swap
@@ -0,0 +1,96 @@
+import datetime
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from haystack import site
+
+from localtv import models
+
+class Command(NoArgsCommand):
+
+    help = ('Updates the search index for the videos in the SearchIndexQueue, '
+            'in batches, and removes the ones which are no longer active.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=100,
+                    help='Number of videos to index at a time.'),
+        make_option('--forever', action='store_true', dest='forever',
+                    default=False,
+                    help='Keep waiting for more videos once the queue is '
+                    'empty, instead of exiting.'),
+        make_option('--sleep', type='float', dest='sleep', default=5,
+                    help='With --forever, seconds to wait before checking '
+                    'an empty queue again.'),
+        make_option('--stats', action='store_true', dest='stats',
+                    default=False,
+                    help='Print the queue statistics and exit.'))
+
+    def handle_noargs(self, batch_size=100, forever=False, sleep=5,
+                      stats=False, verbosity=1, **options):
+        verbosity = int(verbosity)
+        if stats:
+            stats = models.SearchIndexQueue.stats()
+            print '%(queued)i queued, oldest %(lag)i seconds ago' % stats
+            if stats['last_batch']:
+                print ('last batch: %(size)i videos (%(indexed)i indexed, '
+                       '%(removed)i removed) in %(seconds).2f seconds, '
+                       '%(docs_per_second).1f docs/sec, lag %(lag)i seconds'
+                       % stats['last_batch'])
+            return
+
+        index = site.get_index(models.Video)
+        while True:
+            batch = self.process(index, batch_size)
+            if batch is None:
+                if not forever:
+                    break
+                time.sleep(sleep)
+                continue
+            if verbosity > 1:
+                print ('indexed %(indexed)i and removed %(removed)i videos in '
+                       '%(seconds).2f seconds (%(docs_per_second).1f '
+                       'docs/sec); lag %(lag)i seconds' % batch)
+
+    def process(self, index, batch_size):
+        """
+        Updates the index for the next batch of queued videos, and returns
+        the statistics for the batch (or None if the queue is empty, or
+        paused while the index is rebuilt).
+        """
+        if models.SearchIndexQueue.is_paused():
+            return None
+        rows = list(models.SearchIndexQueue.objects.order_by(
+                'pk').values_list('pk', 'video_id',
+                                  'when_queued')[:batch_size])
+        if not rows:
+            return None
+
+        start = time.time()
+        video_ids = set(video_id for pk, video_id, when_queued in rows)
+        videos = index.preload(index.get_queryset().filter(pk__in=video_ids))
+        if videos:
+            index.backend.update(index, videos)
+        removed = video_ids - set(video.pk for video in videos)
+        for video_id in removed:
+            index.backend.remove('localtv.video.%i' % video_id)
+
+        # changes queued while we were indexing stay in the queue
+        models.SearchIndexQueue.objects.filter(
+            pk__lte=rows[-1][0], video_id__in=video_ids).delete()
+
+        seconds = time.time() - start
+        lag = datetime.datetime.now() - min(when_queued for pk, video_id,
+                                            when_queued in rows)
+        stats = {
+            'size': len(video_ids),
+            'indexed': len(videos),
+            'removed': len(removed),
+            'seconds': seconds,
+            'docs_per_second': len(video_ids) / max(seconds, 0.001),
+            'lag': lag.days * 86400 + lag.seconds
+            }
+        models.SearchIndexQueue.record_batch(stats)
+        return stats
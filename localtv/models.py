@@ -18,6 +18,7 @@
 
 import datetime
 import httplib
+import operator
 import re
 import urllib
 import urllib2
@@ -30,16 +31,18 @@ import StringIO
 from xml.sax.saxutils import unescape
 from BeautifulSoup import BeautifulSoup
 
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models.fields.related import ReverseManyRelatedObjectsDescriptor
 from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth.models import User
 from django.contrib.comments.moderation import CommentModerator, moderator
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.core import cache
 from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
-from django.core.mail import EmailMessage
+from django.core.mail import EmailMessage, get_connection
 from django.core.signals import request_finished
 import django.dispatch
 from django.core.validators import ipv4_re
@@ -51,6 +54,8 @@ import feedparser
 import vidscraper
 from notification import models as notification
 import tagging
+from tagging.models import Tag, TaggedItem
+from tagging.managers import TagDescriptor
 
 from localtv.templatetags.filters import sanitize
 from localtv import util
@@ -92,6 +97,12 @@ VIDEO_SERVICE_REGEXES = (
     ('Vimeo', r'http://(www\.)?vimeo\.com/'),
     ('Dailymotion', r'http://(www\.)?dailymotion\.com/rss'))
 
+# user agents whose views shouldn't be counted as watches
+WATCH_IGNORED_USER_AGENTS = re.compile(
+    getattr(settings, 'LOCALTV_WATCH_IGNORED_USER_AGENTS',
+            r'bot|crawl|spider|slurp|feedfetcher|mediapartners|curl|wget'),
+    re.I)
+
 class Error(Exception): pass
 class CannotOpenImageUrl(Error): pass
 
@@ -259,35 +270,49 @@ class Thumbnailable(models.Model):
 
 
 
+# per-process memos of the SiteLocations and their admins, which are cleared at
+# the end of each request.  Between requests, they're shared through the cache
+# (see SiteLocationManager.shared_cache_key()).
 SITE_LOCATION_CACHE = {}
+SITE_ADMINS_CACHE = {}
 
 class SiteLocationManager(models.Manager):
+    def shared_cache_key(self, site_id, name='sitelocation'):
+        return 'localtv.%s:%i:%s' % (name, site_id,
+                                     util.get_cache_version('sitelocation'))
+
     def get_current(self):
-        sid = settings.SITE_ID
-        try:
-            current_site_location = SITE_LOCATION_CACHE[sid]
-        except KeyError:
-            current_site_location = self.select_related().get(site__pk=sid)
-            SITE_LOCATION_CACHE[sid] = current_site_location
-        return current_site_location
+        return self.get(site=settings.SITE_ID)
 
     def get(self, **kwargs):
-        if 'site' in kwargs:
-            site= kwargs.pop('site')
-            if not isinstance(site, (int, long, basestring)):
-                site = site.id
-            site = int(site)
-            try:
-                return SITE_LOCATION_CACHE[site]
-            except KeyError:
-                pass
-        site_location = models.Manager.get(self, **kwargs)
-        SITE_LOCATION_CACHE[site_location.site_id] = site_location
+        if kwargs.keys() != ['site']:
+            site_location = models.Manager.get(self, **kwargs)
+            SITE_LOCATION_CACHE[site_location.site_id] = site_location
+            return site_location
+
+        site = kwargs['site']
+        if not isinstance(site, (int, long, basestring)):
+            site = site.id
+        site = int(site)
+        try:
+            return SITE_LOCATION_CACHE[site]
+        except KeyError:
+            pass
+        key = self.shared_cache_key(site)
+        site_location = cache.cache.get(key)
+        if site_location is None:
+            site_location = self.select_related().get(site__pk=site)
+            cache.cache.set(key, site_location)
+        SITE_LOCATION_CACHE[site] = site_location
         return site_location
 
+    def clear_local_cache(self):
+        SITE_LOCATION_CACHE.clear()
+        SITE_ADMINS_CACHE.clear()
+
     def clear_cache(self):
-        global SITE_LOCATION_CACHE
-        SITE_LOCATION_CACHE = {}
+        self.clear_local_cache()
+        util.bump_cache_version('sitelocation')
 
 
 class SiteLocation(Thumbnailable):
@@ -403,11 +428,29 @@ class SiteLocation(Thumbnailable):
         if user.is_superuser:
             return True
 
-        return bool(self.admins.filter(pk=user.pk).count())
+        return user.pk in self.admin_ids()
+
+    def admin_ids(self):
+        """
+        Returns a frozenset of the primary keys of the admins for this
+        SiteLocation.
+        """
+        try:
+            return SITE_ADMINS_CACHE[self.site_id]
+        except KeyError:
+            pass
+        key = SiteLocation.objects.shared_cache_key(self.site_id, 'admins')
+        admin_ids = cache.cache.get(key)
+        if admin_ids is None:
+            admin_ids = frozenset(self.admins.values_list('pk', flat=True))
+            cache.cache.set(key, admin_ids)
+        SITE_ADMINS_CACHE[self.site_id] = admin_ids
+        return admin_ids
 
     def save(self, *args, **kwargs):
+        models.Model.save(self, *args, **kwargs)
+        # saving cleared the caches, so start them again with this object
         SITE_LOCATION_CACHE[self.site_id] = self
-        return models.Model.save(self, *args, **kwargs)
 
     @property
     def is_free(self):
@@ -762,6 +805,11 @@ class Category(models.Model):
      - description: human readable description of this item
      - parent: Reference to another Category.  Allows you to have heirarchical
        categories.
+     - lft, rght, level: the position of this category in the site's category
+       tree, stored as nested sets.  A category's descendants are the
+       categories on the same site with lft between its lft and rght.  These
+       are maintained by rebuild_category_tree() whenever a category is saved
+       or deleted.
     """
     site = models.ForeignKey(Site)
     name = models.CharField(
@@ -793,6 +841,9 @@ class Category(models.Model):
         verbose_name='Category Parent',
         help_text=("Categories, unlike tags, can have a "
                    "hierarchy."))
+    lft = models.PositiveIntegerField(default=0, editable=False)
+    rght = models.PositiveIntegerField(default=0, editable=False)
+    level = models.PositiveIntegerField(default=0, editable=False)
 
     class Meta:
         ordering = ['name']
@@ -807,12 +858,7 @@ class Category(models.Model):
         """
         Returns the number of parents this category has.  Used for indentation.
         """
-        depth = 0
-        parent = self.parent
-        while parent is not None:
-            depth += 1
-            parent = parent.parent
-        return depth
+        return self.level
 
     def dashes(self):
         return mark_safe('&mdash;' * self.depth())
@@ -821,23 +867,36 @@ class Category(models.Model):
     def get_absolute_url(self):
         return ('localtv_category', [self.slug])
 
+    def subtree(self):
+        """
+        Returns a QuerySet of this category and all of its descendants, in
+        tree order.
+        """
+        return Category.objects.filter(
+            site=self.site_id,
+            lft__range=(self.lft, self.rght)).order_by('lft')
+
     @classmethod
     def in_order(klass, sitelocation, initial=None):
-        objects = []
-        def accumulate(categories):
-            for category in categories:
-                objects.append(category)
-                if category.child_set.count():
-                    accumulate(category.child_set.all())
-        if initial is None:
-            initial = klass.objects.filter(site=sitelocation, parent=None)
-        accumulate(initial)
-        return objects
+        """
+        Returns a list of the categories for the given site, with each category
+        followed by its children.  If `initial` is given, only those categories
+        and their descendants are returned.
+        """
+        categories = klass.objects.filter(site=sitelocation)
+        if initial is not None:
+            subtrees = [models.Q(lft__range=(category.lft, category.rght))
+                        for category in initial]
+            if not subtrees:
+                return []
+            categories = categories.filter(reduce(operator.or_, subtrees))
+        return list(categories.order_by('lft'))
 
     def approved_set(self):
-        categories = [self] + self.in_order(self.site, self.child_set.all())
         return Video.objects.new(status=VIDEO_STATUS_ACTIVE,
-                                 categories__in=categories).distinct()
+                                 categories__site=self.site_id,
+                                 categories__lft__range=(self.lft, self.rght)
+                                 ).distinct()
     approved_set = property(approved_set)
 
     def unique_error_message(self, model_class, unique_check):
@@ -910,18 +969,92 @@ class SavedSearch(Source):
         return u'Search'
 
 
+# how many videos VideoManager.moderate() updates per transaction
+MODERATION_CHUNK_SIZE = 500
+# where the moderate_videos command keeps its (done, total) progress
+MODERATION_PROGRESS_KEY = 'localtv.moderation.progress:%i'
+
 class VideoManager(models.Manager):
 
     def new(self, **kwargs):
-        published = 'localtv_video.when_published,'
+        order_by = '-best_date'
         if 'site' in kwargs:
             if not SiteLocation.objects.get(
                 site=kwargs['site']).use_original_date:
-                published = ''
-        videos = self.extra(select={'best_date': """
-COALESCE(%slocaltv_video.when_approved,
-localtv_video.when_submitted)""" % published})
-        return videos.filter(**kwargs).order_by('-best_date')
+                order_by = '-best_posted_date'
+        return self.filter(**kwargs).order_by(order_by)
+
+    def with_tag(self, tag, site, status=VIDEO_STATUS_ACTIVE):
+        """
+        Returns a QuerySet of the videos on the site with the given tag and
+        status.  The lookup goes through the VideoTagIndex, rather than
+        TaggedItem's generic relation.
+        """
+        return self.filter(tag_index__tag=tag,
+                           tag_index__site=site,
+                           tag_index__status=status)
+
+    def by_author(self, author, site, status=VIDEO_STATUS_ACTIVE):
+        """
+        Returns a QuerySet of the videos on the site with the given status
+        which the user is an author of, or submitted.  The lookup goes
+        through the VideoAuthorIndex, so there's no OR across the authors
+        join and no DISTINCT.
+        """
+        return self.filter(author_index__author=author,
+                           author_index__site=site,
+                           author_index__status=status)
+
+    def moderate(self, video_ids, status, chunk_size=MODERATION_CHUNK_SIZE,
+                 progress=None):
+        """
+        Moves the videos with the given pks to `status` with set-based
+        UPDATEs, `chunk_size` videos (and one transaction) at a time, instead
+        of saving each one.  Approving a video sets its when_approved, and
+        the dates built from it.
+
+        Since update() doesn't send signals, this does what the Video
+        handlers would have: it keeps the tag and author indexes in sync,
+        queues the videos for the search index, and then, once for the whole
+        batch, throws away the cached pages and counts.  Approval
+        notifications are left to send_approval_notifications().
+
+        `progress` is called with the number of videos done and the total
+        after each chunk.
+        """
+        video_ids = list(video_ids)
+        site_ids = set()
+        for index in xrange(0, len(video_ids), chunk_size):
+            chunk = video_ids[index:index + chunk_size]
+            site_ids.update(self.filter(pk__in=chunk).values_list(
+                    'site', flat=True).distinct())
+            self._moderate_chunk(chunk, status)
+            if progress is not None:
+                progress(index + len(chunk), len(video_ids))
+
+        for site_id in site_ids:
+            util.bump_site_generation(site_id)
+        util.bump_cache_version(self.model._meta.db_table)
+
+    @transaction.commit_on_success
+    def _moderate_chunk(self, video_ids, status):
+        now = datetime.datetime.now()
+        fields = {'status': status,
+                  'when_modified': now}
+        if status == VIDEO_STATUS_ACTIVE:
+            # what update_best_dates() would have done
+            fields['when_approved'] = fields['best_posted_date'] = now
+            unpublished = list(self.filter(
+                    pk__in=video_ids, when_published=None).values_list(
+                    'pk', flat=True))
+            self.filter(pk__in=unpublished).update(best_date=now)
+            for index in (VideoTagIndex, VideoAuthorIndex):
+                index.objects.filter(video__in=unpublished).update(
+                    best_date=now)
+        self.filter(pk__in=video_ids).update(**fields)
+        for index in (VideoTagIndex, VideoAuthorIndex):
+            index.objects.filter(video__in=video_ids).update(status=status)
+        SearchIndexQueue.add(*video_ids)
 
     def popular_since(self, delta, sitelocation, **kwargs):
         """
@@ -955,12 +1088,21 @@ localtv_video.when_submitted)""" % published})
                 videos = self
             if kwargs:
                 videos = videos.filter(**kwargs)
-            videos = videos.extra(
-                select={'watchcount':
-                            """SELECT COUNT(*) FROM localtv_watch
+            watchcount = """SELECT COUNT(*) FROM localtv_watch
 WHERE localtv_video.id = localtv_watch.video_id AND
-localtv_watch.timestamp > %s"""},
-                select_params = (earliest_time,))
+localtv_watch.timestamp > %s"""
+            select_params = [earliest_time]
+            if earliest_time < Watch.retention_cutoff():
+                # some of the watches might have been compacted into
+                # WatchRollups
+                watchcount = """(%s) + (SELECT
+COALESCE(SUM(localtv_watchrollup.count), 0) FROM localtv_watchrollup
+WHERE localtv_video.id = localtv_watchrollup.video_id AND
+localtv_watchrollup.date >= %%s)""" % watchcount
+                select_params.append(earliest_time.date())
+            videos = videos.extra(
+                select={'watchcount': watchcount},
+                select_params = select_params)
             if 'extra_where' in kwargs:
                 where = kwargs.pop('extra_where')
                 videos = videos.extra(where=where)
@@ -1022,6 +1164,11 @@ class Video(Thumbnailable):
      - contact: a free-text field for anonymous users to specify some contact
        info
      - notes: a free-text field to add notes about the video
+     - best_date: the first of when_published, when_approved, and
+       when_submitted which is set; kept up to date on save so that listings
+       can be sorted with an index
+     - best_posted_date: like best_date, but ignoring when_published (for
+       sites which don't SiteLocation.use_original_date)
     """
     name = models.CharField(max_length=250)
     site = models.ForeignKey(Site)
@@ -1060,7 +1207,9 @@ class Video(Thumbnailable):
     contact = models.CharField(max_length=250, blank=True,
                                default='')
     notes = models.TextField(blank=True)
-
+    best_date = models.DateTimeField(null=True, blank=True, editable=False)
+    best_posted_date = models.DateTimeField(null=True, blank=True,
+                                            editable=False)
 
     objects = VideoManager()
 
@@ -1191,6 +1340,124 @@ class VideoAdmin(admin.ModelAdmin):
     search_fields = ['name', 'description']
 
 
+class PrefetchedManyRelatedDescriptor(ReverseManyRelatedObjectsDescriptor):
+    """
+    Like the regular descriptor for a ManyToManyField, but if
+    prefetch_videos() has loaded the related objects, the manager's QuerySets
+    start out with them in their result cache.
+    """
+    def __get__(self, instance, instance_type=None):
+        manager = ReverseManyRelatedObjectsDescriptor.__get__(
+            self, instance, instance_type)
+        if instance is None:
+            return manager
+        prefetched = instance.__dict__.get('_prefetched_%s' % self.field.name)
+        if prefetched is not None:
+            get_query_set = manager.get_query_set
+            def get_prefetched_query_set():
+                queryset = get_query_set()
+                queryset._result_cache = list(prefetched)
+                return queryset
+            manager.get_query_set = get_prefetched_query_set
+        return manager
+
+for name in ('authors', 'categories'):
+    setattr(Video, name,
+            PrefetchedManyRelatedDescriptor(Video._meta.get_field(name)))
+
+
+class PrefetchedTagDescriptor(TagDescriptor):
+    """
+    Like django-tagging's TagDescriptor, but uses the tags loaded by
+    prefetch_videos() if there are any.
+    """
+    def __get__(self, instance, owner):
+        if instance is not None and '_prefetched_tags' in instance.__dict__:
+            queryset = Tag.objects.get_for_object(instance)
+            queryset._result_cache = list(instance._prefetched_tags)
+            return queryset
+        return TagDescriptor.__get__(self, instance, owner)
+
+    def __set__(self, instance, value):
+        instance.__dict__.pop('_prefetched_tags', None)
+        TagDescriptor.__set__(self, instance, value)
+
+    def __delete__(self, instance):
+        instance.__dict__.pop('_prefetched_tags', None)
+        TagDescriptor.__delete__(self, instance)
+
+
+def _sort_by_ordering(objects, ordering):
+    """
+    Sorts a list of model instances in place, the way the database would for
+    the given Meta.ordering.
+    """
+    for name in reversed(ordering):
+        if name == '?' or '__' in name:
+            continue
+        objects.sort(key=operator.attrgetter(name.lstrip('-')),
+                     reverse=name.startswith('-'))
+
+def prefetch_videos(videos):
+    """
+    Loads the objects which are shown with each video in a listing (its
+    site, feed, saved search, user, authors, categories and tags) for a whole
+    list of videos at once, in a fixed number of queries.  Returns the videos
+    as a list.
+    """
+    videos = list(videos)
+    by_pk = dict((video.pk, video) for video in videos)
+    if not by_pk:
+        return videos
+
+    for name in ('site', 'feed', 'search', 'user'):
+        field = Video._meta.get_field(name)
+        cache_name = field.get_cache_name()
+        ids = set(getattr(video, field.attname) for video in videos
+                  if not hasattr(video, cache_name))
+        ids.discard(None)
+        if not ids:
+            continue
+        related = field.rel.to._default_manager.in_bulk(list(ids))
+        for video in videos:
+            value = getattr(video, field.attname)
+            if value in related:
+                setattr(video, cache_name, related[value])
+
+    for name in ('authors', 'categories'):
+        field = Video._meta.get_field(name)
+        from_name = field.m2m_field_name()
+        to_name = field.m2m_reverse_field_name()
+        related = dict((pk, []) for pk in by_pk)
+        for row in field.rel.through._default_manager.filter(**{
+                '%s__in' % from_name: by_pk.keys()}).select_related(to_name):
+            related[getattr(row, '%s_id' % from_name)].append(
+                getattr(row, to_name))
+        for pk, objects in related.items():
+            _sort_by_ordering(objects, field.rel.to._meta.ordering)
+            by_pk[pk].__dict__['_prefetched_%s' % name] = objects
+
+    tags = dict((pk, []) for pk in by_pk)
+    for item in TaggedItem._default_manager.filter(
+        content_type=ContentType.objects.get_for_model(Video),
+        object_id__in=by_pk.keys()).select_related('tag'):
+        tags[item.object_id].append(item.tag)
+    for pk, objects in tags.items():
+        _sort_by_ordering(objects, Tag._meta.ordering)
+        by_pk[pk].__dict__['_prefetched_tags'] = objects
+
+    # when() and when_prefix() need the SiteLocation
+    for site_id in set(video.site_id for video in videos):
+        try:
+            SiteLocation.objects.get(site=site_id)
+        except SiteLocation.DoesNotExist:
+            pass
+
+    return videos
+
+
+WATCH_STATS_TIMEOUT = 60 * 60 * 24 * 30 # 30 days
+
 class Watch(models.Model):
     """
     Record of a video being watched.
@@ -1206,12 +1473,18 @@ class Watch(models.Model):
     user = models.ForeignKey('auth.User', blank=True, null=True)
     ip_address = models.IPAddressField()
 
+    STATS = ('recorded', 'deduped', 'filtered')
+
     @classmethod
     def add(Class, request, video):
         """
         Adds a record of a watched video to the database.  If the request came
         from localhost, check to see if it was forwarded to (hopefully) get the
         right IP address.
+
+        Requests from robots are ignored, as are repeat views of the same video
+        by the same user (or, for anonymous users, the same IP address) within
+        settings.LOCALTV_WATCH_DEDUP_WINDOW seconds.
         """
         ip = request.META.get('REMOTE_ADDR', '0.0.0.0')
         if not ipv4_re.match(ip):
@@ -1222,10 +1495,457 @@ class Watch(models.Model):
         else:
             user = None
 
+        if WATCH_IGNORED_USER_AGENTS.search(
+            request.META.get('HTTP_USER_AGENT', '')):
+            Class._increment_stat('filtered')
+            return
+
+        cache_key = Class._mark_viewed(video, user, ip)
+        if cache_key is False:
+            Class._increment_stat('deduped')
+            return
+
         try:
             Class(video=video, user=user, ip_address=ip).save()
         except Exception:
-            pass
+            if cache_key is not None:
+                # the view wasn't recorded, so don't dedupe the next one
+                cache.cache.delete(cache_key)
+        else:
+            Class._increment_stat('recorded')
+
+    @classmethod
+    def _mark_viewed(Class, video, user, ip):
+        """
+        Marks the video as watched by this viewer for the de-duplication
+        window, and returns the marker's cache key; or returns False if the
+        viewer has already watched it within the window (or None if there's
+        no window).  The markers live in the cache, so they expire on their
+        own and memory use is bounded by the cache backend.
+        """
+        window = getattr(settings, 'LOCALTV_WATCH_DEDUP_WINDOW',
+                         30 * 60) # 30 minutes
+        if not window:
+            return None
+        if user is not None:
+            viewer = 'user-%i' % user.pk
+        else:
+            viewer = ip
+        cache_key = 'localtv.watch.seen:%i:%s' % (video.pk, viewer)
+        if not cache.cache.add(cache_key, True, window):
+            return False
+        return cache_key
+
+    @classmethod
+    def _increment_stat(Class, name):
+        cache_key = 'localtv.watch.stats:%s' % name
+        if not cache.cache.add(cache_key, 1, WATCH_STATS_TIMEOUT):
+            try:
+                cache.cache.incr(cache_key)
+            except ValueError:
+                # expired between the add() and the incr()
+                cache.cache.add(cache_key, 1, WATCH_STATS_TIMEOUT)
+
+    @classmethod
+    def retention_cutoff(Class):
+        """
+        Returns the datetime before which Watch records are compacted into
+        WatchRollups by the compact_watches management command.
+        """
+        return datetime.datetime.now() - datetime.timedelta(
+            days=getattr(settings, 'LOCALTV_WATCH_RETENTION_DAYS', 30))
+
+    @classmethod
+    def stats(Class):
+        """
+        Returns a dictionary with the number of watches that were recorded,
+        deduped, and filtered (as coming from robots) by Watch.add().
+        """
+        return dict((name,
+                     cache.cache.get('localtv.watch.stats:%s' % name, 0))
+                    for name in Class.STATS)
+
+
+class WatchRollup(models.Model):
+    """
+    Number of times a video was watched on a given day.  Old Watch records
+    are folded into these by the compact_watches management command.
+
+    fields:
+     - video: Video that was watched
+     - date: the day the video was watched
+     - count: number of Watch records for that video on that day
+    """
+    video = models.ForeignKey(Video)
+    date = models.DateField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('video', 'date')
+
+
+class VideoTombstone(models.Model):
+    """
+    Record of a video being deleted, so that clients syncing with the changes
+    feed know to remove it.  Tombstones older than
+    LOCALTV_TOMBSTONE_RETENTION_DAYS are deleted by the prune_tombstones
+    management command; clients which haven't synced since then have to
+    start again without a cursor.
+
+    fields:
+     - site: site the video was on
+     - video_id: primary key the video had
+     - guid: guid the video had
+     - when_deleted: when the video was deleted
+    """
+    site = models.ForeignKey(Site)
+    video_id = models.PositiveIntegerField()
+    guid = models.CharField(max_length=250, blank=True)
+    when_deleted = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    @classmethod
+    def retention_cutoff(Class):
+        """
+        Returns the datetime before which tombstones are deleted by the
+        prune_tombstones management command.
+        """
+        return datetime.datetime.now() - datetime.timedelta(
+            days=getattr(settings, 'LOCALTV_TOMBSTONE_RETENTION_DAYS', 90))
+
+
+class VideoTagIndexManager(models.Manager):
+
+    def usage(self, site, status=VIDEO_STATUS_ACTIVE):
+        """
+        Returns a QuerySet of the Tags used by videos on the site with the
+        given status, each with a `count` of the videos using it (like
+        Tag.objects.usage_for_model(Video, counts=True)).
+        """
+        return Tag.objects.filter(
+            video_index__site=site,
+            video_index__status=status).annotate(
+            count=models.Count('video_index'))
+
+    def sync_video(self, video):
+        """
+        Makes the index rows for the video match its tags.
+        """
+        content_type = ContentType.objects.get_for_model(Video)
+        tag_ids = set(TaggedItem.objects.filter(
+                content_type=content_type,
+                object_id=video.pk).values_list('tag', flat=True))
+        indexed = set(self.filter(video=video).values_list('tag', flat=True))
+        if indexed - tag_ids:
+            self.filter(video=video, tag__in=indexed - tag_ids).delete()
+        self.filter(video=video).update(site=video.site_id,
+                                        status=video.status,
+                                        best_date=video.best_date)
+        for tag_id in tag_ids - indexed:
+            self.create(tag_id=tag_id, video=video, site_id=video.site_id,
+                        status=video.status, best_date=video.best_date)
+
+    def rebuild(self):
+        """
+        Throws away the whole index and builds it again from TaggedItem.
+        """
+        self.all().delete()
+        videos = dict((values[0], values[1:]) for values in
+                      Video.objects.values_list('pk', 'site', 'status',
+                                                'best_date'))
+        content_type = ContentType.objects.get_for_model(Video)
+        for tag_id, video_id in TaggedItem.objects.filter(
+            content_type=content_type).values_list('tag', 'object_id'):
+            if video_id not in videos:
+                continue
+            site_id, status, best_date = videos[video_id]
+            self.create(tag_id=tag_id, video_id=video_id, site_id=site_id,
+                        status=status, best_date=best_date)
+
+
+class VideoTagIndex(models.Model):
+    """
+    Denormalized copy of the tags on each video, along with the fields tag
+    listings filter and sort on, so that those listings are range scans of
+    one index instead of joins through TaggedItem's generic relation.  The
+    rows are kept up to date by signal handlers; use
+    VideoTagIndex.objects.rebuild() if they get out of sync.
+
+    fields:
+     - tag: the Tag
+     - video: a Video with that tag
+     - site: the video's site
+     - status: the video's status
+     - best_date: the video's best_date
+    """
+    tag = models.ForeignKey(Tag, related_name='video_index')
+    video = models.ForeignKey(Video, related_name='tag_index')
+    site = models.ForeignKey(Site)
+    status = models.IntegerField(choices=VIDEO_STATUSES)
+    best_date = models.DateTimeField(null=True, blank=True)
+
+    objects = VideoTagIndexManager()
+
+    class Meta:
+        unique_together = ('tag', 'video')
+
+
+class VideoAuthorIndexManager(models.Manager):
+
+    def video_counts(self, authors, site, status=VIDEO_STATUS_ACTIVE):
+        """
+        Sets `video_count` on each of the given users to the number of videos
+        on the site they're an author of or submitted.  The counts are cached
+        until the site's content changes.
+        """
+        keys = dict((author.pk, util.site_cache_key(site.pk,
+                                                     'author_video_count',
+                                                     author.pk, status))
+                    for author in authors)
+        cached = cache.cache.get_many(keys.values())
+        counts = {}
+        missing = []
+        for author_id, key in keys.items():
+            if key in cached:
+                counts[author_id] = cached[key]
+            else:
+                missing.append(author_id)
+        if missing:
+            found = dict(self.filter(
+                    author__in=missing, site=site,
+                    status=status).values_list('author').annotate(
+                    models.Count('video')).order_by())
+            for author_id in missing:
+                counts[author_id] = found.get(author_id, 0)
+                cache.cache.set(keys[author_id], counts[author_id])
+        for author in authors:
+            author.video_count = counts[author.pk]
+        return authors
+
+    def sync_video(self, video):
+        """
+        Makes the index rows for the video match its authors and submitter.
+        """
+        author_ids = set(User.objects.filter(
+                authored_set=video).values_list('pk', flat=True))
+        if video.user_id is not None:
+            author_ids.add(video.user_id)
+        indexed = set(self.filter(video=video).values_list('author',
+                                                           flat=True))
+        if indexed - author_ids:
+            self.filter(video=video,
+                        author__in=indexed - author_ids).delete()
+        if indexed & author_ids:
+            self.filter(video=video).update(site=video.site_id,
+                                            status=video.status,
+                                            best_date=video.best_date)
+        for author_id in author_ids - indexed:
+            self.create(author_id=author_id, video=video,
+                        site_id=video.site_id, status=video.status,
+                        best_date=video.best_date)
+
+    def rebuild(self):
+        """
+        Throws away the whole index and builds it again from Video.user and
+        Video.authors.
+        """
+        self.all().delete()
+        authors = Video._meta.get_field('authors')
+        through = authors.rel.through._default_manager.values_list(
+            authors.m2m_field_name(), authors.m2m_reverse_field_name())
+        pairs = set(through)
+        pairs.update(Video.objects.exclude(user=None).values_list('pk',
+                                                                  'user'))
+        videos = dict((values[0], values[1:]) for values in
+                      Video.objects.values_list('pk', 'site', 'status',
+                                                'best_date'))
+        for video_id, author_id in pairs:
+            site_id, status, best_date = videos[video_id]
+            self.create(author_id=author_id, video_id=video_id,
+                        site_id=site_id, status=status, best_date=best_date)
+
+
+class VideoAuthorIndex(models.Model):
+    """
+    Denormalized list of the users each video is by: its authors, and the
+    user who submitted it.  Like VideoTagIndex, it has the fields listings
+    filter and sort on, so that author pages are range scans of one index.
+    The rows are kept up to date by signal handlers; use
+    VideoAuthorIndex.objects.rebuild() if they get out of sync.
+
+    fields:
+     - author: the User
+     - video: a Video which the user is an author of, or submitted
+     - site: the video's site
+     - status: the video's status
+     - best_date: the video's best_date
+    """
+    author = models.ForeignKey('auth.User', related_name='video_index')
+    video = models.ForeignKey(Video, related_name='author_index')
+    site = models.ForeignKey(Site)
+    status = models.IntegerField(choices=VIDEO_STATUSES)
+    best_date = models.DateTimeField(null=True, blank=True)
+
+    objects = VideoAuthorIndexManager()
+
+    class Meta:
+        unique_together = ('author', 'video')
+
+
+# how long (in seconds) SearchIndexQueue.pause() lasts without being renewed
+SEARCH_QUEUE_PAUSE_TIMEOUT = 10 * 60
+# how long (in seconds) the statistics for the last batch are kept
+SEARCH_QUEUE_STATS_TIMEOUT = getattr(settings,
+                                     'LOCALTV_SEARCH_QUEUE_STATS_TIMEOUT',
+                                     60 * 60 * 24) # 1 day
+
+class SearchIndexQueue(models.Model):
+    """
+    Videos whose search index documents are out of date.  Rows are added by
+    signal handlers when a video (or something indexed along with it)
+    changes, and worked off in batches by the update_search_queue management
+    command.  A video can be queued more than once; the command handles all
+    its rows together.  While the index is being rebuilt, the queue is
+    paused, so that the changes are applied to the new index.
+
+    fields:
+     - video_id: primary key of the video (which might have been deleted)
+     - when_queued: when the video changed
+    """
+    video_id = models.PositiveIntegerField()
+    when_queued = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def add(Class, *video_ids):
+        """
+        Queues the given videos to be re-indexed, with one executemany().
+        Like the ORM, it commits unless a transaction is being managed.
+        """
+        if not video_ids:
+            return
+        now = datetime.datetime.now()
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.executemany(
+            'INSERT INTO %s (%s, %s) VALUES (%%s, %%s)' % (
+                qn(Class._meta.db_table), qn('video_id'), qn('when_queued')),
+            [(video_id, now) for video_id in set(video_ids)])
+        transaction.commit_unless_managed()
+
+    @classmethod
+    def pause(Class):
+        """
+        Stops the queue from being worked off for the next
+        SEARCH_QUEUE_PAUSE_TIMEOUT seconds; call it again to keep it paused.
+        The flag is kept in the cache, so it needs to be one the processes
+        share.
+        """
+        cache.cache.set('localtv.search_queue.paused', True,
+                        SEARCH_QUEUE_PAUSE_TIMEOUT)
+
+    @classmethod
+    def resume(Class):
+        cache.cache.delete('localtv.search_queue.paused')
+
+    @classmethod
+    def is_paused(Class):
+        return bool(cache.cache.get('localtv.search_queue.paused'))
+
+    @classmethod
+    def record_batch(Class, stats):
+        """
+        Stores the statistics for the last batch the queue was worked off in,
+        for stats().
+        """
+        cache.cache.set('localtv.search_queue.last_batch', stats,
+                        SEARCH_QUEUE_STATS_TIMEOUT)
+
+    @classmethod
+    def stats(Class):
+        """
+        Returns a dictionary with the number of queue rows, the lag (in
+        seconds) of the oldest one, and the statistics for the last batch
+        (its size, how many videos were indexed and removed, how long it
+        took, and the documents per second).
+        """
+        now = datetime.datetime.now()
+        oldest = Class.objects.aggregate(
+            models.Min('when_queued'))['when_queued__min']
+        if oldest is None:
+            lag = 0
+        else:
+            delta = now - oldest
+            lag = delta.days * 86400 + delta.seconds
+        return {
+            'queued': Class.objects.count(),
+            'lag': lag,
+            'last_batch': cache.cache.get('localtv.search_queue.last_batch')
+            }
+
+
+RELATED_VIDEOS_LENGTH = getattr(settings, 'LOCALTV_RELATED_VIDEOS_LENGTH', 10)
+RELATED_VIDEOS_CACHE_TIMEOUT = 60 * 60 * 24 # 1 day
+
+class RelatedVideosManager(models.Manager):
+
+    def cache_key(self, video_id):
+        return 'localtv.related_videos:%i' % video_id
+
+    def store(self, video_id, related_ids):
+        """
+        Saves the list of related video ids for a video, and puts it in the
+        cache.
+        """
+        value = ','.join(str(related_id) for related_id in related_ids)
+        if not self.filter(video=video_id).update(video_ids=value):
+            self.create(video_id=video_id, video_ids=value)
+        cache.cache.set(self.cache_key(video_id), list(related_ids),
+                        RELATED_VIDEOS_CACHE_TIMEOUT)
+
+    def for_video(self, video, status=VIDEO_STATUS_ACTIVE):
+        """
+        Returns the list of videos related to the given one, most related
+        first, with their relations prefetched.  The ids come from the cache
+        or from one query; videos which are no longer active (or are on
+        another site) are left out.  Returns an empty list if the related
+        videos haven't been computed yet.
+        """
+        cache_key = self.cache_key(video.pk)
+        related_ids = cache.cache.get(cache_key)
+        if related_ids is None:
+            related_ids = []
+            for value in self.filter(video=video).values_list('video_ids',
+                                                              flat=True):
+                related_ids = [int(related_id)
+                               for related_id in value.split(',')
+                               if related_id]
+            cache.cache.set(cache_key, related_ids,
+                            RELATED_VIDEOS_CACHE_TIMEOUT)
+        if not related_ids:
+            return []
+        videos = Video.objects.filter(site=video.site_id,
+                                      status=status).in_bulk(related_ids)
+        return prefetch_videos([videos[related_id]
+                                for related_id in related_ids
+                                if related_id in videos])
+
+
+class RelatedVideos(models.Model):
+    """
+    The videos most related to a video, by the tags, categories and authors
+    they share.  The lists are computed in the background by the
+    compute_related_videos management command, and stored as
+    comma-separated ids so that a video page needs one lookup.
+
+    fields:
+     - video: the Video
+     - video_ids: the ids of the related videos, most related first
+     - when_computed: when the list was last computed
+    """
+    video = models.OneToOneField(Video, related_name='related_videos')
+    video_ids = models.TextField(blank=True)
+    when_computed = models.DateTimeField(auto_now=True)
+
+    objects = RelatedVideosManager()
 
 
 class VideoModerator(CommentModerator):
@@ -1286,13 +2006,36 @@ admin.site.register(Category, CategoryAdmin)
 admin.site.register(Video, VideoAdmin)
 admin.site.register(SavedSearch)
 admin.site.register(Watch)
+admin.site.register(WatchRollup)
 
 tagging.register(Video)
+Video.tags = PrefetchedTagDescriptor()
+
+def clear_prefetched_relations(sender, instance, **kwargs):
+    """
+    Throw away the related objects prefetch_videos() loaded when they change.
+    """
+    instance.__dict__.pop('_prefetched_authors', None)
+    instance.__dict__.pop('_prefetched_categories', None)
+for name in ('authors', 'categories'):
+    models.signals.m2m_changed.connect(
+        clear_prefetched_relations,
+        sender=Video._meta.get_field(name).rel.through)
 
 def finished(sender, **kwargs):
-    SiteLocation.objects.clear_cache()
+    SiteLocation.objects.clear_local_cache()
 request_finished.connect(finished)
 
+def invalidate_site_location_cache(sender, **kwargs):
+    SiteLocation.objects.clear_cache()
+for sender in (Site, SiteLocation):
+    models.signals.post_save.connect(invalidate_site_location_cache,
+                                     sender=sender)
+    models.signals.post_delete.connect(invalidate_site_location_cache,
+                                       sender=sender)
+models.signals.m2m_changed.connect(invalidate_site_location_cache,
+                                   sender=SiteLocation.admins.through)
+
 def tag_unicode(self):
     # hack to make sure that Unicode data gets returned for all tags
     if isinstance(self.name, str):
@@ -1320,6 +2063,37 @@ def send_new_video_email(sender, **kwargs):
 submit_finished.connect(send_new_video_email, weak=False)
 
 
+def send_approval_notifications(videos):
+    """
+    E-mails the users who submitted the videos that they were approved, if
+    they want to know.  Whether each user wants the e-mail is only checked
+    once, and the messages are all sent over one connection.
+    """
+    video_approved = None
+    should_send = {}
+    messages = []
+    for video in videos:
+        user = video.user
+        if user is None or not user.email:
+            continue
+        if video_approved is None:
+            video_approved = notification.NoticeType.objects.get(
+                label="video_approved")
+            t = loader.get_template(
+                'localtv/submit_video/approval_notification_email.txt')
+        if user.pk not in should_send:
+            should_send[user.pk] = notification.should_send(
+                user, video_approved, "1")
+        if not should_send[user.pk]:
+            continue
+        subject = '[%s] "%s" was approved!' % (video.site.name, video)
+        message = t.render(Context({'current_video': video}))
+        messages.append(EmailMessage(subject, message,
+                                     settings.DEFAULT_FROM_EMAIL,
+                                     [user.email]))
+    if messages:
+        get_connection(fail_silently=True).send_messages(messages)
+
 def create_email_notices(app, created_models, verbosity, **kwargs):
     notification.create_notice_type('video_comment',
                                     'New comment on your video',
@@ -1360,6 +2134,125 @@ def create_email_notices(app, created_models, verbosity, **kwargs):
 models.signals.post_syncdb.connect(create_email_notices,
                                    sender=notification)
 
+def update_best_dates(sender, instance, **kwargs):
+    """
+    Keep the denormalized Video.best_date and Video.best_posted_date in sync
+    with the dates they're built from.  This is a pre_save handler rather than
+    part of Video.save() so that it also runs when fixtures are loaded.
+    """
+    if instance.when_submitted is None:
+        # auto_now_add hasn't happened yet
+        instance.when_submitted = datetime.datetime.now()
+    instance.best_posted_date = (instance.when_approved or
+                                 instance.when_submitted)
+    instance.best_date = instance.when_published or instance.best_posted_date
+models.signals.pre_save.connect(update_best_dates,
+                                sender=Video)
+
+def rebuild_category_tree(categories):
+    """
+    Recomputes the nested set fields (lft, rght and level) for a QuerySet of
+    all the categories on one site, and saves the ones which changed.  Returns
+    a dictionary mapping each category's primary key to its new
+    (lft, rght, level).
+
+    This is a plain function, rather than a method, so that the migrations
+    can use it with their frozen models.
+    """
+    children = {}
+    current = {}
+    for pk, parent_id, lft, rght, level in categories.order_by(
+        'name').values_list('pk', 'parent', 'lft', 'rght', 'level'):
+        children.setdefault(parent_id, []).append(pk)
+        current[pk] = (lft, rght, level)
+
+    # categories which can't be reached from the top level (because of a
+    # parent loop) are left out of the tree
+    tree = dict((pk, (0, 0, 0)) for pk in current)
+    counter = [0]
+    def visit(pk, level):
+        counter[0] += 1
+        lft = counter[0]
+        for child in children.get(pk, ()):
+            visit(child, level + 1)
+        counter[0] += 1
+        tree[pk] = (lft, counter[0], level)
+    for pk in children.get(None, ()):
+        visit(pk, 0)
+
+    manager = categories.model._default_manager
+    for pk, values in tree.items():
+        if values != current[pk]:
+            lft, rght, level = values
+            manager.filter(pk=pk).update(lft=lft, rght=rght, level=level)
+    return tree
+
+def update_category_tree(sender, instance, **kwargs):
+    tree = rebuild_category_tree(
+        Category.objects.filter(site=instance.site_id))
+    if instance.pk in tree:
+        instance.lft, instance.rght, instance.level = tree[instance.pk]
+models.signals.post_save.connect(update_category_tree,
+                                 sender=Category)
+models.signals.post_delete.connect(update_category_tree,
+                                   sender=Category)
+
+def bump_site_generation(sender, instance, **kwargs):
+    """
+    Invalidate the cached content for the site the instance belongs to.
+    Objects without a site (like Playlists) belong to the current one.
+    """
+    util.bump_site_generation(getattr(instance, 'site_id',
+                                      settings.SITE_ID))
+for sender in (Video, Category, Feed, SiteLocation):
+    models.signals.post_save.connect(bump_site_generation, sender=sender)
+    models.signals.post_delete.connect(bump_site_generation, sender=sender)
+
+def invalidate_video_relations(sender, instance, action, reverse,
+                               pk_set=None, **kwargs):
+    """
+    Invalidate the cached content (like the feed entries, which list the
+    authors and categories) of the videos whose authors or categories
+    changed.
+    """
+    if not action.startswith('post_'):
+        return
+    site_id = getattr(instance, 'site_id', settings.SITE_ID)
+    if not reverse:
+        video_ids = [instance.pk]
+    elif action == 'post_clear':
+        # we can't tell which videos were related
+        util.bump_cache_version('video_relations:site:%s' % site_id)
+        video_ids = []
+    else:
+        video_ids = pk_set
+    for video_id in video_ids:
+        util.bump_cache_version('video_relations:%s' % video_id)
+    util.bump_site_generation(site_id)
+for name in ('authors', 'categories'):
+    models.signals.m2m_changed.connect(
+        invalidate_video_relations,
+        sender=Video._meta.get_field(name).rel.through)
+
+def invalidate_video_relations_for_tags(sender, instance, **kwargs):
+    if instance.content_type_id != \
+            ContentType.objects.get_for_model(Video).pk:
+        return
+    util.bump_cache_version('video_relations:%s' % instance.object_id)
+    util.bump_site_generation(settings.SITE_ID)
+models.signals.post_save.connect(invalidate_video_relations_for_tags,
+                                 sender=TaggedItem)
+models.signals.post_delete.connect(invalidate_video_relations_for_tags,
+                                   sender=TaggedItem)
+
+def invalidate_video_relations_for_category(sender, instance, **kwargs):
+    # renaming a category changes the entries of all its videos
+    util.bump_cache_version('video_relations:site:%s' % instance.site_id)
+models.signals.post_save.connect(invalidate_video_relations_for_category,
+                                 sender=Category)
+models.signals.post_delete.connect(invalidate_video_relations_for_category,
+                                   sender=Category)
+
 def delete_comments(sender, instance, **kwargs):
     from django.contrib.comments import get_model
     get_model().objects.filter(object_pk=instance.pk,
@@ -1368,3 +2261,139 @@ def delete_comments(sender, instance, **kwargs):
                                ).delete()
 models.signals.pre_delete.connect(delete_comments,
                                   sender=Video)
+
+def create_video_tombstone(sender, instance, **kwargs):
+    VideoTombstone.objects.create(site_id=instance.site_id,
+                                  video_id=instance.pk,
+                                  guid=instance.guid)
+models.signals.post_delete.connect(create_video_tombstone,
+                                   sender=Video)
+
+def update_tag_index_for_video(sender, instance, raw=False, **kwargs):
+    if raw:
+        # loading fixtures; the TaggedItems might have been loaded first
+        VideoTagIndex.objects.sync_video(instance)
+    else:
+        VideoTagIndex.objects.filter(video=instance).update(
+            site=instance.site_id,
+            status=instance.status,
+            best_date=instance.best_date)
+models.signals.post_save.connect(update_tag_index_for_video,
+                                 sender=Video)
+
+def update_author_index_for_video(sender, instance, **kwargs):
+    VideoAuthorIndex.objects.sync_video(instance)
+models.signals.post_save.connect(update_author_index_for_video,
+                                 sender=Video)
+
+def update_author_index_for_authors(sender, instance, action, reverse,
+                                    pk_set=None, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        videos = [instance]
+    elif action == 'post_clear':
+        # the user is no longer an author of anything they didn't submit
+        VideoAuthorIndex.objects.filter(author=instance).exclude(
+            video__user=instance).delete()
+        util.bump_site_generation(settings.SITE_ID)
+        videos = []
+    else:
+        videos = Video.objects.filter(pk__in=pk_set)
+    for video in videos:
+        VideoAuthorIndex.objects.sync_video(video)
+        util.bump_site_generation(video.site_id)
+models.signals.m2m_changed.connect(
+    update_author_index_for_authors,
+    sender=Video._meta.get_field('authors').rel.through)
+
+def queue_search_update(sender, instance, **kwargs):
+    """
+    Queue the video to have its search document updated (or removed).
+    Senders other than Video are related to a video by `video_id`.
+    """
+    if isinstance(instance, Video):
+        SearchIndexQueue.add(instance.pk)
+    else:
+        SearchIndexQueue.add(instance.video_id)
+models.signals.post_save.connect(queue_search_update, sender=Video)
+models.signals.post_delete.connect(queue_search_update, sender=Video)
+
+def queue_search_update_for_tags(sender, instance, **kwargs):
+    if instance.content_type_id == \
+            ContentType.objects.get_for_model(Video).pk:
+        SearchIndexQueue.add(instance.object_id)
+models.signals.post_save.connect(queue_search_update_for_tags,
+                                 sender=TaggedItem)
+models.signals.post_delete.connect(queue_search_update_for_tags,
+                                   sender=TaggedItem)
+
+def queue_search_update_for_relation(sender, instance, action, reverse,
+                                     pk_set=None, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            SearchIndexQueue.add(instance.pk)
+    elif action == 'pre_clear':
+        # after the clear, we can't tell which videos were related
+        field = [field for field in Video._meta.many_to_many
+                 if field.rel.through is sender][0]
+        SearchIndexQueue.add(*sender._default_manager.filter(**{
+                    field.m2m_reverse_field_name(): instance}).values_list(
+                field.m2m_field_name(), flat=True))
+    elif action in ('post_add', 'post_remove'):
+        SearchIndexQueue.add(*pk_set)
+for name in ('authors', 'categories'):
+    models.signals.m2m_changed.connect(
+        queue_search_update_for_relation,
+        sender=Video._meta.get_field(name).rel.through)
+
+def add_to_tag_index(sender, instance, **kwargs):
+    if instance.content_type_id != \
+            ContentType.objects.get_for_model(Video).pk:
+        return
+    try:
+        video = Video.objects.get(pk=instance.object_id)
+    except Video.DoesNotExist:
+        return
+    if not VideoTagIndex.objects.filter(tag=instance.tag_id,
+                                        video=video).count():
+        VideoTagIndex.objects.create(tag_id=instance.tag_id, video=video,
+                                     site_id=video.site_id,
+                                     status=video.status,
+                                     best_date=video.best_date)
+models.signals.post_save.connect(add_to_tag_index,
+                                 sender=TaggedItem)
+
+def remove_from_tag_index(sender, instance, **kwargs):
+    if instance.content_type_id != \
+            ContentType.objects.get_for_model(Video).pk:
+        return
+    VideoTagIndex.objects.filter(tag=instance.tag_id,
+                                 video=instance.object_id).delete()
+models.signals.post_delete.connect(remove_from_tag_index,
+                                   sender=TaggedItem)
+
+def invalidate_counts(sender, **kwargs):
+    """
+    Throw away the cached paginator counts for the model which changed.
+    """
+    util.bump_cache_version(sender._meta.db_table)
+
+def connect_count_invalidation():
+    from django.contrib.comments import get_model
+    for sender in (Video, get_model()):
+        models.signals.post_save.connect(invalidate_counts, sender=sender)
+        models.signals.post_delete.connect(invalidate_counts, sender=sender)
+connect_count_invalidation()
+
+def invalidate_search_keywords(sender, **kwargs):
+    """
+    Throw away the search keywords which were resolved to objects of the
+    model which changed.
+    """
+    util.bump_cache_version('search_keyword:%s' % sender._meta.db_table)
+for sender in (Category, Feed, SavedSearch, Tag, User):
+    models.signals.post_save.connect(invalidate_search_keywords,
+                                     sender=sender)
+    models.signals.post_delete.connect(invalidate_search_keywords,
+                                       sender=sender)
@@ -0,0 +1,297 @@
+# Copyright 2009 - Participatory Culture Foundation
+#
+# This file is part of Miro Community.
+#
+# Miro Community is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Miro Community is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Miro Community.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import hashlib
+import re
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator, InvalidPage
+from django.db import connections
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.db.models.sql.constants import LOOKUP_SEP
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.encoding import force_unicode
+
+import simplejson
+
+from localtv.util import get_cache_version
+
+COUNT_CACHE_TIMEOUT = getattr(settings, 'LOCALTV_COUNT_CACHE_TIMEOUT', 60)
+COUNT_ESTIMATE_THRESHOLD = getattr(settings,
+                                   'LOCALTV_COUNT_ESTIMATE_THRESHOLD', 10000)
+
+EXPLAIN_ROWS_RE = re.compile(r' rows=(\d+)')
+
+class InvalidCursor(InvalidPage):
+    pass
+
+class KeysetPage(object):
+    """
+    A page of results from a KeysetPaginator.  It has the parts of the
+    django.core.paginator.Page interface that don't need to know the total
+    number of objects.
+    """
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __repr__(self):
+        return '<KeysetPage of %i objects>' % len(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    def next_cursor(self):
+        if self._has_next and self.object_list:
+            return self.paginator.cursor_for(self.object_list[-1])
+
+    def previous_cursor(self):
+        if self._has_previous and self.object_list:
+            return self.paginator.cursor_for(self.object_list[0])
+
+
+class KeysetPaginator(object):
+    """
+    Paginates a QuerySet by the values of its sort keys, rather than with
+    OFFSET/LIMIT.  Deep pages cost the same as the first one, and no COUNT(*)
+    is needed.
+
+    `keys` is a list of field names as they'd be passed to order_by(); none of
+    the fields may be NULL, and the last one should be unique (usually '-pk')
+    so that the order is stable.  A key may follow a relation the queryset is
+    already filtered through (e.g. 'tag_index__best_date'); it's compared on
+    the queryset's own join.
+    """
+    def __init__(self, queryset, per_page, keys):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.keys = [(key.lstrip('-'), key.startswith('-')) for key in keys]
+
+    def _field(self, name):
+        opts = self.queryset.model._meta
+        parts = name.split(LOOKUP_SEP)
+        for part in parts[:-1]:
+            field, model, direct, m2m = opts.get_field_by_name(part)
+            if direct:
+                opts = field.rel.to._meta
+            else:
+                opts = field.model._meta
+        if parts[-1] == 'pk':
+            return opts.pk
+        return opts.get_field(parts[-1])
+
+    def _related_keys(self):
+        return [name for name, desc in self.keys if LOOKUP_SEP in name]
+
+    def cursor_for(self, obj):
+        """
+        Returns an opaque string representing the position of the given object
+        in the ordering.
+        """
+        related = self._related_keys()
+        related_values = {}
+        if related:
+            # values across a relation aren't on the object itself
+            related_values = dict(zip(related, self.queryset.filter(
+                        pk=obj.pk).values_list(*related)[0]))
+        values = []
+        for name, desc in self.keys:
+            if name in related_values:
+                values.append(force_unicode(related_values[name]))
+            else:
+                values.append(force_unicode(getattr(obj, name)))
+        return base64.urlsafe_b64encode(simplejson.dumps(values))
+
+    def _decode(self, cursor):
+        try:
+            values = simplejson.loads(base64.urlsafe_b64decode(str(cursor)))
+            if len(values) != len(self.keys):
+                raise ValueError
+            return [self._field(name).to_python(value)
+                    for (name, desc), value in zip(self.keys, values)]
+        except Exception:
+            raise InvalidCursor('Invalid cursor: %r' % cursor)
+
+    def _filter(self, values, forward):
+        """
+        Returns a Q object matching the objects which come after (or, if
+        forward is False, before) the given key values.
+        """
+        q = None
+        for index, (name, desc) in enumerate(self.keys):
+            if desc == forward:
+                lookup = '%s__lt' % name
+            else:
+                lookup = '%s__gt' % name
+            kwargs = dict((equal_name, value)
+                          for (equal_name, equal_desc), value in
+                          zip(self.keys[:index], values[:index]))
+            kwargs[lookup] = values[index]
+            if q is None:
+                q = Q(**kwargs)
+            else:
+                q = q | Q(**kwargs)
+        return q
+
+    def _where(self, values, forward):
+        """
+        Like _filter(), but returns the WHERE clause and parameters for
+        QuerySet.extra().  The columns are looked up on the queryset's
+        existing joins; filtering through a multi-valued relation again would
+        add a second join, and return each object once per related row.
+        """
+        query = self.queryset.query.clone()
+        connection = connections[self.queryset.db]
+        qn = connection.ops.quote_name
+        columns = []
+        db_values = []
+        for (name, desc), value in zip(self.keys, values):
+            field, target, opts, joins, last, extra = query.setup_joins(
+                name.split(LOOKUP_SEP), query.get_meta(),
+                query.get_initial_alias(), False)
+            columns.append('%s.%s' % (qn(joins[-1]), qn(target.column)))
+            db_values.append(self._field(name).get_db_prep_value(
+                    value, connection=connection))
+        clauses = []
+        params = []
+        for index, (name, desc) in enumerate(self.keys):
+            if desc == forward:
+                operator = '<'
+            else:
+                operator = '>'
+            parts = ['%s = %%s' % column for column in columns[:index]]
+            parts.append('%s %s %%s' % (columns[index], operator))
+            clauses.append('(%s)' % ' AND '.join(parts))
+            params.extend(db_values[:index + 1])
+        return '(%s)' % ' OR '.join(clauses), params
+
+    def _filter_queryset(self, queryset, values, forward):
+        if self._related_keys():
+            where, params = self._where(values, forward)
+            return queryset.extra(where=[where], params=params)
+        return queryset.filter(self._filter(values, forward))
+
+    def _ordering(self, forward):
+        return [(desc == forward and '-' or '') + name
+                for name, desc in self.keys]
+
+    def page(self, after=None, before=None):
+        """
+        Returns the KeysetPage of objects following the `after` cursor, or
+        preceding the `before` cursor.  With neither, returns the first page.
+        """
+        forward = before is None
+        queryset = self.queryset
+        if after:
+            queryset = self._filter_queryset(queryset, self._decode(after),
+                                             True)
+        elif before:
+            queryset = self._filter_queryset(queryset, self._decode(before),
+                                             False)
+        object_list = list(queryset.order_by(
+                *self._ordering(forward))[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if forward:
+            return KeysetPage(object_list, self, has_more, bool(after))
+        else:
+            object_list.reverse()
+            return KeysetPage(object_list, self, True, has_more)
+
+
+class CachedCountPaginator(Paginator):
+    """
+    A Paginator which keeps the number of objects in the cache for
+    LOCALTV_COUNT_CACHE_TIMEOUT seconds, rather than running a COUNT(*) on
+    every request.  Cached counts are thrown away whenever an object of the
+    same model is saved or deleted.
+
+    Once a query has had more than LOCALTV_COUNT_ESTIMATE_THRESHOLD results,
+    it isn't counted exactly again until the last exact count expires; the
+    database's estimate (or the last exact count) is used instead, and
+    `approximate` is set so that templates can say "about N".
+    """
+    approximate = False
+
+    def _cache_keys(self):
+        queryset = self.object_list
+        compiler = queryset.query.get_compiler(queryset.db)
+        sql, params = compiler.as_sql()
+        digest = hashlib.md5(repr((sql, params))).hexdigest()
+        table = queryset.model._meta.db_table
+        return (sql, params,
+                'localtv.count:%s:%s:%s' % (table, get_cache_version(table),
+                                            digest),
+                'localtv.count.last:%s' % digest)
+
+    def _estimate(self, sql, params):
+        """
+        Returns the number of rows the database expects the query to return,
+        or None if it can't tell us.
+        """
+        connection = connections[self.object_list.db]
+        if 'postgresql' not in connection.settings_dict['ENGINE']:
+            return None
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN ' + sql, params)
+        match = EXPLAIN_ROWS_RE.search(cursor.fetchone()[0])
+        if match:
+            return int(match.group(1))
+
+    def _get_count(self):
+        if self._count is not None:
+            return self._count
+        if not isinstance(self.object_list, QuerySet):
+            # not a QuerySet, so it counts itself
+            return Paginator._get_count(self)
+        try:
+            sql, params, key, last_key = self._cache_keys()
+        except EmptyResultSet:
+            self._count = 0
+            return self._count
+
+        cached = cache.get(key)
+        if cached is None:
+            last_count = cache.get(last_key)
+            if last_count is not None and \
+                    last_count > COUNT_ESTIMATE_THRESHOLD:
+                estimate = self._estimate(sql, params)
+                if estimate is None:
+                    estimate = last_count
+                cached = (estimate, True)
+            else:
+                count = self.object_list.count()
+                cache.set(last_key, count, COUNT_CACHE_TIMEOUT * 60)
+                cached = (count, False)
+            cache.set(key, cached, COUNT_CACHE_TIMEOUT)
+        self._count, self.approximate = cached
+        return self._count
+    count = property(_get_count)
@@ -1,8 +1,9 @@
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.template import Context, loader
 
-from localtv.models import Video
+from localtv.models import (Video, bump_site_generation, queue_search_update,
+                            invalidate_search_keywords)
 
 PLAYLIST_STATUS_PRIVATE = 0
 PLAYLIST_STATUS_WAITING_FOR_MODERATION = 1
@@ -128,3 +129,13 @@ def send_notification(sender, instance, raw, created, **kwargs):
                     sitelocation=SiteLocation.objects.get_current())
 
 post_save.connect(send_notification, sender=Playlist)
+
+for sender in (Playlist, PlaylistItem):
+    post_save.connect(bump_site_generation, sender=sender)
+    post_delete.connect(bump_site_generation, sender=sender)
+
+post_save.connect(queue_search_update, sender=PlaylistItem)
+post_delete.connect(queue_search_update, sender=PlaylistItem)
+
+post_save.connect(invalidate_search_keywords, sender=Playlist)
+post_delete.connect(invalidate_search_keywords, sender=Playlist)
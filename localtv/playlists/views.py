@@ -9,6 +9,7 @@ from django.template import RequestContext
 from django.template.defaultfilters import slugify
 from django.views.generic.list_detail import object_list
 
+from localtv.decorators import cache_anonymous_page
 from localtv.models import Video
 from localtv.util import SortHeaders
 
@@ -133,6 +134,7 @@ def index(request):
                               context_instance=RequestContext(request))
 
 @playlist_enabled
+@cache_anonymous_page(15 * 60)
 def view(request, pk, slug=None, count=15):
     """
     Displays the videos of a given playlist.
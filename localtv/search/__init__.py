@@ -1,10 +1,20 @@
+import bisect
+import hashlib
+import operator
+
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.db.models import Count, Q
+from django.utils.encoding import force_unicode
 from haystack.query import SearchQuerySet, SQ
 
 from tagging.models import Tag
-from localtv.models import Feed, Category, SavedSearch
+from localtv.models import (Feed, Category, SavedSearch, Video,
+                            VideoTagIndex, VIDEO_STATUS_ACTIVE,
+                            prefetch_videos)
 from localtv.playlists.models import Playlist
+from localtv.util import get_cache_version, site_cache_key
 
 from localtv.search import shlex
 
@@ -64,31 +74,90 @@ def tokenize(query):
     while or_stack:
         yield or_stack.pop()
 
-def _get_object(model, token, *fields):
+# how long resolved keywords are cached; they're also thrown away whenever an
+# object of the same model changes
+KEYWORD_CACHE_TIMEOUT = 60 * 60 # 1 hour
+
+KEYWORDS = ('category', 'feed', 'search', 'tag', 'user', 'playlist')
+
+# how many ids of each search's results are cached, and for how long; they're
+# also thrown away whenever the site's content changes
+RESULT_CACHE_LENGTH = getattr(settings, 'LOCALTV_SEARCH_CACHE_LENGTH', 500)
+RESULT_CACHE_TIMEOUT = getattr(settings, 'LOCALTV_SEARCH_CACHE_TIMEOUT',
+                               15 * 60) # 15 minutes
+RESULT_CACHE_STATS = ('hits', 'misses')
+RESULT_CACHE_STATS_TIMEOUT = 60 * 60 * 24 * 30 # 30 days
+
+# the multi-value fields of the VideoIndex which results can be counted by
+FACET_FIELDS = ('categories', 'tags', 'authors', 'playlists')
+FACET_LIMIT = getattr(settings, 'LOCALTV_SEARCH_FACET_LIMIT', 10)
+
+# suggestions are kept in buckets by the first SUGGESTION_BUCKET_LENGTH
+# characters of the prefix; each bucket holds at most
+# SUGGESTION_BUCKET_TITLES video titles
+SUGGESTION_BUCKET_LENGTH = 2
+SUGGESTION_BUCKET_TITLES = 200
+
+def _cached_keyword(model, token, lookup):
     """
-    Tries various fields to get an object.
+    Returns the result of lookup() (the pk of the object the token refers
+    to, or None), from the cache if we've resolved the token on this site
+    before.
     """
-    default_kwargs = {}
-    try:
-        model._meta.get_field_by_name('site')
-    except Exception:
-        pass
-    else:
-        default_kwargs['site'] = Site.objects.get_current()
+    table = model._meta.db_table
+    cache_key = 'localtv.search.keyword:%s:%s:%s:%s' % (
+        table, get_cache_version('search_keyword:%s' % table),
+        settings.SITE_ID,
+        hashlib.md5(token.encode('utf8')).hexdigest())
+    cached = cache.get(cache_key)
+    if cached is None:
+        # wrapped, so that None can be cached too
+        cached = (lookup(),)
+        cache.set(cache_key, cached, KEYWORD_CACHE_TIMEOUT)
+    return cached[0]
+
+def _get_pk(model, token, *fields, **kwargs):
+    """
+    Tries various fields to find the object the token refers to, and returns
+    its primary key (or, if `value` is given, the value of that field).  The
+    fields are tried in order, each matching exactly and then ignoring case,
+    followed by the primary key.  The candidates are all loaded with a single
+    query, and the answer is cached.
+    """
+    value = kwargs.get('value', 'pk')
     if 'pk' not in fields:
         fields = fields + ('pk',)
 
-    for field in fields:
-        methods = ['exact']
-        if field != 'pk':
-            methods.append('iexact')
-        for method in methods:
-            kwargs = default_kwargs.copy()
-            kwargs['%s__%s' % (field, method)] = token
-            try:
-                return model.objects.get(**kwargs)
-            except (model.DoesNotExist, ValueError):
-                pass
+    def lookup():
+        filters = {}
+        try:
+            model._meta.get_field_by_name('site')
+        except Exception:
+            pass
+        else:
+            filters['site'] = settings.SITE_ID
+        q = []
+        for field in fields:
+            if field != 'pk':
+                q.append(Q(**{'%s__iexact' % field: token}))
+            elif token.isdigit():
+                q.append(Q(pk=int(token)))
+        if not q:
+            return None
+        candidates = list(model.objects.filter(
+                reduce(operator.or_, q), **filters).order_by(
+                'pk').values_list(value, *fields))
+        lowered = token.lower()
+        for index, field in enumerate(fields):
+            matches = [lambda v: force_unicode(v) == token]
+            if field != 'pk':
+                matches.append(lambda v: force_unicode(v).lower() == lowered)
+            for match in matches:
+                for row in candidates:
+                    if match(row[index + 1]):
+                        return row[0]
+
+    return _cached_keyword(model, token, lookup)
 
 def _tokens_to_sqs(tokens, sqs):
     """
@@ -111,47 +180,47 @@ def _tokens_to_sqs(tokens, sqs):
                 keyword, rest = token.split(':', 1)
                 keyword = keyword.lower()
                 if keyword == 'category':
-                    category = _get_object(Category, rest,
-                                           'name', 'slug', 'pk')
+                    category = _get_pk(Category, rest,
+                                       'name', 'slug', 'pk')
                     if category is not None:
-                        sqs = method(categories=category.pk)
+                        sqs = method(categories=category)
                 elif keyword == 'feed':
-                    feed = _get_object(Feed, rest,
-                                       'name', 'pk')
+                    feed = _get_pk(Feed, rest,
+                                   'name', 'pk')
                     if feed is not None:
-                        sqs = method(feed=feed.pk)
+                        sqs = method(feed=feed)
                 elif keyword == 'search':
-                    search = _get_object(SavedSearch, rest,
-                                         'query_string', 'pk')
+                    search = _get_pk(SavedSearch, rest,
+                                     'query_string', 'pk')
                     if search is not None:
-                        sqs = method(search=search.pk)
+                        sqs = method(search=search)
                 elif keyword == 'tag':
-                    tag = _get_object(Tag, rest, 'name')
+                    tag = _get_pk(Tag, rest, 'name', value='name')
                     if tag is not None:
                         sqs = method(tags=tag)
                 elif keyword == 'user':
-                    user = _get_object(User, rest,
-                                       'username', 'pk')
+                    user = _get_pk(User, rest,
+                                   'username', 'pk')
                     if user is not None:
                         if not negative:
-                            sqs = sqs.filter(SQ(user=user.pk) |
-                                             SQ(authors=user.pk))
+                            sqs = sqs.filter(SQ(user=user) |
+                                             SQ(authors=user))
                         else:
-                            sqs = sqs.exclude(user=user.pk).exclude(
-                                    authors=user.pk)
+                            sqs = sqs.exclude(user=user).exclude(
+                                    authors=user)
                 elif keyword == 'playlist':
-                    playlist = _get_object(Playlist, rest, 'pk')
+                    playlist = _get_pk(Playlist, rest, 'pk')
                     if playlist is None and '/' in rest:
                         # user/slug
                         user, slug = rest.split('/', 1)
-                        try:
-                            playlist = Playlist.objects.get(
+                        def lookup():
+                            for pk in Playlist.objects.filter(
                                 user__username=user,
-                                slug=slug)
-                        except Playlist.DoesNotExist:
-                            pass
+                                slug=slug).values_list('pk', flat=True):
+                                return pk
+                        playlist = _cached_keyword(Playlist, rest, lookup)
                     if playlist is not None:
-                        sqs = method(playlists=playlist.pk)
+                        sqs = method(playlists=playlist)
                 else:
                     sqs = method(content=clean(token))
         else:
@@ -169,3 +238,294 @@ def auto_query(query, sqs=None):
     if sqs is None:
         sqs = SearchQuerySet()
     return _tokens_to_sqs(tokenize(query), sqs)
+
+def load_videos(results, **kwargs):
+    """
+    Returns the videos for the given search results, in the same order, with
+    a single query (rather than one for each result.object).  Results whose
+    videos have been deleted, or don't match the given filters, are left out.
+    """
+    pks = [int(result.pk) for result in results if result is not None]
+    videos = Video.objects.filter(**kwargs).in_bulk(pks)
+    return prefetch_videos([videos[pk] for pk in pks if pk in videos])
+
+def normalize(tokens):
+    """
+    Returns the tokens from tokenize() in a canonical form, so that queries
+    which only differ in case or in the order of their OR groups are the
+    same.  Keyword values are left alone, since they're matched exactly
+    first.
+    """
+    normalized = []
+    for token in tokens:
+        if isinstance(token, basestring):
+            prefix = ''
+            if token.startswith('-'):
+                prefix, token = '-', token[1:]
+            keyword, sep, rest = token.partition(':')
+            if sep and keyword.lower() in KEYWORDS:
+                token = u'%s:%s' % (keyword.lower(), rest)
+            else:
+                token = token.lower()
+            normalized.append(prefix + token)
+        else:
+            normalized.append(sorted(normalize(token), key=repr))
+    return normalized
+
+
+class CachedResult(object):
+    """
+    Stands in for a SearchResult when all we have is the id.
+    """
+    def __init__(self, pk):
+        self.pk = pk
+
+    def __repr__(self):
+        return '<CachedResult: %s>' % self.pk
+
+
+class CachedSearchResults(object):
+    """
+    A ranked list of video ids from the cache, which can be used (counted,
+    sliced, and iterated over) like the SearchQuerySet it came from.  Only
+    the first RESULT_CACHE_LENGTH ids are cached; anything after that comes
+    from the SearchQuerySet, which is only built if it's needed.
+
+    `facets` maps each faceted field to a list of (value, count) pairs.
+    """
+    def __init__(self, pks, total, get_sqs, facets=None):
+        self.pks = pks
+        self.total = total
+        self.facets = facets or {}
+        self._get_sqs = get_sqs
+        self._sqs = None
+
+    @property
+    def sqs(self):
+        if self._sqs is None:
+            self._sqs = self._get_sqs()
+        return self._sqs
+
+    def __len__(self):
+        return self.total
+
+    def count(self):
+        return self.total
+
+    def __iter__(self):
+        for pk in self.pks:
+            yield CachedResult(pk)
+        if self.total > len(self.pks):
+            for result in self.sqs[len(self.pks):]:
+                yield result
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            if k.step is not None:
+                return list(self)[k]
+            if k.stop is not None and k.stop <= len(self.pks):
+                return [CachedResult(pk) for pk in self.pks[k]]
+            start = k.start or 0
+            if start < len(self.pks):
+                # the slice runs past the cached ids; only fetch the rest of
+                # it from the SearchQuerySet
+                return ([CachedResult(pk) for pk in self.pks[start:]] +
+                        list(self.sqs[len(self.pks):k.stop]))
+            return list(self.sqs[k])
+        if k < len(self.pks):
+            return CachedResult(self.pks[k])
+        return self.sqs[k]
+
+
+def _increment_stat(name):
+    cache_key = 'localtv.search_cache.stats:%s' % name
+    if not cache.add(cache_key, 1, RESULT_CACHE_STATS_TIMEOUT):
+        try:
+            cache.incr(cache_key)
+        except ValueError:
+            # expired between the add() and the incr()
+            cache.add(cache_key, 1, RESULT_CACHE_STATS_TIMEOUT)
+
+def result_cache_stats():
+    """
+    Returns a dictionary with the number of hits and misses of the search
+    result cache, and the hit rate.
+    """
+    stats = dict((name, cache.get('localtv.search_cache.stats:%s' % name, 0))
+                 for name in RESULT_CACHE_STATS)
+    total = stats['hits'] + stats['misses']
+    if total:
+        stats['hit_rate'] = float(stats['hits']) / total
+    else:
+        stats['hit_rate'] = 0.0
+    return stats
+
+def _facet_counts(counts):
+    """
+    Turns the facet counts from the search backend into a dictionary mapping
+    each field to a list of (value, count) pairs.  Backends which don't
+    support faceting (like Whoosh) give us an empty dictionary.
+    """
+    facets = {}
+    for field, values in ((counts or {}).get('fields') or {}).items():
+        if field != 'tags':
+            values = [(int(value), count) for value, count in values]
+        facets[field] = [(value, count) for value, count in values if count]
+    return facets
+
+def cached_query(query, sqs=None, facets=()):
+    """
+    Like auto_query(), but returns CachedSearchResults.  The ranked ids are
+    cached under the normalized form of the query until the site's content
+    changes.
+
+    `facets` is a list of fields (from FACET_FIELDS) to count the results by;
+    the counts come back from the backend with the results.
+    """
+    if sqs is None:
+        sqs = SearchQuerySet()
+    facets = tuple(facets)
+    for field in facets:
+        sqs = sqs.facet(field)
+    tokens = list(tokenize(query))
+    cache_key = site_cache_key(
+        settings.SITE_ID, 'search',
+        hashlib.md5(repr((normalize(tokens), facets))).hexdigest())
+    get_sqs = lambda: _tokens_to_sqs(tokens, sqs)
+    cached = cache.get(cache_key)
+    if cached is None:
+        _increment_stat('misses')
+        results = get_sqs()
+        cached = ([int(result.pk) for result in
+                   results[:RESULT_CACHE_LENGTH] if result is not None],
+                  len(results))
+        if facets:
+            # the query has already been run, so this doesn't search again
+            cached += (_facet_counts(results.query.get_facet_counts()),)
+        cache.set(cache_key, cached, RESULT_CACHE_TIMEOUT)
+    else:
+        _increment_stat('hits')
+    return CachedSearchResults(cached[0], cached[1], get_sqs,
+                               *cached[2:])
+
+def browse_counts(field, site, fallback=None):
+    """
+    Returns a dictionary mapping the values of the given VideoIndex field to
+    the number of active videos on the site which have them, from the search
+    backend's facet counts rather than COUNT queries.  If the backend can't
+    count facets, the counts come from `fallback()` instead (or, without a
+    fallback, None is returned).  Either way, the result is cached until the
+    site's content changes, so the backend is only asked once.
+    """
+    cache_key = site_cache_key(site.pk, 'facets', field)
+    counts = cache.get(cache_key)
+    if counts is None:
+        facets = _facet_counts(
+            SearchQuerySet().models(Video).facet(field).facet_counts())
+        if field in facets:
+            counts = dict(facets[field])
+        elif fallback is not None:
+            counts = fallback()
+        else:
+            counts = False # the backend can't count them
+        cache.set(cache_key, counts, RESULT_CACHE_TIMEOUT)
+    if counts is False:
+        return None
+    return counts
+
+def _facet_query(keyword, value):
+    value = force_unicode(value)
+    if ' ' in value:
+        value = u'"%s"' % value
+    return u'%s:%s' % (keyword, value)
+
+def resolve_facets(facets, query='', limit=FACET_LIMIT):
+    """
+    Turns the facet counts from CachedSearchResults into something templates
+    can show: a dictionary mapping each field to a list of up to `limit`
+    dictionaries with the object (or, for tags, the name), the number of
+    results, and the query which narrows the results down to them.  The
+    objects are loaded with one query per field.
+    """
+    models = {'categories': (Category, 'category'),
+              'authors': (User, 'user'),
+              'playlists': (Playlist, 'playlist')}
+    resolved = {}
+    for field, values in facets.items():
+        values = sorted(values, key=lambda facet: -facet[1])[:limit]
+        if field == 'tags':
+            objects = dict((value, value) for value, count in values)
+            keyword = 'tag'
+        elif field in models:
+            model, keyword = models[field]
+            objects = model.objects.in_bulk(
+                [value for value, count in values])
+        else:
+            continue
+        resolved[field] = [
+            {'object': objects[value],
+             'count': count,
+             'query': (u'%s %s' % (query,
+                                   _facet_query(keyword, value))).strip()}
+            for value, count in values if value in objects]
+    return resolved
+
+def _suggestion_bucket(site, bucket):
+    """
+    Returns the sorted list of (text, label, kind, query, count) suggestions
+    for the site whose text starts with `bucket`.  Buckets are built the
+    first time they're needed, and kept until the site's content changes.
+    """
+    cache_key = site_cache_key(site.pk, 'suggestions',
+                               hashlib.md5(bucket.encode('utf8')).hexdigest())
+    entries = cache.get(cache_key)
+    if entries is not None:
+        return entries
+
+    entries = []
+    for tag in VideoTagIndex.objects.usage(site).filter(
+        name__istartswith=bucket):
+        entries.append((tag.name.lower(), tag.name, 'tag',
+                        u'tag:%s' % tag.name, tag.count))
+    for category in Category.objects.filter(
+        site=site, name__istartswith=bucket,
+        video__status=VIDEO_STATUS_ACTIVE).annotate(count=Count('video')):
+        entries.append((category.name.lower(), category.name, 'category',
+                        u'category:%s' % category.slug, category.count))
+    for user in User.objects.filter(
+        username__istartswith=bucket, video_index__site=site,
+        video_index__status=VIDEO_STATUS_ACTIVE).annotate(
+        count=Count('video_index')):
+        entries.append((user.username.lower(), user.username, 'user',
+                        u'user:%s' % user.username, user.count))
+    for name in Video.objects.filter(
+        site=site, status=VIDEO_STATUS_ACTIVE,
+        name__istartswith=bucket).order_by('-best_date').values_list(
+        'name', flat=True)[:SUGGESTION_BUCKET_TITLES]:
+        entries.append((name.lower(), name, 'video', name, 1))
+    entries.sort()
+    cache.set(cache_key, entries)
+    return entries
+
+def suggest(prefix, site, limit=10):
+    """
+    Returns up to `limit` suggestions (as dictionaries with the label, the
+    kind of suggestion, the query to search for, and the number of videos)
+    for the given prefix of a search.  Exact matches come first, then the
+    ones with the most videos.
+    """
+    prefix = prefix.strip().lower()
+    if len(prefix) < SUGGESTION_BUCKET_LENGTH:
+        return []
+    entries = _suggestion_bucket(site, prefix[:SUGGESTION_BUCKET_LENGTH])
+    matches = []
+    for index in xrange(bisect.bisect_left(entries, (prefix,)),
+                        len(entries)):
+        entry = entries[index]
+        if not entry[0].startswith(prefix):
+            break
+        matches.append(entry)
+    matches.sort(key=lambda entry: (entry[0] != prefix, -entry[4],
+                                    len(entry[0])))
+    return [{'label': label, 'type': kind, 'query': query, 'count': count}
+            for text, label, kind, query, count in matches[:limit]]
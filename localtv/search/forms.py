@@ -7,6 +7,5 @@ class VideoSearchForm(forms.SearchForm):
     def search(self):
         self.clean()
         sqs = self.searchqueryset.models(models.Video)
-        sqs = search.auto_query(self.cleaned_data['q'], sqs)
-
-        return sqs
+        return search.cached_query(self.cleaned_data['q'], sqs,
+                                   facets=search.FACET_FIELDS)
@@ -1,4 +1,7 @@
 from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+
+import simplejson
 
 from localtv.tests import BaseTestCase
 
@@ -300,3 +303,182 @@ class AutoQueryTestCase(BaseTestCase):
             self.assertFalse('and' in result.text.lower(), result.text)
             self.assertTrue(('import' in result.text.lower()) or
                             ('repair' in result.text.lower()), result.text)
+
+    def test_load_videos(self):
+        """
+        search.load_videos() should return the videos for the results in the
+        same order, leaving out the ones which don't match the filters.
+        """
+        self._rebuild_index()
+        results = list(search.auto_query('blender')[:10])
+        self.assertEquals(search.load_videos(results),
+                          [result.object for result in results])
+
+        rejected = results[0].object
+        rejected.status = models.VIDEO_STATUS_REJECTED
+        rejected.save()
+        self.assertEquals(
+            search.load_videos(results, status=models.VIDEO_STATUS_ACTIVE),
+            [result.object for result in results[1:]])
+
+    def test_keyword_cache(self):
+        """
+        Keywords should be resolved with at most one query, and then served
+        from the cache until an object of that model changes.
+        """
+        from django.conf import settings
+        from django.db import connection
+        from localtv.search import _get_pk
+
+        old_DEBUG = settings.DEBUG
+        settings.DEBUG = True # so that queries are logged
+        try:
+            connection.queries = []
+            self.assertEquals(_get_pk(models.Category, 'linux',
+                                      'name', 'slug'), 2)
+            self.assertEquals(len(connection.queries), 1)
+
+            connection.queries = []
+            self.assertEquals(_get_pk(models.Category, 'linux',
+                                      'name', 'slug'), 2)
+            self.assertEquals(_get_pk(models.Category, 'missing',
+                                      'name', 'slug'), None)
+            self.assertEquals(_get_pk(models.Category, 'missing',
+                                      'name', 'slug'), None)
+            self.assertEquals(len(connection.queries), 1)
+        finally:
+            settings.DEBUG = old_DEBUG
+
+        models.Category.objects.create(site=self.site_location.site,
+                                       name='Missing', slug='missing')
+        self.assertNotEquals(_get_pk(models.Category, 'missing',
+                                     'name', 'slug'), None)
+
+    def test_normalize(self):
+        """
+        Queries which only differ in case or in the order of their OR groups
+        should normalize to the same thing.
+        """
+        self.assertEquals(
+            search.normalize(search.tokenize('Blender {Render Elephant}')),
+            search.normalize(search.tokenize('blender {elephant render}')))
+        self.assertEquals(
+            search.normalize(search.tokenize('Category:Miro -Tag:Foo')),
+            [u'category:Miro', u'-tag:Foo'])
+
+    def test_result_cache(self):
+        """
+        search.cached_query() should return the same ranked results as
+        auto_query(), and serve equivalent queries from the cache until the
+        content changes.
+        """
+        self._rebuild_index()
+        expected = [int(result.pk) for result in
+                    search.auto_query('blender {elephant render}')]
+
+        results = search.cached_query('blender {elephant render}')
+        self.assertEquals([int(result.pk) for result in results], expected)
+        self.assertEquals(len(results), len(expected))
+        self.assertEquals(search.result_cache_stats()['misses'], 1)
+
+        results = search.cached_query('Blender {Render Elephant}')
+        self.assertEquals([int(result.pk) for result in results[:5]],
+                          expected[:5])
+        stats = search.result_cache_stats()
+        self.assertEquals(stats['hits'], 1)
+        self.assertEquals(stats['hit_rate'], 0.5)
+
+        models.Video.objects.get(pk=expected[0]).save()
+        search.cached_query('blender {elephant render}')
+        self.assertEquals(search.result_cache_stats()['misses'], 2)
+
+    def test_cached_results_slice(self):
+        """
+        A slice of CachedSearchResults which runs past the cached ids should
+        only fetch the rest of the slice from the SearchQuerySet.
+        """
+        class FakeSearchQuerySet(object):
+            slices = []
+            def __getitem__(self, k):
+                self.slices.append(k)
+                return range(100)[k]
+
+        sqs = FakeSearchQuerySet()
+        results = search.CachedSearchResults([0, 1, 2], 100, lambda: sqs)
+        page = results[1:6]
+        self.assertEquals([int(result.pk) for result in page[:2]], [1, 2])
+        self.assertEquals(page[2:], [3, 4, 5])
+        self.assertEquals(sqs.slices, [slice(3, 6)])
+
+    def test_browse_counts_cached(self):
+        """
+        search.browse_counts() should only ask the backend (or, if it can't
+        count facets, the fallback) once until the content changes.
+        """
+        calls = []
+        def fallback():
+            calls.append(True)
+            return {1: 5}
+        site = models.SiteLocation.objects.get_current().site
+        counts = search.browse_counts('category_tree', site,
+                                      fallback=fallback)
+        self.assertEquals(search.browse_counts('category_tree', site,
+                                               fallback=fallback), counts)
+        self.assertTrue(len(calls) <= 1)
+
+    def test_resolve_facets(self):
+        """
+        search.resolve_facets() should load the objects for the facet counts,
+        most results first, with the query which narrows the search down to
+        each of them.
+        """
+        user = User.objects.get(username='user')
+        facets = search.resolve_facets({
+                'categories': [(1, 2), (2, 5), (12345, 1)],
+                'tags': [(u'two words', 3)],
+                'authors': [(user.pk, 1)]}, 'blender')
+        self.assertEquals(
+            [(facet['object'], facet['count'], facet['query'])
+             for facet in facets['categories']],
+            [(models.Category.objects.get(pk=2), 5, u'blender category:2'),
+             (models.Category.objects.get(pk=1), 2, u'blender category:1')])
+        self.assertEquals(facets['tags'],
+                          [{'object': u'two words', 'count': 3,
+                            'query': u'blender tag:"two words"'}])
+        self.assertEquals(facets['authors'][0]['object'], user)
+        self.assertEquals(facets['authors'][0]['query'],
+                          u'blender user:%i' % user.pk)
+
+    def test_suggest(self):
+        """
+        search.suggest() should return the tags, categories, users and video
+        titles starting with the prefix, exact matches first and then by
+        number of videos, and forget them when the content changes.
+        """
+        site = self.site_location.site
+        video = models.Video.objects.filter(
+            site=site, status=models.VIDEO_STATUS_ACTIVE)[0]
+        video.categories.add(models.Category.objects.get(slug='linux'))
+
+        self.assertEquals(search.suggest('l', site), [])
+        suggestions = search.suggest('Linux', site)
+        self.assertEquals(suggestions[0], {'label': u'Linux',
+                                           'type': 'category',
+                                           'query': u'category:linux',
+                                           'count': 1})
+        for suggestion in suggestions:
+            self.assertTrue(suggestion['label'].lower().startswith('linux'))
+        counts = [suggestion['count'] for suggestion in suggestions[1:]]
+        self.assertEquals(counts, sorted(counts, reverse=True))
+
+        video.name = 'Linuxy Unique Title'
+        video.save()
+        self.assertTrue({'label': u'Linuxy Unique Title', 'type': 'video',
+                         'query': u'Linuxy Unique Title', 'count': 1} in
+                        search.suggest('linuxy', site))
+
+        response = self.client.get(reverse('localtv_search_suggestions'),
+                                   {'q': 'linuxy'})
+        self.assertEquals(response['Content-Type'], 'application/json')
+        self.assertEquals(simplejson.loads(response.content)[0]['label'],
+                          u'Linuxy Unique Title')
@@ -1,8 +1,11 @@
+from django.db.models import Manager
 from django.utils.encoding import force_unicode
 
 from haystack import indexes
 from haystack import site
-from localtv.models import Video, VIDEO_STATUS_ACTIVE
+from localtv.models import (Category, Video, VIDEO_STATUS_ACTIVE,
+                            prefetch_videos)
+from localtv.playlists.models import PlaylistItem
 
 
 class VideoIndex(indexes.SearchIndex):
@@ -12,6 +15,8 @@ class VideoIndex(indexes.SearchIndex):
     user = indexes.IntegerField(model_attr='user__pk', null=True)
     tags = indexes.MultiValueField()
     categories = indexes.MultiValueField()
+    # the categories and all their ancestors, for counting whole subtrees
+    category_tree = indexes.MultiValueField()
     authors = indexes.MultiValueField()
     playlists = indexes.MultiValueField()
 
@@ -24,9 +29,57 @@ class VideoIndex(indexes.SearchIndex):
     def get_updated_field(self):
         return 'when_modified'
 
+    def preload(self, videos, category_trees=None):
+        """
+        Loads the related objects the index uses for a whole list of videos
+        at once, so that preparing them doesn't need any more queries.
+        `category_trees` is the result of category_trees(), if the caller
+        has already built it.  Returns the videos as a list.
+        """
+        videos = prefetch_videos(videos)
+        playlists = dict((video.pk, []) for video in videos)
+        for video_id, playlist_id in PlaylistItem.objects.filter(
+            video__in=playlists.keys()).values_list('video', 'playlist'):
+            playlists[video_id].append(playlist_id)
+        if category_trees is None:
+            category_trees = self.category_trees(
+                set(video.site_id for video in videos))
+        for video in videos:
+            video.__dict__['_prefetched_playlist_ids'] = playlists[video.pk]
+            # only the video's own tree, so the videos stay small to pickle
+            video.__dict__['_prefetched_category_tree'] = \
+                self._category_tree(video, category_trees)
+        return videos
+
+    def category_trees(self, site_ids):
+        """
+        Returns a dictionary mapping the pk of each category on the given
+        sites to the pks of the category and its ancestors.
+        """
+        trees = {}
+        ancestors = [] # (pk, site, rght) of the categories we're inside
+        for pk, site, lft, rght in Category.objects.filter(
+            site__in=site_ids).order_by('site', 'lft').values_list(
+            'pk', 'site', 'lft', 'rght'):
+            while ancestors and (ancestors[-1][1] != site or
+                                 ancestors[-1][2] < lft):
+                ancestors.pop()
+            ancestors.append((pk, site, rght))
+            trees[pk] = [ancestor[0] for ancestor in ancestors]
+        return trees
+
+    def _category_tree(self, video, category_trees):
+        pks = set()
+        for pk in self.prepare_categories(video):
+            pks.update(category_trees.get(pk, [pk]))
+        return sorted(pks)
+
     def _prepare_field(self, video, field, attr='pk', normalize=int):
-        return [normalize(getattr(rel, attr))
-                for rel in getattr(video, field).all()]
+        related = getattr(video, field)
+        if isinstance(related, Manager):
+            related = related.all()
+        # iterate over tags directly, so the prefetched ones are used
+        return [normalize(getattr(rel, attr)) for rel in related]
 
     def prepare_tags(self, video):
         return self._prepare_field(video, 'tags', 'name', force_unicode)
@@ -34,10 +87,18 @@ class VideoIndex(indexes.SearchIndex):
     def prepare_categories(self, video):
         return self._prepare_field(video, 'categories')
 
+    def prepare_category_tree(self, video):
+        if '_prefetched_category_tree' in video.__dict__:
+            return list(video._prefetched_category_tree)
+        return self._category_tree(video,
+                                   self.category_trees([video.site_id]))
+
     def prepare_authors(self, video):
         return self._prepare_field(video, 'authors')
 
     def prepare_playlists(self, video):
+        if '_prefetched_playlist_ids' in video.__dict__:
+            return list(video._prefetched_playlist_ids)
         return self._prepare_field(video, 'playlists')
 
 site.register(Video, VideoIndex)
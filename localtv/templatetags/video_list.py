@@ -2,7 +2,6 @@ import datetime
 
 from django import template
 from django.contrib.auth.models import User
-from django.db.models import Q
 
 from tagging.models import Tag
 
@@ -124,9 +123,9 @@ class TagVideoListNode(BaseVideoListNode):
                 tag = Tag.objects.get(name=self.item)
             except Tag.DoesNotExist:
                 return models.Video.objects.none()
-        return models.Video.tagged.with_all(tag).filter(
-            site=context['sitelocation'].site,
-            status=models.VIDEO_STATUS_ACTIVE)
+        return models.Video.objects.with_tag(
+            tag, context['sitelocation'].site).order_by(
+            '-tag_index__best_date')
 
 class UserVideoListNode(BaseVideoListNode):
     """
@@ -142,10 +141,8 @@ class UserVideoListNode(BaseVideoListNode):
                 author = User.objects.get(username=self.item)
             except User.DoesNotExist:
                 return models.Video.objects.none()
-        return models.Video.objects.filter(
-            Q(authors=author) | Q(user=author),
-            site=context['sitelocation'].site,
-            status=models.VIDEO_STATUS_ACTIVE).distinct()
+        return models.Video.objects.by_author(author,
+                                             context['sitelocation'].site)
 
 register.tag('get_video_list_new', NewVideoListNode.handle_token)
 register.tag('get_video_list_popular', PopularVideoListNode.handle_token)
@@ -22,6 +22,7 @@ import tempfile
 from urllib import quote_plus, urlencode
 
 import feedparser
+import simplejson
 import vidscraper
 
 from django.conf import settings
@@ -30,19 +31,28 @@ from django.contrib.comments import get_model, get_form, get_form_target
 Comment = get_model()
 CommentForm = get_form()
 
+from django.core.cache import cache
 from django.core.files.base import File
 from django.core.files import storage
 from django.core import mail
 from django.core.urlresolvers import reverse
+from django.db import connection, transaction
 from django.db.models import Q
 from django.http import HttpRequest
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
 
 from haystack.query import SearchQuerySet
+from tagging.models import Tag
 
 from localtv import models
+from localtv import pagination
 from localtv import util
+from localtv.management.commands import compact_watches
+from localtv.management.commands import compute_related_videos
+from localtv.management.commands import prune_tombstones
+from localtv.management.commands import rebuild_search_index
+from localtv.management.commands import update_search_queue
 
 from notification import models as notification
 
@@ -63,6 +73,10 @@ class BaseTestCase(TestCase):
         TestCase.setUp(self)
         self.old_site_id = settings.SITE_ID
         settings.SITE_ID = 1
+        # the page cache would hide the templates and context from the tests
+        self.old_PAGE_CACHE = getattr(settings, 'LOCALTV_PAGE_CACHE', False)
+        settings.LOCALTV_PAGE_CACHE = False
+        cache.clear()
         models.SiteLocation.objects.clear_cache()
         self.site_location = models.SiteLocation.objects.get_current()
 
@@ -75,6 +89,7 @@ class BaseTestCase(TestCase):
     def tearDown(self):
         TestCase.tearDown(self)
         settings.SITE_ID = self.old_site_id
+        settings.LOCALTV_PAGE_CACHE = self.old_PAGE_CACHE
         settings.MEDIA_ROOT = self.old_MEDIA_ROOT
         Profile.__dict__['logo'].field.storage = \
             storage.default_storage
@@ -582,6 +597,26 @@ class ViewTestCase(BaseTestCase):
         index = site.get_index(models.Video)
         index.reindex()
 
+    def test_cache_invalidator(self):
+        """
+        The cache_invalidator in the context should change whenever content on
+        the site changes, and not otherwise.
+        """
+        c = Client()
+        first = c.get(reverse('localtv_index')).context['cache_invalidator']
+        self.assertEquals(
+            c.get(reverse('localtv_index')).context['cache_invalidator'],
+            first)
+
+        models.Category.objects.get(pk=1).save()
+        second = c.get(reverse('localtv_index')).context['cache_invalidator']
+        self.assertNotEquals(second, first)
+
+        models.Video.objects.get(pk=1).delete()
+        self.assertNotEquals(
+            c.get(reverse('localtv_index')).context['cache_invalidator'],
+            second)
+
     def test_index(self):
         """
         The index view should render the 'localtv/index.html'.  The context
@@ -1009,6 +1044,9 @@ class ViewTestCase(BaseTestCase):
         self.assertEquals(response.context['pages'], 1)
         self.assertEquals(list(response.context['page_obj'].object_list),
                           list(models.Category.objects.filter(parent=None)))
+        for category in response.context['category_list']:
+            self.assertEquals(category.video_count,
+                              category.approved_set.count())
 
     def test_category(self):
         """
@@ -1026,8 +1064,8 @@ class ViewTestCase(BaseTestCase):
     def test_author_index(self):
         """
         The author_index view should render the
-        'localtv/author_list.html' template and include the authors in
-        the context.
+        'localtv/author_list.html' template and include a page of the authors
+        in the context, with the number of videos each one has.
         """
         c = Client()
         response = c.get(reverse('localtv_author_index'))
@@ -1036,6 +1074,11 @@ class ViewTestCase(BaseTestCase):
         self.assertStatusCodeEquals(response, 200)
         self.assertEquals(list(response.context['authors']),
                           list(User.objects.all()))
+        for author in response.context['authors']:
+            self.assertEquals(author.video_count,
+                              models.Video.objects.filter(
+                    Q(user=author) | Q(authors=author),
+                    status=models.VIDEO_STATUS_ACTIVE).distinct().count())
 
     def test_author(self):
         """
@@ -1056,6 +1099,38 @@ class ViewTestCase(BaseTestCase):
                     Q(user=author) | Q(authors=author),
                     status=models.VIDEO_STATUS_ACTIVE)))
 
+    def test_author_index_maintained(self):
+        """
+        Author pages should follow changes to a video's authors and
+        submitter.
+        """
+        author = User.objects.get(username='user')
+        site = self.site_location.site
+        video = models.Video.objects.filter(
+            status=models.VIDEO_STATUS_ACTIVE).exclude(user=author)[0]
+        self.assertFalse(video in models.Video.objects.by_author(author,
+                                                                  site))
+
+        video.authors.add(author)
+        self.assertTrue(video in models.Video.objects.by_author(author, site))
+
+        video.authors.remove(author)
+        video.user = author
+        video.save()
+        self.assertTrue(video in models.Video.objects.by_author(author, site))
+
+        video.status = models.VIDEO_STATUS_REJECTED
+        video.save()
+        self.assertFalse(video in models.Video.objects.by_author(author,
+                                                                  site))
+
+        models.VideoAuthorIndex.objects.rebuild()
+        self.assertEquals(
+            set(models.Video.objects.by_author(author, site)),
+            set(models.Video.objects.filter(
+                    Q(user=author) | Q(authors=author),
+                    status=models.VIDEO_STATUS_ACTIVE)))
+
 
 # -----------------------------------------------------------------------------
 # Listing Views tests
@@ -1094,6 +1169,241 @@ class ListingViewTestCase(BaseTestCase):
                           list(models.Video.objects.new(
                     status=models.VIDEO_STATUS_ACTIVE)[:15]))
 
+    def test_new_videos_cursor(self):
+        """
+        If the request has an 'after' cursor, the new_videos view should
+        paginate by the sort keys, with links to the next and previous pages
+        and no page count.
+        """
+        videos = list(models.Video.objects.new(
+                status=models.VIDEO_STATUS_ACTIVE).order_by('-best_date',
+                                                             '-pk'))
+        c = Client()
+        response = c.get(reverse('localtv_list_new'), {'after': ''})
+        self.assertStatusCodeEquals(response, 200)
+        self.assertTrue(response.context['cursor_pagination'])
+        self.assertFalse('pages' in response.context)
+        self.assertEquals(list(response.context['video_list']), videos[:15])
+        self.assertFalse('previous_page_url' in response.context)
+
+        response = c.get(response.context['next_page_url'])
+        self.assertStatusCodeEquals(response, 200)
+        self.assertEquals(list(response.context['video_list']),
+                          videos[15:30])
+        self.assertFalse('next_page_url' in response.context)
+
+        response = c.get(response.context['previous_page_url'])
+        self.assertStatusCodeEquals(response, 200)
+        self.assertEquals(list(response.context['video_list']), videos[:15])
+        self.assertFalse('previous_page_url' in response.context)
+        self.assertTrue('next_page_url' in response.context)
+
+    def test_new_videos_numbered_links_cursor(self):
+        """
+        A numbered page of the new_videos view should link to the next page
+        with an 'after' cursor, so that following the links doesn't use page
+        numbers.
+        """
+        videos = list(models.Video.objects.new(
+                status=models.VIDEO_STATUS_ACTIVE).order_by('-best_date',
+                                                             '-pk'))
+        c = Client()
+        response = c.get(reverse('localtv_list_new'))
+        self.assertStatusCodeEquals(response, 200)
+        self.assertFalse(response.context.get('cursor_pagination'))
+        self.assertEquals(list(response.context['video_list']), videos[:15])
+        self.assertFalse('previous_page_url' in response.context)
+        self.assertTrue('after=' in response.context['next_page_url'])
+
+        response = c.get(response.context['next_page_url'])
+        self.assertStatusCodeEquals(response, 200)
+        self.assertTrue(response.context['cursor_pagination'])
+        self.assertEquals(list(response.context['video_list']),
+                          videos[15:30])
+
+        response = c.get(reverse('localtv_list_new'), {'page': 2})
+        self.assertStatusCodeEquals(response, 200)
+        self.assertTrue('before=' in response.context['previous_page_url'])
+        response = c.get(response.context['previous_page_url'])
+        self.assertEquals(list(response.context['video_list']), videos[:15])
+
+    def test_page_cache(self):
+        """
+        Anonymous requests for the listings should be cached until the site's
+        content changes, with an ETag which can be used for conditional GETs.
+        Logged-in users shouldn't get cached pages.
+        """
+        settings.LOCALTV_PAGE_CACHE = True
+        c = Client()
+        response = c.get(reverse('localtv_list_new'))
+        self.assertStatusCodeEquals(response, 200)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        response = c.get(reverse('localtv_list_new'))
+        self.assertEquals(response.template, None) # from the cache
+        self.assertEquals(response['ETag'], etag)
+
+        response = c.get(reverse('localtv_list_new'),
+                         HTTP_IF_NONE_MATCH=etag)
+        self.assertStatusCodeEquals(response, 304)
+        self.assertEquals(response.content, '')
+
+        video = models.Video.objects.new(
+            site=self.site_location.site,
+            status=models.VIDEO_STATUS_ACTIVE)[0]
+        video.name = 'Changed Name'
+        video.save()
+        response = c.get(reverse('localtv_list_new'),
+                         HTTP_IF_NONE_MATCH=etag)
+        self.assertStatusCodeEquals(response, 200)
+        self.assertTrue('Changed Name' in response.content)
+        self.assertNotEquals(response['ETag'], etag)
+
+        c.login(username='user', password='password')
+        response = c.get(reverse('localtv_list_new'))
+        self.assertStatusCodeEquals(response, 200)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertEquals(response.template[0].name,
+                          'localtv/video_listing_new.html')
+
+    def test_feed_cache(self):
+        """
+        Feeds should be cached without regard to unimportant query parameters
+        and the JSONP callback, and should support conditional GETs.
+        """
+        c = Client()
+        response = c.get('/feeds/json/new/', {'utm_source': 'test'})
+        self.assertStatusCodeEquals(response, 200)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        response = c.get('/feeds/json/new/', HTTP_IF_NONE_MATCH=etag)
+        self.assertStatusCodeEquals(response, 304)
+
+        response = c.get('/feeds/json/new/', {'jsoncallback': 'callback'})
+        self.assertStatusCodeEquals(response, 200)
+        self.assertTrue(response.content.startswith('callback('))
+        self.assertNotEquals(response['ETag'], etag)
+        response = c.get('/feeds/json/new/', {'jsoncallback': 'callback'},
+                         HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertStatusCodeEquals(response, 304)
+
+    def test_feed_entry_cache(self):
+        """
+        Feed entries should be rendered once for each version of the video
+        (as given by when_modified), and shared between the feeds.
+        """
+        video = models.Video.objects.new(
+            status=models.VIDEO_STATUS_ACTIVE)[0]
+        c = Client()
+        parsed = feedparser.parse(c.get('/feeds/new/').content)
+        self.assertEquals(parsed.entries[0].title.strip(), video.name)
+
+        # update() doesn't touch when_modified, so the old entry is used
+        models.Video.objects.filter(pk=video.pk).update(name='Changed Name')
+        util.bump_site_generation(video.site_id)
+        parsed = feedparser.parse(c.get('/feeds/new/').content)
+        self.assertEquals(parsed.entries[0].title.strip(), video.name)
+
+        models.Video.objects.get(pk=video.pk).save()
+        parsed = feedparser.parse(c.get('/feeds/new/').content)
+        self.assertEquals(parsed.entries[0].title.strip(), 'Changed Name')
+
+    def test_feed_entry_cache_relations(self):
+        """
+        Cached feed entries should be thrown away when the video's tags or
+        categories change, or one of its categories is renamed.
+        """
+        video = models.Video.objects.new(
+            status=models.VIDEO_STATUS_ACTIVE)[0]
+        c = Client()
+        c.get('/feeds/new/')
+
+        video.tags = 'feedentrytag'
+        parsed = feedparser.parse(c.get('/feeds/new/').content)
+        self.assertTrue('feedentrytag' in parsed.entries[0].description)
+
+        category = models.Category.objects.create(
+            site=self.site_location.site, name='Feed Entry Category',
+            slug='feed-entry-category')
+        video.categories.add(category)
+        parsed = feedparser.parse(c.get('/feeds/new/').content)
+        self.assertTrue('Feed Entry Category' in
+                        parsed.entries[0].description)
+
+        category.name = 'Renamed Category'
+        category.save()
+        parsed = feedparser.parse(c.get('/feeds/new/').content)
+        self.assertTrue('Renamed Category' in parsed.entries[0].description)
+
+    def test_changes(self):
+        """
+        The changes feed should page through all the active videos, and then
+        return only the videos which were changed or removed since the
+        cursor.
+        """
+        c = Client()
+        changed = []
+        cursor = ''
+        more = True
+        while more:
+            response = c.get(reverse('localtv_feeds_changes'),
+                             {'after': cursor, 'limit': 3,
+                              'fields': 'id,name'})
+            self.assertStatusCodeEquals(response, 200)
+            data = simplejson.loads(response.content)
+            self.assertEquals(data['fields'], ['id', 'name'])
+            changed.extend(id for id, name in data['changed'])
+            cursor, more = data['cursor'], data['more']
+        self.assertEquals(sorted(changed),
+                          sorted(models.Video.objects.filter(
+                    site=settings.SITE_ID,
+                    status=models.VIDEO_STATUS_ACTIVE).values_list(
+                    'pk', flat=True)))
+
+        response = c.get(reverse('localtv_feeds_changes'), {'after': cursor})
+        data = simplejson.loads(response.content)
+        self.assertEquals(data['changed'], [])
+        self.assertEquals(data['removed'], [])
+        self.assertEquals(data['cursor'], cursor)
+
+        rejected, deleted, edited = models.Video.objects.filter(
+            site=settings.SITE_ID,
+            status=models.VIDEO_STATUS_ACTIVE)[:3]
+        rejected.status = models.VIDEO_STATUS_REJECTED
+        rejected.save()
+        deleted.delete()
+        edited.name = 'Edited'
+        edited.save()
+
+        response = c.get(reverse('localtv_feeds_changes'),
+                         {'after': cursor, 'fields': 'id,name'})
+        data = simplejson.loads(response.content)
+        self.assertEquals(data['changed'], [[edited.pk, 'Edited']])
+        self.assertEquals(sorted(data['removed']),
+                          sorted([rejected.pk, deleted.pk]))
+
+    def test_changes_invalid(self):
+        """
+        Unknown fields and invalid cursors should give a 400.
+        """
+        c = Client()
+        response = c.get(reverse('localtv_feeds_changes'),
+                         {'fields': 'id,password'})
+        self.assertStatusCodeEquals(response, 400)
+        response = c.get(reverse('localtv_feeds_changes'),
+                         {'after': 'invalid'})
+        self.assertStatusCodeEquals(response, 400)
+
+    def test_new_videos_invalid_cursor(self):
+        """
+        An invalid cursor should give a 404, like an invalid page number.
+        """
+        c = Client()
+        response = c.get(reverse('localtv_list_new'), {'after': 'invalid'})
+        self.assertStatusCodeEquals(response, 404)
+
     def test_popular_videos(self):
         """
         The popular_videos view should render the
@@ -1157,6 +1467,32 @@ class ListingViewTestCase(BaseTestCase):
         self.assertEquals(list(response.context['page_obj'].object_list),
                           [video])
 
+    def test_tag_videos_cursor(self):
+        """
+        The tag_videos view should be ordered by the tag index's best_date,
+        and following its cursor links should give each video once, even when
+        the videos have other tags.
+        """
+        for video in models.Video.objects.filter(
+            status=models.VIDEO_STATUS_ACTIVE)[:5]:
+            video.tags = 'tag1 tag2 tag3'
+            video.save()
+        videos = list(models.Video.objects.with_tag(
+                Tag.objects.get(name='tag1'),
+                self.site_location.site).order_by('-best_date', '-pk'))
+        self.assertEquals(len(videos), 5)
+
+        c = Client()
+        response = c.get(reverse('localtv_list_tag', args=['tag1']),
+                         {'count': 2})
+        self.assertStatusCodeEquals(response, 200)
+        seen = list(response.context['video_list'])
+        while 'next_page_url' in response.context:
+            response = c.get(response.context['next_page_url'])
+            self.assertStatusCodeEquals(response, 200)
+            seen.extend(response.context['video_list'])
+        self.assertEquals(seen, videos)
+
     def test_feed_videos(self):
         """
         The feed_videos view should render the
@@ -1422,6 +1758,57 @@ class CommentModerationTestCase(BaseTestCase):
         self.assertEquals(mail.outbox[0].recipients(),
                           [admin.email])
 
+# -----------------------------------------------------------------------------
+# SiteLocation model tests
+# -----------------------------------------------------------------------------
+
+class SiteLocationModelTestCase(BaseTestCase):
+
+    def test_get_current_shared_cache(self):
+        """
+        SiteLocation.objects.get_current() should keep using the cached
+        SiteLocation after the end of a request, until a SiteLocation is saved
+        or the cache is cleared.
+        """
+        models.SiteLocation.objects.filter(pk=self.site_location.pk).update(
+            tagline='Updated')
+        models.SiteLocation.objects.clear_local_cache()
+        self.assertEquals(models.SiteLocation.objects.get_current().tagline,
+                          self.site_location.tagline)
+
+        models.SiteLocation.objects.clear_cache()
+        self.assertEquals(models.SiteLocation.objects.get_current().tagline,
+                          'Updated')
+
+        site_location = models.SiteLocation.objects.get(
+            pk=self.site_location.pk)
+        site_location.tagline = 'Saved'
+        site_location.save()
+        models.SiteLocation.objects.clear_local_cache()
+        self.assertEquals(models.SiteLocation.objects.get_current().tagline,
+                          'Saved')
+
+    def test_user_is_admin(self):
+        """
+        SiteLocation.user_is_admin() should use the cached admin ids, which are
+        invalidated when the admins change.
+        """
+        user = User.objects.get(username='user')
+        admin = User.objects.get(username='admin')
+        self.assertTrue(self.site_location.user_is_admin(admin))
+        self.assertFalse(self.site_location.user_is_admin(user))
+        self.assertEquals(self.site_location.admin_ids(),
+                          frozenset([admin.pk]))
+
+        self.site_location.admins.add(user)
+        models.SiteLocation.objects.clear_local_cache()
+        self.assertTrue(models.SiteLocation.objects.get_current().user_is_admin(
+                user))
+
+        self.site_location.admins.remove(admin)
+        self.assertFalse(self.site_location.user_is_admin(admin))
+
+
 # -----------------------------------------------------------------------------
 # Video model tests
 # -----------------------------------------------------------------------------
@@ -1503,6 +1890,149 @@ localtv_video.when_submitted)"""}).order_by('-date')))
 COALESCE(localtv_video.when_approved,localtv_video.when_submitted)"""}
                                                           ).order_by('-date')))
 
+    def test_best_date(self):
+        """
+        Video.best_date and Video.best_posted_date should be kept up to date
+        with the dates they're based on when the video is saved.
+        """
+        v = models.Video.objects.get(pk=11)
+        self.assertEquals(v.best_date, v.when_published)
+        self.assertEquals(v.best_posted_date, v.when_approved)
+
+        v.when_published = None
+        v.when_approved = None
+        v.save()
+        v = models.Video.objects.get(pk=11)
+        self.assertEquals(v.best_date, v.when_submitted)
+        self.assertEquals(v.best_posted_date, v.when_submitted)
+
+    def test_prefetch_videos(self):
+        """
+        models.prefetch_videos() should load the related objects for a list
+        of videos, so that using them doesn't need any more queries.
+        """
+        category = models.Category.objects.create(
+            site=self.site_location.site, name='Category', slug='category')
+        user = User.objects.get(username='user')
+        v = models.Video.objects.get(pk=11)
+        v.user = user
+        v.save()
+        v.authors.add(user)
+        v.categories.add(category)
+        v.tags = 'tag1 tag2'
+
+        videos = models.prefetch_videos(
+            models.Video.objects.filter(pk__in=[11, 12]).order_by('pk'))
+        old_DEBUG = settings.DEBUG
+        settings.DEBUG = True # so that queries are logged
+        connection.queries = []
+        try:
+            self.assertEquals(videos[0].site, self.site_location.site)
+            self.assertEquals(videos[0].user, user)
+            self.assertEquals(list(videos[0].authors.all()), [user])
+            self.assertEquals(videos[0].authors.count(), 1)
+            self.assertEquals(list(videos[0].categories.all()), [category])
+            self.assertEquals([tag.name for tag in videos[0].tags],
+                              ['tag1', 'tag2'])
+            self.assertEquals(list(videos[1].authors.all()), [])
+            self.assertEquals(list(videos[1].tags), [])
+            self.assertEquals(connection.queries, [])
+        finally:
+            settings.DEBUG = old_DEBUG
+
+        # changing the relations throws the prefetched objects away
+        videos[0].authors.clear()
+        self.assertEquals(list(videos[0].authors.all()), [])
+        videos[0].tags = 'tag3'
+        self.assertEquals([tag.name for tag in videos[0].tags], ['tag3'])
+
+    def test_tag_index(self):
+        """
+        The VideoTagIndex should follow changes to the tags and status of the
+        videos, so that Video.objects.with_tag() and
+        VideoTagIndex.objects.usage() give the same results as going through
+        TaggedItem.
+        """
+        site = self.site_location.site
+        v1 = models.Video.objects.get(pk=12)
+        v2 = models.Video.objects.get(pk=13)
+        v1.tags = 'tag1 tag2'
+        v2.tags = 'tag1'
+        tag1, tag2 = Tag.objects.get(name='tag1'), Tag.objects.get(name='tag2')
+
+        self.assertEquals(set(models.Video.objects.with_tag(tag1, site)),
+                          set([v1, v2]))
+        self.assertEquals(list(models.Video.objects.with_tag(tag2, site)),
+                          [v1])
+        self.assertEquals(
+            dict((tag.name, tag.count) for tag in
+                 models.VideoTagIndex.objects.usage(site)),
+            {'tag1': 2, 'tag2': 1})
+
+        v2.status = models.VIDEO_STATUS_REJECTED
+        v2.save()
+        self.assertEquals(list(models.Video.objects.with_tag(tag1, site)),
+                          [v1])
+        self.assertEquals(list(models.Video.objects.with_tag(
+                    tag1, site, status=models.VIDEO_STATUS_REJECTED)),
+                          [v2])
+
+        v1.tags = 'tag2'
+        self.assertEquals(list(models.Video.objects.with_tag(tag1, site)),
+                          [])
+
+        models.VideoTagIndex.objects.all().delete()
+        models.VideoTagIndex.objects.rebuild()
+        self.assertEquals(list(models.Video.objects.with_tag(tag2, site)),
+                          [v1])
+        self.assertEquals(list(models.Video.objects.with_tag(
+                    tag1, site, status=models.VIDEO_STATUS_REJECTED)),
+                          [v2])
+
+    def test_moderate(self):
+        """
+        Video.objects.moderate() should change the status of the videos the
+        way saving them would have: setting the approval dates, updating the
+        tag index, queueing the videos for the search index and throwing
+        away the cached pages and counts.
+        """
+        site = self.site_location.site
+        videos = list(models.Video.objects.filter(
+                status=models.VIDEO_STATUS_UNAPPROVED)[:3])
+        videos[0].tags = 'tag1'
+        tag1 = Tag.objects.get(name='tag1')
+        models.SearchIndexQueue.objects.all().delete()
+        generation = util.get_site_generation(site.pk)
+        count_version = util.get_cache_version(models.Video._meta.db_table)
+        progress = []
+
+        models.Video.objects.moderate(
+            [video.pk for video in videos], models.VIDEO_STATUS_ACTIVE,
+            chunk_size=2, progress=lambda *args: progress.append(args))
+        self.assertEquals(progress, [(2, 3), (3, 3)])
+        for video in videos:
+            saved = models.Video.objects.get(pk=video.pk)
+            self.assertEquals(saved.status, models.VIDEO_STATUS_ACTIVE)
+            self.assertTrue(saved.when_approved is not None)
+            self.assertEquals(saved.best_posted_date, saved.when_approved)
+            self.assertEquals(saved.best_date, saved.when_published or
+                              saved.when_approved)
+        self.assertEquals(list(models.Video.objects.with_tag(tag1, site)),
+                          [videos[0]])
+        self.assertEquals(
+            set(models.SearchIndexQueue.objects.values_list('video_id',
+                                                            flat=True)),
+            set(video.pk for video in videos))
+        self.assertNotEquals(util.get_site_generation(site.pk), generation)
+        self.assertNotEquals(
+            util.get_cache_version(models.Video._meta.db_table),
+            count_version)
+
+        models.Video.objects.moderate([videos[0].pk],
+                                      models.VIDEO_STATUS_REJECTED)
+        self.assertEquals(list(models.Video.objects.with_tag(tag1, site)),
+                          [])
+
     def test_thumbnail_deleted(self):
         """
         If a Video has a thumbnail, deleting the Video should remove the
@@ -1520,6 +2050,77 @@ COALESCE(localtv_video.when_approved,localtv_video.when_submitted)"""}
             self.assertFalse(storage.default_storage.exists(path),
                              '%s was not deleted' % path)
 
+# -----------------------------------------------------------------------------
+# Category model tests
+# -----------------------------------------------------------------------------
+
+class CategoryModelTestCase(BaseTestCase):
+
+    fixtures = BaseTestCase.fixtures + ['categories', 'videos']
+
+    def test_in_order(self):
+        """
+        Category.in_order() should return the categories in tree order (each
+        category followed by its children, sorted by name), and depth() should
+        be the number of parents.
+        """
+        categories = models.Category.in_order(self.site_location.site)
+        self.assertEquals([(category.name, category.depth())
+                           for category in categories],
+                          [(u'Blogroll', 0),
+                           (u'Miro', 0),
+                           (u'Linux', 1),
+                           (u'Ubuntu', 2),
+                           (u'Windows', 1)])
+
+        miro = models.Category.objects.get(slug='miro')
+        self.assertEquals([category.name for category in
+                           models.Category.in_order(self.site_location.site,
+                                                    miro.child_set.all())],
+                          [u'Linux', u'Ubuntu', u'Windows'])
+
+    def test_tree_updated(self):
+        """
+        Moving, adding or deleting a category should update the tree.
+        """
+        ubuntu = models.Category.objects.get(slug='ubuntu')
+        ubuntu.parent = None
+        ubuntu.save()
+        self.assertEquals(ubuntu.depth(), 0)
+
+        models.Category.objects.create(site=self.site_location.site,
+                                       name='Debian', slug='debian',
+                                       parent=ubuntu)
+        models.Category.objects.get(slug='linux').delete()
+
+        self.assertEquals([(category.name, category.depth())
+                           for category in models.Category.in_order(
+                    self.site_location.site)],
+                          [(u'Blogroll', 0),
+                           (u'Miro', 0),
+                           (u'Windows', 1),
+                           (u'Ubuntu', 0),
+                           (u'Debian', 1)])
+
+    def test_approved_set(self):
+        """
+        Category.approved_set should include the active videos in the
+        category and in all of its descendants.
+        """
+        miro = models.Category.objects.get(slug='miro')
+        ubuntu = models.Category.objects.get(slug='ubuntu')
+        active = list(models.Video.objects.filter(
+                status=models.VIDEO_STATUS_ACTIVE)[:2])
+        active[0].categories.add(miro)
+        active[1].categories.add(ubuntu)
+        models.Video.objects.filter(
+            status=models.VIDEO_STATUS_UNAPPROVED)[0].categories.add(ubuntu)
+
+        self.assertEquals(set(miro.approved_set), set(active))
+        self.assertEquals(list(ubuntu.approved_set), [active[1]])
+        self.assertEquals(list(models.Category.objects.get(
+                    slug='blogroll').approved_set), [])
+
 # -----------------------------------------------------------------------------
 # Watch model tests
 # -----------------------------------------------------------------------------
@@ -1583,6 +2184,465 @@ class WatchModelTestCase(BaseTestCase):
         self.assertEquals(w.video, video)
         self.assertEquals(w.ip_address, '0.0.0.0')
 
+    def test_add_dedup_user(self):
+        """
+        Repeat views of the same video by the same user should only be
+        recorded once, even from a different IP address.
+        """
+        request = HttpRequest()
+        request.META['REMOTE_ADDR'] = '123.123.123.123'
+        request.user = User.objects.get(username='user')
+
+        video = models.Video.objects.get(pk=1)
+
+        models.Watch.add(request, video)
+        request.META['REMOTE_ADDR'] = '124.124.124.124'
+        models.Watch.add(request, video)
+
+        self.assertEquals(models.Watch.objects.count(), 1)
+        self.assertEquals(models.Watch.stats()['recorded'], 1)
+        self.assertEquals(models.Watch.stats()['deduped'], 1)
+
+    def test_add_dedup_ip(self):
+        """
+        Repeat views of the same video from the same anonymous IP address
+        should only be recorded once.  Views of other videos, or from other
+        IP addresses, should still be recorded.
+        """
+        request = HttpRequest()
+        request.META['REMOTE_ADDR'] = '123.123.123.123'
+
+        video = models.Video.objects.get(pk=1)
+        other_video = models.Video.objects.get(pk=2)
+
+        models.Watch.add(request, video)
+        models.Watch.add(request, video)
+        models.Watch.add(request, other_video)
+        request.META['REMOTE_ADDR'] = '124.124.124.124'
+        models.Watch.add(request, video)
+
+        self.assertEquals(models.Watch.objects.count(), 3)
+        self.assertEquals(models.Watch.stats()['deduped'], 1)
+
+    def test_add_dedup_window_disabled(self):
+        """
+        If settings.LOCALTV_WATCH_DEDUP_WINDOW is 0, every view should be
+        recorded.
+        """
+        old_window = getattr(settings, 'LOCALTV_WATCH_DEDUP_WINDOW', None)
+        settings.LOCALTV_WATCH_DEDUP_WINDOW = 0
+        try:
+            request = HttpRequest()
+            request.META['REMOTE_ADDR'] = '123.123.123.123'
+
+            video = models.Video.objects.get(pk=1)
+
+            models.Watch.add(request, video)
+            models.Watch.add(request, video)
+        finally:
+            if old_window is None:
+                del settings.LOCALTV_WATCH_DEDUP_WINDOW
+            else:
+                settings.LOCALTV_WATCH_DEDUP_WINDOW = old_window
+
+        self.assertEquals(models.Watch.objects.count(), 2)
+
+    def test_add_failed_save_not_deduped(self):
+        """
+        If saving the Watch fails, the viewer's next view should still be
+        recorded.
+        """
+        request = HttpRequest()
+        request.META['REMOTE_ADDR'] = '123.123.123.123'
+        video = models.Video.objects.get(pk=1)
+
+        def save(self, *args, **kwargs):
+            raise RuntimeError('save failed')
+        old_save = models.Watch.save
+        models.Watch.save = save
+        try:
+            models.Watch.add(request, video)
+        finally:
+            models.Watch.save = old_save
+        self.assertEquals(models.Watch.objects.count(), 0)
+
+        models.Watch.add(request, video)
+        self.assertEquals(models.Watch.objects.count(), 1)
+
+    def test_add_ignores_robots(self):
+        """
+        Views from user agents that look like robots should not be recorded.
+        """
+        request = HttpRequest()
+        request.META['REMOTE_ADDR'] = '123.123.123.123'
+        request.META['HTTP_USER_AGENT'] = ('Mozilla/5.0 (compatible; '
+                                           'Googlebot/2.1)')
+
+        video = models.Video.objects.get(pk=1)
+
+        models.Watch.add(request, video)
+
+        self.assertEquals(models.Watch.objects.count(), 0)
+        self.assertEquals(models.Watch.stats()['filtered'], 1)
+
+
+class CompactWatchesTestCase(BaseTestCase):
+
+    fixtures = BaseTestCase.fixtures + ['videos', 'watched']
+
+    def test_compact(self):
+        """
+        The compact_watches command should fold Watch records older than the
+        retention window into WatchRollups and delete them, leaving newer
+        watches alone.
+        """
+        recent = models.Watch.objects.all()[0]
+        recent.timestamp = datetime.datetime.now()
+        recent.save()
+        old_watches = models.Watch.objects.exclude(pk=recent.pk)
+        expected = {}
+        for watch in old_watches:
+            key = (watch.video_id, watch.timestamp.date())
+            expected[key] = expected.get(key, 0) + 1
+
+        compact_watches.Command().handle_noargs(chunk_size=2, verbosity=0)
+
+        self.assertEquals(list(models.Watch.objects.all()), [recent])
+        self.assertEquals(
+            dict(((rollup.video_id, rollup.date), rollup.count)
+                 for rollup in models.WatchRollup.objects.all()),
+            expected)
+
+    def test_popular_since_includes_rollups(self):
+        """
+        Compacted watches should still be counted by
+        Video.objects.popular_since() when the time period reaches past the
+        retention window.
+        """
+        before = list(models.Video.objects.popular_since(
+                datetime.timedelta.max, self.site_location))
+
+        compact_watches.Command().handle_noargs(verbosity=0)
+        self.assertEquals(models.Watch.objects.count(), 0)
+        cache.clear()
+
+        self.assertEquals(list(models.Video.objects.popular_since(
+                    datetime.timedelta.max, self.site_location)),
+                          before)
+
+
+class PruneTombstonesTestCase(BaseTestCase):
+
+    def test_prune(self):
+        """
+        The prune_tombstones command should delete the tombstones older than
+        the retention window, and leave the newer ones alone.
+        """
+        site = self.site_location.site
+        old = models.VideoTombstone.objects.create(site=site, video_id=1)
+        old.when_deleted = datetime.datetime.now() - datetime.timedelta(
+            days=100)
+        old.save()
+        recent = models.VideoTombstone.objects.create(site=site, video_id=2)
+
+        prune_tombstones.Command().handle_noargs(chunk_size=1, verbosity=0)
+        self.assertEquals(list(models.VideoTombstone.objects.all()),
+                          [recent])
+
+
+class UpdateSearchQueueTestCase(BaseTestCase):
+
+    fixtures = BaseTestCase.fixtures + ['videos']
+
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        from haystack import site
+        site.get_index(models.Video).reindex()
+        models.SearchIndexQueue.objects.all().delete()
+
+    def search(self, query):
+        return [int(result.pk) for result in
+                SearchQuerySet().models(models.Video).filter(content=query)]
+
+    def test_queue(self):
+        """
+        Changing, rejecting or deleting a video should queue it, and the
+        update_search_queue command should bring the index up to date and
+        empty the queue.
+        """
+        active = models.Video.objects.filter(
+            status=models.VIDEO_STATUS_ACTIVE)
+        changed, rejected, deleted = active[:3]
+        changed.name = 'Zyzzyva'
+        changed.save()
+        rejected.status = models.VIDEO_STATUS_REJECTED
+        rejected.save()
+        deleted_pk = deleted.pk
+        deleted.delete()
+        self.assertEquals(
+            set(models.SearchIndexQueue.objects.values_list('video_id',
+                                                            flat=True)),
+            set([changed.pk, rejected.pk, deleted_pk]))
+        self.assertEquals(self.search('zyzzyva'), [])
+
+        update_search_queue.Command().handle_noargs(batch_size=2,
+                                                    verbosity=0)
+        self.assertEquals(models.SearchIndexQueue.objects.count(), 0)
+        self.assertEquals(self.search('zyzzyva'), [changed.pk])
+        indexed = [int(result.pk) for result in
+                   SearchQuerySet().models(models.Video)]
+        self.assertFalse(rejected.pk in indexed)
+        self.assertFalse(deleted_pk in indexed)
+
+        stats = models.SearchIndexQueue.stats()
+        self.assertEquals(stats['queued'], 0)
+        self.assertEquals(stats['last_batch']['size'], 1)
+
+    def test_relations_queue(self):
+        """
+        Changing a video's tags or categories should queue it.
+        """
+        video = models.Video.objects.filter(
+            status=models.VIDEO_STATUS_ACTIVE)[0]
+        video.tags = 'tag1'
+        category = models.Category.objects.create(
+            site=self.site_location.site, name='Category', slug='category')
+        category.video_set.add(video)
+        self.assertEquals(
+            set(models.SearchIndexQueue.objects.values_list('video_id',
+                                                            flat=True)),
+            set([video.pk]))
+
+    def test_paused(self):
+        """
+        While the queue is paused (during a rebuild of the index), the
+        update_search_queue command should leave the videos queued.
+        """
+        video = models.Video.objects.filter(
+            status=models.VIDEO_STATUS_ACTIVE)[0]
+        video.save()
+        models.SearchIndexQueue.pause()
+        update_search_queue.Command().handle_noargs(verbosity=0)
+        self.assertEquals(
+            list(models.SearchIndexQueue.objects.values_list('video_id',
+                                                             flat=True)),
+            [video.pk])
+
+        models.SearchIndexQueue.resume()
+        update_search_queue.Command().handle_noargs(verbosity=0)
+        self.assertEquals(models.SearchIndexQueue.objects.count(), 0)
+
+
+class RebuildSearchIndexTestCase(BaseTestCase):
+
+    fixtures = BaseTestCase.fixtures + ['videos']
+
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.old_HAYSTACK_SEARCH_ENGINE = getattr(
+            settings, 'HAYSTACK_SEARCH_ENGINE', None)
+        self.old_HAYSTACK_WHOOSH_PATH = getattr(
+            settings, 'HAYSTACK_WHOOSH_PATH', None)
+        settings.HAYSTACK_SEARCH_ENGINE = 'whoosh'
+        settings.HAYSTACK_WHOOSH_PATH = os.path.join(self.tmpdir, 'index')
+
+    def tearDown(self):
+        settings.HAYSTACK_SEARCH_ENGINE = self.old_HAYSTACK_SEARCH_ENGINE
+        settings.HAYSTACK_WHOOSH_PATH = self.old_HAYSTACK_WHOOSH_PATH
+        BaseTestCase.tearDown(self)
+
+    def test_rebuild(self):
+        """
+        The rebuild_search_index command should build a new Whoosh index in
+        its own directory, and swap it in for the live index (which isn't
+        written to) once it has all the videos.  The queue is paused until
+        then.
+        """
+        from whoosh.filedb.filestore import FileStorage
+        from haystack import site
+        path = settings.HAYSTACK_WHOOSH_PATH
+        os.makedirs(path)
+        open(os.path.join(path, 'live'), 'w').close()
+        index = site.get_index(models.Video)
+        count = index.get_queryset().count()
+
+        rebuild_search_index.Command().handle_noargs(chunk_size=5,
+                                                     workers=1,
+                                                     verbosity=0)
+        self.assertTrue(os.path.islink(path))
+        new_path = os.path.realpath(path)
+        self.assertNotEquals(new_path, os.path.abspath(path))
+        self.assertFalse(os.path.exists(path + '.old'))
+        self.assertFalse(os.path.exists(os.path.join(new_path, 'live')))
+        self.assertEquals(
+            FileStorage(new_path).open_index().doc_count_all(), count)
+        self.assertFalse(models.SearchIndexQueue.is_paused())
+
+    def test_prepared_index(self):
+        """
+        PreparedIndex should hand the documents which were already prepared
+        to the backend's update(), which calls full_prepare().
+        """
+        from haystack import site
+        video = models.Video.objects.filter(
+            status=models.VIDEO_STATUS_ACTIVE)[0]
+        document = {'text': 'prepared'}
+        prepared = rebuild_search_index.PreparedIndex(
+            site.get_index(models.Video), [video], [document])
+        self.assertTrue(prepared.full_prepare(video) is document)
+
+
+class SearchIndexQueueTransactionTestCase(TransactionTestCase):
+
+    def test_add_outside_transaction(self):
+        """
+        SearchIndexQueue.add() should commit its rows when it's called
+        outside of transaction management.
+        """
+        models.SearchIndexQueue.add(1, 2, 2)
+        transaction.rollback()
+        self.assertEquals(
+            sorted(models.SearchIndexQueue.objects.values_list('video_id',
+                                                               flat=True)),
+            [1, 2])
+
+
+class RelatedVideosTestCase(BaseTestCase):
+
+    fixtures = BaseTestCase.fixtures + ['categories', 'videos']
+
+    def test_compute(self):
+        """
+        The compute_related_videos command should store, for each video, the
+        videos which share the most of its rarest tags, categories and
+        authors, and view_video should show them.
+        """
+        video, most, less = models.Video.objects.filter(
+            status=models.VIDEO_STATUS_ACTIVE)[:3]
+        video.user = None
+        video.save()
+        video.categories.clear()
+        video.authors.clear()
+        video.tags = 'related1 related2'
+        most.tags = 'related1 related2'
+        less.tags = 'related1'
+
+        compute_related_videos.Command().handle_noargs(verbosity=0)
+        self.assertEquals(models.RelatedVideos.objects.for_video(video),
+                          [most, less])
+
+        response = Client().get(video.get_absolute_url())
+        self.assertEquals(response.context['related_videos'], [most, less])
+        self.assertEquals(response.context['popular_videos'], [most, less])
+
+        # the stored lists outlive the cache, and inactive videos are left
+        # out
+        cache.clear()
+        most.status = models.VIDEO_STATUS_REJECTED
+        most.save()
+        self.assertEquals(models.RelatedVideos.objects.for_video(video),
+                          [less])
+
+
+class VideoIndexTestCase(BaseTestCase):
+
+    fixtures = BaseTestCase.fixtures + ['categories', 'videos']
+
+    def test_preload(self):
+        """
+        Once VideoIndex.preload() has loaded a list of videos, preparing
+        their search documents shouldn't need any more queries.
+        """
+        from haystack import site
+        index = site.get_index(models.Video)
+        user = User.objects.get(username='user')
+        video = models.Video.objects.get(pk=12)
+        video.authors.add(user)
+        video.tags = 'tag1 tag2'
+        video.categories.add(models.Category.objects.get(slug='ubuntu'))
+
+        videos = index.preload(models.Video.objects.filter(pk__in=[12, 13]))
+        old_DEBUG = settings.DEBUG
+        settings.DEBUG = True # so that queries are logged
+        connection.queries = []
+        try:
+            documents = [index.prepare(video) for video in videos]
+            self.assertEquals(connection.queries, [])
+        finally:
+            settings.DEBUG = old_DEBUG
+        self.assertEquals(documents[0]['authors'], [user.pk])
+        self.assertEquals(sorted(documents[0]['tags']), [u'tag1', u'tag2'])
+        self.assertEquals(documents[0]['playlists'], [])
+        # Ubuntu is in Linux, which is in Miro
+        self.assertEquals(documents[0]['category_tree'], [1, 2, 6])
+        # each video only carries its own tree to the worker processes
+        self.assertEquals(videos[0].__dict__['_prefetched_category_tree'],
+                          [1, 2, 6])
+
+
+class CachedCountPaginatorTestCase(BaseTestCase):
+
+    fixtures = BaseTestCase.fixtures + ['videos']
+
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.old_threshold = pagination.COUNT_ESTIMATE_THRESHOLD
+
+    def tearDown(self):
+        pagination.COUNT_ESTIMATE_THRESHOLD = self.old_threshold
+        BaseTestCase.tearDown(self)
+
+    def get_paginator(self):
+        return pagination.CachedCountPaginator(
+            models.Video.objects.filter(status=models.VIDEO_STATUS_ACTIVE),
+            10)
+
+    def test_count_cached(self):
+        """
+        The count should come from the cache until a Video is saved.
+        """
+        count = models.Video.objects.filter(
+            status=models.VIDEO_STATUS_ACTIVE).count()
+        self.assertEquals(self.get_paginator().count, count)
+
+        # update() doesn't send signals, so the cached count is still used
+        models.Video.objects.filter(pk=2).update(
+            status=models.VIDEO_STATUS_REJECTED)
+        self.assertEquals(self.get_paginator().count, count)
+
+        video = models.Video.objects.get(pk=4)
+        video.status = models.VIDEO_STATUS_REJECTED
+        video.save()
+        paginator = self.get_paginator()
+        self.assertEquals(paginator.count, count - 2)
+        self.assertFalse(paginator.approximate)
+
+    def test_count_approximate(self):
+        """
+        Once a query has had more results than
+        LOCALTV_COUNT_ESTIMATE_THRESHOLD, later counts should be approximate.
+        """
+        pagination.COUNT_ESTIMATE_THRESHOLD = 5
+        count = models.Video.objects.filter(
+            status=models.VIDEO_STATUS_ACTIVE).count()
+        paginator = self.get_paginator()
+        self.assertEquals(paginator.count, count)
+        self.assertFalse(paginator.approximate)
+
+        models.Video.objects.get(pk=2).save() # invalidate the cached count
+        paginator = self.get_paginator()
+        self.assertEquals(paginator.count, count)
+        self.assertTrue(paginator.approximate)
+
+    def test_not_a_queryset(self):
+        """
+        Lists are counted with len(), as with a regular Paginator.
+        """
+        paginator = pagination.CachedCountPaginator(range(25), 10)
+        self.assertEquals(paginator.count, 25)
+        self.assertEquals(paginator.num_pages, 3)
+        self.assertFalse(paginator.approximate)
+
 
 # -----------------------------------------------------------------------------
 # SavedSearch model tests
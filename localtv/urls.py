@@ -28,6 +28,8 @@ urlpatterns = patterns(
 urlpatterns += patterns(
     'localtv.listing.views',
     (r'^search/$', 'video_search', {}, 'localtv_search'),
+    (r'^search/suggest/$', 'search_suggestions', {},
+     'localtv_search_suggestions'),
     (r'^category/$', 'category', {}, 'localtv_category_index'),
     (r'^category/([-\w]+)$', 'category', {}, 'localtv_category'),
     (r'^author/$', 'author', {}, 'localtv_author_index'),
@@ -18,6 +18,7 @@
 import hashlib
 import re
 import string
+import time
 import urllib
 
 from django.conf import settings
@@ -168,6 +169,60 @@ def get_scraped_data(url):
 
     return scraped_data
 
+def get_cache_version(name):
+    """
+    Returns the current version of the named group of cache entries.  Include
+    it in the cache keys, and bump_cache_version() will invalidate them all at
+    once.
+    """
+    key = 'localtv.cache_version:%s' % name
+    version = cache.get(key)
+    if version is None:
+        # start from the current time, so that a version which was evicted
+        # from the cache doesn't come back with an old number
+        cache.add(key, int(time.time()))
+        version = cache.get(key)
+    return version
+
+def bump_cache_version(name):
+    """
+    Invalidates all the cache entries which were keyed with the named
+    version.
+    """
+    key = 'localtv.cache_version:%s' % name
+    try:
+        cache.incr(key)
+    except ValueError: # not in the cache
+        cache.set(key, int(time.time()))
+
+def get_site_generation(site_id):
+    """
+    Returns the content generation of the given site.  It changes whenever
+    a video, category, feed, playlist or the SiteLocation is saved or
+    deleted.
+    """
+    return get_cache_version('site:%s' % site_id)
+
+def bump_site_generation(site_id):
+    bump_cache_version('site:%s' % site_id)
+
+def site_cache_key(site_id, *parts):
+    """
+    Returns a cache key for content from the given site.  The key includes the
+    site's content generation, so all of the keys are invalidated together
+    when the content changes.
+    """
+    key = 'localtv.site:%s:%s:%s' % (
+        site_id, get_site_generation(site_id),
+        ':'.join(force_unicode(part) for part in parts).encode('utf8'))
+    if len(key) >= 250 or re.search(r'\s', key):
+        # too long (or has characters memcached doesn't like), use the hash
+        key = 'localtv.site:%s:%s:hash-%s' % (
+            site_id, get_site_generation(site_id),
+            hashlib.sha1(key).hexdigest())
+    return key
+
+
 def send_notice(notice_label, subject, message, fail_silently=True,
                 sitelocation=None):
     notice_type = notification.NoticeType.objects.get(label=notice_label)
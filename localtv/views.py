@@ -26,11 +26,14 @@ from django.views.decorators.vary import vary_on_headers
 
 
 from localtv import models
+from localtv.decorators import cache_anonymous_page
 from localtv.listing import views as listing_views
 
 from localtv.playlists.models import (Playlist, PlaylistItem,
                                       PLAYLIST_STATUS_PUBLIC)
 
+# the popular videos don't change the content generation, so expire sooner
+@cache_anonymous_page(5 * 60)
 def index(request):
     featured_videos = models.Video.objects.filter(
         site=request.sitelocation.site_id,
@@ -67,6 +70,7 @@ def index(request):
         context_instance=RequestContext(request))
 
 
+@cache_anonymous_page(60 * 60)
 def about(request):
     return render_to_response(
         'localtv/about.html',
@@ -121,11 +125,18 @@ def view_video(request, video_id, slug=None):
             category_obj = video.categories.all()[0]
 
         context['category'] = category_obj
+
+    # precomputed by the compute_related_videos command; once they're there,
+    # they're shown in place of the popular videos
+    context['related_videos'] = models.RelatedVideos.objects.for_video(video)
+    if context['related_videos']:
+        context['popular_videos'] = context['related_videos']
+    elif 'category' in context:
         context['popular_videos'] = models.Video.objects.popular_since(
             datetime.timedelta(days=7),
             sitelocation=request.sitelocation,
             status=models.VIDEO_STATUS_ACTIVE,
-            categories__pk=category_obj.pk)
+            categories__pk=context['category'].pk)
     else:
         context['popular_videos'] = models.Video.objects.popular_since(
             datetime.timedelta(days=7),
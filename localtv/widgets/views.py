@@ -17,20 +17,28 @@
 
 import datetime
 
+from django.core.cache import cache
 from django.shortcuts import render_to_response
 from django.template.context import RequestContext
 
-from localtv import models
+from localtv import models, util
 
 def widget(func):
     def wrapper(request, *args, **kwargs):
-        objects = func(request, *args, **kwargs)
         try:
             count = int(request.GET.get('count'))
         except TypeError:
-            count = 3
+            objects = func(request, *args, **kwargs)
         else:
-            objects = objects[:count]
+            # the videos are cached until the site's content changes
+            cache_key = util.site_cache_key(request.sitelocation.site_id,
+                                            'widget', func.__name__, args,
+                                            sorted(kwargs.items()), count)
+            objects = cache.get(cache_key)
+            if objects is None:
+                objects = list(func(request, *args, **kwargs)[:count])
+                cache.set(cache_key, objects)
+        objects = models.prefetch_videos(objects)
         return render_to_response('localtv/widgets/widget.html',
                                   {'objects': objects},
                                   context_instance=RequestContext(request))
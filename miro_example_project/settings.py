@@ -184,6 +184,10 @@ BROKER_VHOST = '/'
 CELERY_BACKEND = 'cache' # this MUST be set, otherwise the import page won't be
                          # able to figure out if the task has ended
 
+# cache the public listing pages for anonymous visitors, until the site's
+# content changes (see localtv.decorators.cache_anonymous_page)
+LOCALTV_PAGE_CACHE = False
+
 # haystack search
 HAYSTACK_SITECONF = 'miro_example_project.search_sites'
 HAYSTACK_SEARCH_ENGINE = 'whoosh'